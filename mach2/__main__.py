@@ -2,6 +2,8 @@ import os
 import asyncio
 import argparse
 
+os.environ.setdefault("KIVY_CLOCK", "interrupt") # lets callbacks wake an idle clock (idle.py)
+
 from .kivy_chat_app import ChatApp
 
 if __name__ == '__main__':
@@ -11,7 +13,29 @@ if __name__ == '__main__':
         description="NLIP Chat App"
     )
     parser.add_argument("-p", "--plain", action='store_true', help="Use plain formatting")
+    parser.add_argument("-b", "--blocks", action='store_true', help="Lay out Markdown as one widget per block")
+    parser.add_argument("--lean-bubbles", action='store_true', help="Draw each message on one widget (not with --blocks)")
     parser.add_argument("-m", "--mock", action='store_true', help="Use Mock response server")
+    parser.add_argument("--compress", default="none", help="Request body compression: none, gzip, br or zstd, with optional :level")
+    parser.add_argument("--compression-config", default=None, help="JSON file of per-endpoint compression settings")
+    parser.add_argument("--credential-store", default="memory", choices=["memory", "keyring", "file"], help="Where to remember server credentials")
+    parser.add_argument("--credential-file", default=None, help="Encrypted credential file for --credential-store=file")
+    parser.add_argument("--retries", type=int, default=3, help="Attempts per message before giving up")
+    parser.add_argument("--connect-timeout", type=float, default=10.0, help="Seconds to establish a connection")
+    parser.add_argument("--read-timeout", type=float, default=120.0, help="Seconds to wait for response data")
+    parser.add_argument("--total-timeout", type=float, default=300.0, help="Seconds for a message including retries")
+    parser.add_argument("--backup-url", default=None, help="Backup server for hedged requests")
+    parser.add_argument("--hedge-ms", type=float, default=None, help="Hedge after this delay instead of the observed p95")
+    parser.add_argument("--cache", action='store_true', help="Answer repeated queries from a local response cache")
+    parser.add_argument("--cache-ttl", type=float, default=300.0, help="Seconds a cached response stays fresh")
+    parser.add_argument("--cache-dir", default=None, help="Directory for the response cache")
+    parser.add_argument("--render-workers", type=int, default=0, help="Processes for rendering large responses (0: render in-process)")
+    parser.add_argument("--render-threshold", type=int, default=16384, help="Characters above which a response is rendered in a worker process")
+    parser.add_argument("--idle-fps", type=float, default=10, help="Frame rate when nothing is happening (0: always the full rate)")
+    parser.add_argument("--idle-after", type=float, default=2.0, help="Seconds without activity before the frame rate drops")
+    parser.add_argument("--stall-ms", type=float, default=0, help="Record main thread stacks when the UI is blocked this long (0: off)")
+    parser.add_argument("--stall-dir", default=None, help="Directory for the stall stacks (default ~/.mach2/stalls)")
+    parser.add_argument("--memory-mb", type=float, default=0, help="Memory budget for the history; older messages spill to disk (0: no limit)")
 
     # Parse the argument from the command line
     cmdargs = parser.parse_args()
@@ -0,0 +1,325 @@
+#
+# Export and import of a whole conversation as one binary archive.
+#
+# Layout (all integers little-endian):
+#
+#   header   b"M2CA"  u16 version  u16 flags
+#   record   u8 kind  u32 length  payload[length]   ... repeated
+#
+# Record kinds:
+#
+#   IMAGE    32-byte sha256 of the data, str extension, then the image bytes.
+#            Each distinct image is stored once, however many messages use it.
+#   MESSAGE  str id, str role, str message_type, f64 timestamp, u8 cached,
+#            str content, str formatted (empty unless FLAG_MARKUP), u16 image
+#            count, then a 32-byte sha256 per image.
+#
+# where str is a u32 byte length followed by UTF-8.  Image records always come
+# before the messages that refer to them.
+#
+# Import memory-maps the archive.  Message records are decoded; image records
+# are only located.  A message's image_paths name files in the content-addressed
+# image directory, but an image that is not there yet is written out from the
+# archive (mapped again by path) only when it is first used: call
+# ensure_image(path) before opening an image file.  Opening a large archive
+# therefore reads none of its images, and reopening one finds them on disk.
+# ensure_image() reads and writes the whole image, so the UI calls it from a
+# worker thread (thumbnails.ensure_image_later).
+#
+# If the archive has been moved or deleted by the time an image is needed, the
+# image cannot be written out; observers added with add_extract_observer() are
+# told once per archive.
+#
+
+import os
+import mmap
+import struct
+import hashlib
+import threading
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from .models import Message
+
+
+MAGIC = b"M2CA"
+VERSION = 1
+
+FLAG_MARKUP = 0x0001 # messages carry their rendered markup
+
+KIND_IMAGE = 1
+KIND_MESSAGE = 2
+
+DEFAULT_IMAGE_DIR = os.path.join(os.path.expanduser("~"), ".mach2", "images")
+
+_HEADER = struct.Struct("<4sHH")
+_RECORD = struct.Struct("<BI")
+_U32 = struct.Struct("<I")
+_U16 = struct.Struct("<H")
+_MESSAGE_FIXED = struct.Struct("<dB")
+
+
+class ArchiveError(Exception):
+    pass
+
+
+# images of imported archives not written out yet: path -> (archive path, offset, length)
+_unextracted: Dict[str, tuple] = {}
+_extracting: Dict[str, threading.Event] = {} # path -> set once written (or failed)
+_extract_lock = threading.Lock()
+_extract_observers: List[Callable[[str, Exception], None]] = []
+_failed_archives = set() # archives already reported
+
+
+def add_extract_observer(callback: Callable[[str, Exception], None]):
+    """Be told (archive path, error), in the extracting thread, when images cannot be read from an archive"""
+    _extract_observers.append(callback)
+
+
+def pending_image(path: str) -> bool:
+    """True if path is an image of an imported archive that is not written out yet"""
+    return path in _unextracted
+
+
+def _write_image(path: str, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _extract(path: str, archive_path: str, offset: int, length: int):
+    """Write an image straight from a mapping of its archive"""
+    with open(archive_path, "rb") as f:
+        try:
+            archive = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # empty file
+            raise ArchiveError(f"{archive_path} is empty")
+        with archive:
+            if offset + length > len(archive):
+                raise ArchiveError(f"{archive_path} is truncated")
+            with memoryview(archive) as view, view[offset:offset + length] as blob:
+                _write_image(path, blob)
+
+
+def ensure_image(path: str) -> str:
+    """
+    Write out an image of an imported archive the first time it is used.
+    Blocks while it is written, so call it from a worker thread.  Returns the
+    path, which is left missing if the archive has gone.
+    """
+    with _extract_lock:
+        location = _unextracted.pop(path, None)
+        if location is None:
+            done = _extracting.get(path)
+        else:
+            done = _extracting[path] = threading.Event()
+    if location is None: # written already, or being written by another thread
+        if done is not None:
+            done.wait()
+        return path
+
+    (archive_path, offset, length) = location
+    try:
+        if not os.path.exists(path):
+            _extract(path, archive_path, offset, length)
+    except (OSError, ArchiveError) as e:
+        print(f"IMAGE EXTRACT FAILED:{path}:{e}")
+        with _extract_lock:
+            report = archive_path not in _failed_archives
+            _failed_archives.add(archive_path)
+        if report:
+            for observer in _extract_observers:
+                observer(archive_path, e)
+    finally:
+        with _extract_lock:
+            del _extracting[path]
+        done.set()
+    return path
+
+
+def _pack_str(value: Optional[str]) -> bytes:
+    data = (value or "").encode("utf-8")
+    return _U32.pack(len(data)) + data
+
+
+def _unpack_str(buf, offset: int):
+    (length,) = _U32.unpack_from(buf, offset)
+    offset += _U32.size
+    return (bytes(buf[offset:offset + length]).decode("utf-8"), offset + length)
+
+
+def _write_record(f, kind: int, payload: bytes):
+    f.write(_RECORD.pack(kind, len(payload)))
+    f.write(payload)
+
+
+def export_archive(path: str, messages: List[Message], include_markup: bool = False) -> dict:
+    """
+    Write messages and their images to an archive.  Images whose files are gone
+    are left out of the message.  Returns counts of what was written.
+    """
+    stored: Dict[str, str] = {} # image path -> sha256 hex
+    images_written = 0
+    images_missing = 0
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, FLAG_MARKUP if include_markup else 0))
+        written = set()
+
+        for message in messages:
+            digests = []
+            for image_path in message.image_paths:
+                digest = stored.get(image_path)
+                if digest is None:
+                    try:
+                        with open(ensure_image(image_path), "rb") as image_file:
+                            data = image_file.read()
+                    except OSError:
+                        images_missing += 1
+                        continue
+                    digest = hashlib.sha256(data).hexdigest()
+                    stored[image_path] = digest
+                    if digest not in written: # the same image under another name
+                        extension = os.path.splitext(image_path)[1].lstrip(".")
+                        _write_record(f, KIND_IMAGE, bytes.fromhex(digest) + _pack_str(extension) + data)
+                        written.add(digest)
+                        images_written += 1
+                digests.append(digest)
+
+            payload = b"".join([
+                _pack_str(message.id),
+                _pack_str(message.role),
+                _pack_str(message.message_type if digests else "text"),
+                _MESSAGE_FIXED.pack(message.timestamp.timestamp(), 1 if message.cached else 0),
+                _pack_str(message.content),
+                _pack_str(message.formatted if include_markup else None),
+                _U16.pack(len(digests)),
+            ] + [ bytes.fromhex(d) for d in digests ])
+            _write_record(f, KIND_MESSAGE, payload)
+
+    os.replace(tmp_path, path)
+    return { "messages": len(messages), "images": images_written, "images_missing": images_missing }
+
+
+class ArchiveReader:
+    """
+    Read an archive through a memory mapping.
+
+    Args:
+        path: the archive file
+        image_dir: where images are written, named by content hash
+    """
+
+    def __init__(self, path: str, image_dir: str = DEFAULT_IMAGE_DIR):
+        self.path = path
+        self.image_dir = image_dir
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # empty file
+            self._file.close()
+            raise ArchiveError(f"{path} is empty")
+
+        if len(self._map) < _HEADER.size:
+            self.close()
+            raise ArchiveError(f"{path} is not a conversation archive")
+        (magic, version, self.flags) = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version > VERSION:
+            self.close()
+            raise ArchiveError(f"{path} is not a conversation archive (version {version})")
+
+        self._images: Dict[str, tuple] = {} # sha256 hex -> (extension, offset, length)
+
+    @property
+    def has_markup(self) -> bool:
+        return bool(self.flags & FLAG_MARKUP)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _image_file(self, digest: str) -> str:
+        (extension, offset, length) = self._images[digest]
+        return os.path.join(self.image_dir, f"{digest}.{extension}" if extension else digest)
+
+    def lazy_image_path(self, digest: str) -> str:
+        """The file for an image, written by ensure_image() when it is first used"""
+        path = self._image_file(digest)
+        if not os.path.exists(path):
+            (extension, offset, length) = self._images[digest]
+            _unextracted[path] = (os.path.abspath(self.path), offset, length)
+        return path
+
+    def messages(self) -> List[Message]:
+        """Decode the messages, locating (not reading) the images they use"""
+        result = []
+        buf = self._map
+        offset = _HEADER.size
+        end = len(buf)
+
+        while offset < end:
+            if offset + _RECORD.size > end:
+                raise ArchiveError(f"{self.path} is truncated")
+            (kind, length) = _RECORD.unpack_from(buf, offset)
+            offset += _RECORD.size
+            if offset + length > end:
+                raise ArchiveError(f"{self.path} is truncated")
+
+            if kind == KIND_IMAGE:
+                digest = buf[offset:offset + 32].hex()
+                (extension, data_offset) = _unpack_str(buf, offset + 32)
+                self._images[digest] = (extension, data_offset, offset + length - data_offset)
+            elif kind == KIND_MESSAGE:
+                result.append(self._decode_message(buf, offset))
+            # unknown kinds from a later minor version are skipped
+
+            offset += length
+
+        return result
+
+    def _decode_message(self, buf, offset: int) -> Message:
+        (id, offset) = _unpack_str(buf, offset)
+        (role, offset) = _unpack_str(buf, offset)
+        (message_type, offset) = _unpack_str(buf, offset)
+        (timestamp, cached) = _MESSAGE_FIXED.unpack_from(buf, offset)
+        offset += _MESSAGE_FIXED.size
+        (content, offset) = _unpack_str(buf, offset)
+        (formatted, offset) = _unpack_str(buf, offset)
+        (count,) = _U16.unpack_from(buf, offset)
+        offset += _U16.size
+
+        image_paths = []
+        for i in range(count):
+            digest = buf[offset:offset + 32].hex()
+            offset += 32
+            if digest in self._images:
+                image_paths.append(self.lazy_image_path(digest))
+
+        return Message(
+            id=id,
+            content=content,
+            formatted=formatted or None,
+            message_type=message_type if image_paths else "text",
+            image_paths=image_paths,
+            role=role,
+            timestamp=datetime.fromtimestamp(timestamp),
+            cached=bool(cached),
+        )
+
+
+def import_archive(path: str, image_dir: str = DEFAULT_IMAGE_DIR) -> List[Message]:
+    """
+    Read the messages of an archive, with image_paths in image_dir.  The
+    images are written out by ensure_image() when they are first used.
+    """
+    with ArchiveReader(path, image_dir) as reader:
+        return reader.messages()
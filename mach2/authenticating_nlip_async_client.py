@@ -4,33 +4,83 @@
 # RFC2617 Sect 1.2 states that "if a prior request has been authorized" ... the same credentials
 # may be reused.
 
+import time
+import asyncio
 import httpx
+from contextlib import contextmanager
 from nlip_sdk.nlip import NLIP_Message
 
+from .nlip_decoder import NlipDecoder
+from .compression import CompressionSettings
+from .credentials import CredentialCache, Credentials, origin_of, seed_digest_challenge
+from .metrics import metrics
+
 class AuthenticatingNlipAsyncClient:
 
-    def __init__(self, base_url: str):
+    def __init__(self, base_url: str, decoder: NlipDecoder = None, compression: CompressionSettings = None, transport = None,
+                 credential_cache: CredentialCache = None):
         self.base_url = base_url
-        self.client = httpx.AsyncClient()
-        self.recursion = 0
+        self.origin = origin_of(base_url)
+        self.transport = transport
+        self.decoder = decoder or NlipDecoder()
+        self.compression = compression or CompressionSettings()
+        self.credential_cache = credential_cache or CredentialCache()
+
+        # send credentials with the first request if this origin is already known
+        self.client = self._create_client()
+        if self.credential_cache.get(self.origin) is not None:
+            metrics.incr("auth.preemptive")
 
         self.on_login_elicitation = None  # obtain username/password
         self.on_bearer_elicitation = None # obtain bearer token
+        self._asking = 0 # elicitations waiting for the user
+        self._credentials_given = None # asyncio.Event set when they have all been answered
+
+    # create the client with whatever credentials are cached for the origin
+    def _create_client(self):
+        auth = self.credential_cache.auth_for(self.origin)
+        headers = self.credential_cache.headers_for(self.origin)
+        return httpx.AsyncClient(auth=auth, headers=headers, transport=self.transport)
 
     # add basic auth to the client and recreate it
     def add_basic_auth(self, username: str, password: str):
-        auth = httpx.BasicAuth(username=username, password=password)
-        self.client = httpx.AsyncClient(auth=auth)
-
-    # add digest auth to the client and recreate it
-    def add_digest_auth(self, username: str, password: str):
-        auth = httpx.DigestAuth(username=username, password=password)
-        self.client = httpx.AsyncClient(auth=auth)
-
-    # add digest auth to the client and recreate it
+        self.credential_cache.put(self.origin, Credentials("basic", username=username, password=password))
+        self.client = self._create_client()
+
+    # add digest auth to the client and recreate it.  If the 401 response is given,
+    # its challenge is used right away, saving the round trip for a fresh nonce.
+    def add_digest_auth(self, username: str, password: str, challenge: httpx.Response = None):
+        self.credential_cache.put(self.origin, Credentials("digest", username=username, password=password))
+        self.client = self._create_client()
+        if challenge is not None:
+            seed_digest_challenge(self.credential_cache.auth_for(self.origin), challenge.request, challenge)
+
+    # add bearer token to the client and recreate it
     def add_bearer_token(self, bearer: str):
-        headers = { "Authorization" : f"Bearer {bearer}" }
-        self.client = httpx.AsyncClient(headers=headers)
+        self.credential_cache.put(self.origin, Credentials("bearer", bearer=bearer))
+        self.client = self._create_client()
+
+    # mark the time spent waiting for the user to give credentials
+    @contextmanager
+    def _asking_user(self):
+        if self._credentials_given is None:
+            self._credentials_given = asyncio.Event()
+        self._asking += 1
+        try:
+            yield
+        finally:
+            self._asking -= 1
+            if not self._asking:
+                (event, self._credentials_given) = (self._credentials_given, None)
+                event.set()
+
+    # wait while the user is being asked for credentials.  Returns True if they were.
+    async def wait_for_credentials(self) -> bool:
+        event = self._credentials_given
+        if event is None:
+            return False
+        await event.wait()
+        return True
 
     # register an elicitation for username/password
     def on_login_requested(self, on_login_elicitation):
@@ -41,7 +91,8 @@ class AuthenticatingNlipAsyncClient:
     async def elicit_login_credentials(self):
         print(f"ELICIT LOGIN CREDENTIALS")
         if self.on_login_elicitation:
-            (username, password) = await self.on_login_elicitation(self)
+            with self._asking_user():
+                (username, password) = await self.on_login_elicitation(self)
             return (username, password)
         else:
             print(f"NO LOGIN HANDLER REGISTERED")
@@ -56,62 +107,90 @@ class AuthenticatingNlipAsyncClient:
     async def elicit_bearer_credentials(self):
         print(f"ELICIT BEARER CREDENTIALS")
         if self.on_bearer_elicitation:
-            bearer = await self.on_bearer_elicitation(self)
+            with self._asking_user():
+                bearer = await self.on_bearer_elicitation(self)
             return bearer
         else:
             print(f"NO BEARER HANDLER REGISTERED")
             return ""
 
     @classmethod
-    def create_from_url(cls, base_url:str):
-        return AuthenticatingNlipAsyncClient(base_url)
+    def create_from_url(cls, base_url:str, decoder: NlipDecoder = None, compression: CompressionSettings = None, transport = None,
+                        credential_cache: CredentialCache = None):
+        return AuthenticatingNlipAsyncClient(base_url, decoder=decoder, compression=compression, transport=transport,
+                                             credential_cache=credential_cache)
+
+    # Open a connection to the server and measure the round trip.  Any HTTP
+    # response counts as reachable; the connection stays in the pool for the
+    # first message.  Returns (status_code, seconds).
+    async def async_probe(self, timeout = 10.0):
+        started = time.perf_counter()
+        response = await self.client.options(self.base_url, timeout=timeout)
+        return (response.status_code, time.perf_counter() - started)
 
     async def Xasync_send(self, msg:NLIP_Message) -> NLIP_Message:
-        response = await self.client.post(self.base_url, json=msg.to_dict(), timeout=120.0, follow_redirects=True)
-        data = response.raise_for_status().json()
-        nlip_msg = NLIP_Message(**data)
+        content, headers = self.compression.encode_body(msg.to_json().encode("utf-8"))
+        response = await self.client.post(self.base_url, content=content, headers=headers, timeout=120.0, follow_redirects=True)
+        response.raise_for_status()
+        nlip_msg = await self.decoder.async_decode(response.content)
+        return nlip_msg
+
+    async def async_send(self, msg:NLIP_Message, headers: dict = None, timeout = 120.0) -> NLIP_Message:
+        (nlip_msg, response) = await self.async_exchange(msg, headers, timeout)
         return nlip_msg
 
-    async def async_send(self, msg:NLIP_Message) -> NLIP_Message:
-        self.recursion = 0
-        return await self._async_send(msg)
+    # send a message and return both the reply and the HTTP response it came in
+    async def async_exchange(self, msg:NLIP_Message, headers: dict = None, timeout = 120.0):
+        return await self._async_exchange(msg, headers, timeout)
         
-    async def _async_send(self, msg:NLIP_Message) -> NLIP_Message:
+    # login tries are counted per exchange, as several can be in flight (batch.py)
+    async def _async_exchange(self, msg:NLIP_Message, headers: dict = None, timeout = 120.0, tries: int = 0):
         print(f"ASYNC_SEND")
+        started = time.perf_counter()
         try:
-            response = await self.client.post(self.base_url, json=msg.to_dict(), timeout=120.0, follow_redirects=True)
+            content, body_headers = self.compression.encode_body(msg.to_json().encode("utf-8"))
+            body_headers.update(headers or {})
+            response = await self.client.post(self.base_url, content=content, headers=body_headers, timeout=timeout, follow_redirects=True)
             response.raise_for_status() # raise an exception if status
-            data = response.json()
-            nlip_msg = NLIP_Message(**data)
-            return nlip_msg
+            # large bodies are decoded in a worker thread so the UI keeps drawing
+            nlip_msg = await self.decoder.async_decode(response.content)
+            return (nlip_msg, response)
 
         except httpx.HTTPStatusError as e:
             if e.response.status_code == 401:
                 print(f"401 Headers:{e.response.headers}")
-                self.recursion += 1
-                if self.recursion > 4:
-                    raise Exception(f"Too many login tries:{self.recursion}")
+                # the round trip spent on the challenge
+                metrics.incr("auth.challenge")
+                metrics.observe("auth.challenge.roundtrip", time.perf_counter() - started)
+
+                # cached credentials were rejected: forget them and ask again
+                if self.credential_cache.get(self.origin) is not None:
+                    self.credential_cache.forget(self.origin)
+
+                tries += 1
+                if tries > 4:
+                    raise Exception(f"Too many login tries:{tries}")
                 else:
                     if e.response.headers.get('www-authenticate', None) is not None:
                         scheme = e.response.headers.get('www-authenticate')
                         print(f"Authentication Required:{scheme}.  Requesting Credentials")
-                        if scheme == 'Basic':
-                            future = self.elicit_login_credentials()
-                            (username, password) = await future
+                        if scheme.startswith('Basic'):
+                            with metrics.timer("auth.elicitation"):
+                                (username, password) = await self.elicit_login_credentials()
                             self.add_basic_auth(username, password)
                         elif scheme.startswith('Digest'):
-                            future = self.elicit_login_credentials()
-                            (username, password) = await future
-                            self.add_digest_auth(username, password)
+                            with metrics.timer("auth.elicitation"):
+                                (username, password) = await self.elicit_login_credentials()
+                            self.add_digest_auth(username, password, challenge=e.response)
                         elif scheme.startswith('Bearer'):
-                            future = self.elicit_bearer_credentials()
-                            bearer = await future
+                            with metrics.timer("auth.elicitation"):
+                                bearer = await self.elicit_bearer_credentials()
                             self.add_bearer_token(bearer)
                         else:
                             raise Exception(f"Unrecognized header: www-authenticate:{scheme}")
 
                         # send the message again with the authorization
-                        return await self._async_send(msg)
+                        return await self._async_exchange(msg, headers, timeout, tries)
                     else:
                         raise e
 
@@ -0,0 +1,218 @@
+#
+# Send prompts to an NLIP server without the UI.
+#
+# Reads one prompt per line of JSONL, sends up to --concurrency of them at a
+# time through the same service layer as the chat app (MessageService and
+# NlipChatBotService: compression, retries, credentials), and writes one JSONL
+# result per prompt, in the order they complete.  Used for regression runs and
+# throughput tests against agents.
+#
+#    $ python -m mach2.batch http://localhost:8000 -i prompts.jsonl -o results.jsonl -c 8
+#
+# Each prompt is an object with "text" and optionally "images" (a list of file
+# paths) and "id" (defaults to the line number):
+#
+#    {"id": "weather-1", "text": "What is the weather in Juneau?"}
+#    {"text": "What is in this picture?", "images": ["pics/cat.png"]}
+#
+# Each result repeats the id and line, and has the "response" text, the
+# paths of any "images" in the response, whether it was "cached", an "error"
+# (null on success), when it was sent ("start_ms", after the batch started)
+# and how long it took ("elapsed_ms").  A summary goes to stderr.
+#
+# A server that asks for credentials is answered from MACH2_USERNAME and
+# MACH2_PASSWORD, or MACH2_BEARER, or from a JSON file given with
+# --credentials with the same fields in lower case ("username", "password",
+# "bearer"); the environment wins.  A bearer token is sent with the first
+# request instead of waiting to be challenged.  The first prompt is sent on
+# its own, so that a login is asked for once rather than by every prompt in
+# flight.
+#
+# The service layer logs to stdout, so while the batch runs that goes to
+# stderr, and results written to "-" go to the real stdout.
+#
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import contextlib
+from typing import Optional
+
+from .models import Roles
+from .services import MockChatBotService, NlipChatBotService, MessageService
+from .compression import CompressionSettings, EndpointCompression
+from .credentials import Credentials, CredentialCache, origin_of
+from .retry import RetryPolicy
+from .metrics import metrics
+
+
+def load_credentials(path: Optional[str] = None) -> dict:
+    """username, password and bearer from a JSON file, overridden by the environment"""
+    credentials = {}
+    if path:
+        with open(path) as f:
+            credentials.update(json.load(f))
+    for field in ("username", "password", "bearer"):
+        value = os.environ.get(f"MACH2_{field.upper()}")
+        if value:
+            credentials[field] = value
+    return credentials
+
+
+def credential_elicitations(credentials: dict):
+    """Elicitation callbacks for NlipChatBotService that answer from the credentials"""
+
+    async def on_login_elicitation(client):
+        if not credentials.get("username"):
+            raise RuntimeError("server asked for a login: set MACH2_USERNAME and MACH2_PASSWORD")
+        return (credentials["username"], credentials.get("password", ""))
+
+    async def on_bearer_elicitation(client):
+        if not credentials.get("bearer"):
+            raise RuntimeError("server asked for a bearer token: set MACH2_BEARER")
+        return credentials["bearer"]
+
+    return (on_login_elicitation, on_bearer_elicitation)
+
+
+def read_prompts(f):
+    """(line number, prompt or None, error) for each non-blank line"""
+    for (number, line) in enumerate(f, start=1):
+        if not line.strip():
+            continue
+        try:
+            prompt = json.loads(line)
+            if not isinstance(prompt, dict) or not isinstance(prompt.get("text", ""), str):
+                raise ValueError("expected an object with a \"text\" string")
+            yield (number, prompt, None)
+        except ValueError as e:
+            yield (number, None, f"bad prompt: {e}")
+
+
+class BatchRunner:
+    """
+    Send prompts through a chatbot service with at most `concurrency` in
+    flight, and write a result line for each one as it completes.
+    """
+
+    def __init__(self, chatbot_service, concurrency: int = 4):
+        self.chatbot_service = chatbot_service
+        self.message_service = MessageService(processor_name='plain') # prompts are not displayed
+        self.concurrency = max(1, concurrency)
+        self.failed = 0
+        self.completed = 0
+
+    async def run(self, prompts, out):
+        self._started = time.perf_counter()
+        self._out = out
+        queue = asyncio.Queue(maxsize=2 * self.concurrency) # reads ahead a little, not the whole file
+        workers = []
+        for item in prompts:
+            if workers:
+                await queue.put(item)
+                continue
+            # the first prompt goes alone, so that a server asking for credentials
+            # is answered once and the other prompts are sent with them
+            self._write(await self._send(*item))
+            if item[1] is not None:
+                workers = [ asyncio.create_task(self._worker(queue)) for i in range(self.concurrency) ]
+        for worker in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+        return time.perf_counter() - self._started
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            self._write(await self._send(*item))
+
+    async def _send(self, number: int, prompt: Optional[dict], error: Optional[str]) -> dict:
+        result = { "id": (prompt or {}).get("id", number), "line": number, "response": None, "images": [],
+                   "cached": False, "error": error, "start_ms": None, "elapsed_ms": None }
+        if error:
+            return result
+
+        start = time.perf_counter()
+        result["start_ms"] = round((start - self._started) * 1000, 1)
+        try:
+            images = prompt.get("images") or []
+            if images:
+                message = self.message_service.create_image_message(prompt.get("text", ""), images, role=Roles.USER)
+            else:
+                message = self.message_service.create_text_message(prompt.get("text", ""), role=Roles.USER)
+            (result["response"], result["images"], result["cached"]) = await self.chatbot_service.send(message)
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+        elapsed = time.perf_counter() - start
+        result["elapsed_ms"] = round(elapsed * 1000, 1)
+        if result["error"] is None:
+            metrics.observe("batch.request", elapsed)
+        return result
+
+    def _write(self, result: dict):
+        self.completed += 1
+        if result["error"] is not None:
+            self.failed += 1
+        self._out.write(json.dumps(result) + "\n")
+        self._out.flush()
+
+
+def create_chatbot_service(args):
+    if args.mock:
+        return MockChatBotService()
+    credentials = load_credentials(args.credentials)
+    credential_cache = CredentialCache()
+    if credentials.get("bearer"): # sent preemptively
+        credential_cache.put(origin_of(args.url), Credentials(scheme="bearer", bearer=credentials["bearer"]))
+    (on_login_elicitation, on_bearer_elicitation) = credential_elicitations(credentials)
+    return NlipChatBotService(compression=EndpointCompression(default=CompressionSettings.parse(args.compress)),
+                              credential_cache=credential_cache,
+                              retry_policy=RetryPolicy(max_attempts=max(1, args.retries),
+                                                       connect_timeout=args.connect_timeout,
+                                                       read_timeout=args.read_timeout,
+                                                       total_timeout=args.total_timeout),
+                              on_login_elicitation=on_login_elicitation,
+                              on_bearer_elicitation=on_bearer_elicitation)
+
+
+async def main(args, out) -> int:
+    chatbot_service = create_chatbot_service(args)
+    status = await chatbot_service.connect_to_server(args.url)
+    print(status, file=sys.stderr)
+
+    runner = BatchRunner(chatbot_service, concurrency=args.concurrency)
+    with contextlib.ExitStack() as stack:
+        f = sys.stdin if args.input == "-" else stack.enter_context(open(args.input))
+        elapsed = await runner.run(read_prompts(f), out)
+
+    summary = metrics.summary("batch.request")
+    latency = f", p50 {summary['p50'] * 1000:.0f}ms, p95 {summary['p95'] * 1000:.0f}ms" if summary["count"] else ""
+    print(f"{runner.completed} prompts, {runner.failed} failed, {elapsed:.1f}s, "
+          f"{runner.completed / elapsed if elapsed else 0:.1f}/s{latency}", file=sys.stderr)
+    return 1 if runner.failed else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="mach2.batch", description="Send JSONL prompts to an NLIP server")
+    parser.add_argument("url", help="NLIP server, e.g. http://localhost:8000")
+    parser.add_argument("-i", "--input", default="-", help="JSONL prompts (default stdin)")
+    parser.add_argument("-o", "--output", default="-", help="JSONL results (default stdout)")
+    parser.add_argument("-c", "--concurrency", type=int, default=4, help="Prompts in flight at once")
+    parser.add_argument("--credentials", default=None, help="JSON file with username and password, or bearer")
+    parser.add_argument("-m", "--mock", action='store_true', help="Use Mock response server")
+    parser.add_argument("--compress", default="none", help="Request body compression: none, gzip, br or zstd, with optional :level")
+    parser.add_argument("--retries", type=int, default=3, help="Attempts per prompt before giving up")
+    parser.add_argument("--connect-timeout", type=float, default=10.0, help="Seconds to establish a connection")
+    parser.add_argument("--read-timeout", type=float, default=120.0, help="Seconds to wait for response data")
+    parser.add_argument("--total-timeout", type=float, default=300.0, help="Seconds for a prompt including retries")
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        out = sys.stdout if args.output == "-" else stack.enter_context(open(args.output, "w"))
+        stack.enter_context(contextlib.redirect_stdout(sys.stderr)) # keep the service layer's logging out of the results
+        sys.exit(asyncio.run(main(args, out)))
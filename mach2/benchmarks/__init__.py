@@ -0,0 +1,3 @@
+# Benchmarks for Mach2.  Run each module from the root directory, e.g.
+#
+#    $ python -m mach2.benchmarks.bench_compression
@@ -0,0 +1,99 @@
+#
+# Measure the cost of authentication challenges, with and without the
+# credential cache, against the local stand-in server.
+#
+# Each case connects (creates a client), sends one message, then reconnects and
+# sends again - as the app does when the user re-enters the server URL.  The
+# credential popups are replaced by handlers that answer immediately.
+#
+#    $ python -m mach2.benchmarks.bench_auth [--rtt-ms 80]
+#
+
+import asyncio
+import argparse
+
+import httpx
+from nlip_sdk.nlip import NLIP_Factory
+
+from ..authenticating_nlip_async_client import AuthenticatingNlipAsyncClient
+from ..credentials import CredentialCache
+from ..metrics import metrics
+from .standin_server import StandInNlipServer, ThrottledLink, timed
+
+
+class StandInAuthServer(StandInNlipServer):
+    """A stand-in server that requires Basic, Digest or Bearer authorization"""
+
+    NONCE = "dcd98b7102dd2f0e8b11d0f600bfb0c093"
+
+    def __init__(self, scheme: str, **kwargs):
+        super().__init__(**kwargs)
+        self.scheme = scheme
+
+    def _authorized(self, request: httpx.Request) -> bool:
+        header = request.headers.get("authorization", "")
+        if self.scheme == "basic":
+            return header == httpx.BasicAuth("user", "secret")._auth_header
+        elif self.scheme == "digest":
+            return header.startswith("Digest ") and 'username="user"' in header and self.NONCE in header
+        else:
+            return header == "Bearer token-123"
+
+    async def respond(self, request: httpx.Request, body: bytes) -> httpx.Response:
+        if self._authorized(request):
+            return await super().respond(request, body)
+
+        if self.scheme == "basic":
+            challenge = 'Basic realm="standin"'
+        elif self.scheme == "digest":
+            challenge = f'Digest realm="standin", qop="auth", nonce="{self.NONCE}", opaque="5ccc069c403ebaf9"'
+        else:
+            challenge = 'Bearer realm="standin"'
+        return httpx.Response(401, headers={"www-authenticate": challenge})
+
+
+async def login(client):
+    return ("user", "secret")
+
+async def bearer(client):
+    return "token-123"
+
+
+async def run_case(scheme: str, cached: bool, link: ThrottledLink):
+    server = StandInAuthServer(scheme, link=link)
+    cache = CredentialCache()
+    msg = NLIP_Factory.create_text("hello")
+
+    results = []
+    for attempt in ("connect", "reconnect"):
+        client = AuthenticatingNlipAsyncClient.create_from_url("http://standin/nlip/", transport=server,
+                                                               credential_cache=cache if cached else CredentialCache())
+        client.on_login_requested(login)
+        client.on_bearer_requested(bearer)
+
+        link.reset()
+        (reply, elapsed) = await timed(client.async_send(msg))
+        results.append(f"{attempt}: {link.stats.requests} requests {elapsed * 1000:7.1f}ms")
+
+    label = f"{scheme}{' cached' if cached else ''}"
+    print(f"{label:<16} " + "   ".join(results))
+
+
+async def main(args):
+    link = ThrottledLink(latency=args.rtt_ms / 1000, bandwidth=None)
+    print(f"Link: {args.rtt_ms} ms RTT")
+    metrics.reset()
+
+    for scheme in ("basic", "digest", "bearer"):
+        await run_case(scheme, cached=False, link=link)
+        await run_case(scheme, cached=True, link=link)
+
+    challenge = metrics.summary("auth.challenge.roundtrip")
+    print(f"challenges:{metrics.count('auth.challenge')}  preemptive sends:{metrics.count('auth.preemptive')}  "
+          f"challenge round trip p50:{challenge['p50'] * 1000:.1f}ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="bench_auth")
+    parser.add_argument("--rtt-ms", type=float, default=80.0, help="Link round trip time in ms")
+    asyncio.run(main(parser.parse_args()))
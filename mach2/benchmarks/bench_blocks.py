@@ -0,0 +1,112 @@
+#
+# Texture work for one long response shown as a single markup Label against
+# the block renderer's RichTextView: the first render, a resize of the bubble,
+# and an update that changes one paragraph (as when a reply is re-rendered).
+#
+#    $ python -m mach2.benchmarks.bench_blocks [--sections 20]
+#
+# Without a display, run it with
+#    KIVY_GL_BACKEND=mock KIVY_METRICS_DENSITY=1 KIVY_TEXT=pil
+#
+
+import os
+import time
+import argparse
+
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+os.environ.setdefault("KIVY_NO_CONSOLELOG", "1")
+
+from kivy.uix.label import Label
+
+from ..renderers.kivy_mistune_bbcode import MarkdownToBBCodeParser
+from ..renderers.kivy_blocks import MarkdownToBlocks
+from ..widgets.rich_text_view import RichTextView, CodeBlock
+
+
+def make_response(sections: int) -> str:
+    parts = []
+    for i in range(sections):
+        parts.append(f"## Step {i}\n\nThis step computes the **partial sums** for chunk {i} and keeps the "
+                     f"running total; see [the notes](https://example.com/{i}) for the details.\n\n"
+                     f"- reads chunk {i}\n- writes `total_{i}`\n\n"
+                     f"```python\n" + "\n".join(f"total_{i} += values[{j}] * scale  # item {j}" for j in range(12)) + "\n```\n")
+    return "\n".join(parts)
+
+
+def labels_of(view):
+    """Every Label in the view, with code labels inside their ScrollViews"""
+    for child in view.children:
+        if isinstance(child, CodeBlock):
+            yield child.children[0]
+        elif isinstance(child, Label):
+            yield child
+
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return (time.perf_counter() - start) * 1000
+
+
+def main(args):
+    content = make_response(args.sections)
+    changed = content.replace("chunk 3 and", "chunk three and", 1)
+    markup = MarkdownToBBCodeParser().parse(content)
+    parser = MarkdownToBlocks()
+    blocks = parser.parse(content)
+    print(f"{len(content)} characters, {len(blocks)} blocks")
+
+    label = Label(text=markup, markup=True, size_hint_y=None)
+
+    def label_width(width):
+        label.text_size = (width, None)
+        label.texture_update()
+
+    view = RichTextView()
+
+    def view_width(width):
+        view.width = width
+        for child in view.children:
+            child.width = width
+        for child in labels_of(view):
+            child.texture_update()
+
+    def view_update(content):
+        view.blocks = parser.parse(content)
+        view_width(view.width)
+
+    print(f"first render   label:{timed(lambda: label_width(600)):8.1f}ms   blocks:{timed(lambda: view_update(content)):8.1f}ms")
+
+    # on resize only the text blocks wrap again
+    def view_resize(width):
+        view.width = width
+        for child in view.children:
+            child.width = width
+        for child in view.children:
+            if isinstance(child, Label):
+                child.texture_update()
+
+    print(f"resize         label:{timed(lambda: label_width(450)):8.1f}ms   blocks:{timed(lambda: view_resize(450)):8.1f}ms")
+
+    # an update re-renders the changed block only
+    before = set(map(id, view.children))
+    def view_changed():
+        view.blocks = parser.parse(changed)
+        for child in view.children:
+            if id(child) not in before:
+                child.width = view.width
+                for label in ([child.children[0]] if isinstance(child, CodeBlock) else [child]):
+                    label.texture_update()
+    new_markup = MarkdownToBBCodeParser().parse(changed)
+    def label_changed():
+        label.text = new_markup
+        label.texture_update()
+
+    print(f"one paragraph  label:{timed(label_changed):8.1f}ms   blocks:{timed(view_changed):8.1f}ms")
+    print(f"widgets rebuilt on update: {sum(1 for c in view.children if id(c) not in before)} of {len(view.children)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="bench_blocks")
+    parser.add_argument("--sections", type=int, default=20, help="Sections (heading, text, list, code) in the response")
+    main(parser.parse_args())
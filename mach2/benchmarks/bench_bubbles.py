@@ -0,0 +1,126 @@
+#
+# Cost per message of MessageBubble (chat.kv) against LeanBubble: widgets,
+# canvas instructions drawn every frame, Python memory, and CPU time to build
+# and lay out a history and to lay it out again at another width.
+#
+#    $ python -m mach2.benchmarks.bench_bubbles [--messages 200]
+#
+# Without a display, run it with
+#    KIVY_GL_BACKEND=mock KIVY_METRICS_DENSITY=1 KIVY_TEXT=pil
+#
+
+import os
+import time
+import argparse
+import tracemalloc
+
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+os.environ.setdefault("KIVY_NO_CONSOLELOG", "1")
+
+from kivy.lang import Builder
+from kivy.clock import Clock
+from kivy.uix.boxlayout import BoxLayout
+from kivy.graphics import InstructionGroup
+from kivy.graphics.instructions import VertexInstruction
+
+from ..models import Message, Roles
+from ..processors.mistune_processor import MistuneProcessor
+from ..kivy_chat_app import MessageBubble
+from ..widgets.lean_bubble import LeanBubble
+
+
+REPLIES = [
+    "Sure, I can help with that.",
+    "The forecast for Juneau tonight is cloudy with a chance of rain, around 0.2 inches.",
+    "**Today:**\n- Temperature: 57°F\n- Wind: 10 to 15 mph from Southeast\n- Conditions: Rainy and cloudy",
+    "See [the docs](https://example.com/docs) and use `pip install mach2` to install it.",
+]
+
+
+def make_messages(count: int):
+    processor = MistuneProcessor()
+    messages = []
+    for i in range(count):
+        role = Roles.USER if i % 2 == 0 else Roles.ASSISTANT
+        content = f"Question {i} about the weather?" if role == Roles.USER else REPLIES[i % len(REPLIES)]
+        formatted = processor.process(content, role)
+        messages.append(Message(id=str(i), content=content, formatted=formatted, message_type="text",
+                                role=role, cached=(i % 10 == 1)))
+    return messages
+
+
+def settle(seconds: float = 0.15):
+    """Run the clock long enough for MessageBubble's delayed sizing"""
+    end = time.perf_counter() + seconds
+    while True:
+        Clock.tick()
+        Clock.tick_draw()
+        if time.perf_counter() > end:
+            break
+        time.sleep(0.01)
+
+
+def drawn(instruction) -> int:
+    """Vertex instructions under a canvas instruction"""
+    if isinstance(instruction, VertexInstruction):
+        return 1
+    if isinstance(instruction, InstructionGroup):
+        return sum(drawn(child) for child in instruction.children)
+    return 0
+
+
+def census(layout):
+    widgets = list(layout.walk(restrict=True))[1:]
+    instructions = 0
+    for widget in widgets:
+        canvas = widget.canvas
+        instructions += drawn(canvas)
+        if canvas.has_before:
+            instructions += drawn(canvas.before)
+        if canvas.has_after:
+            instructions += drawn(canvas.after)
+    return (len(widgets), instructions)
+
+
+def build(bubble_class, messages):
+    layout = BoxLayout(orientation='vertical', size_hint_y=None, width=800)
+    layout.bind(minimum_height=layout.setter('height'))
+    for message in messages:
+        layout.add_widget(bubble_class(message))
+    settle()
+    return layout
+
+
+def measure(name: str, bubble_class, messages):
+    start = time.process_time()
+    layout = build(bubble_class, messages)
+    elapsed = time.process_time() - start
+
+    start = time.process_time()
+    layout.width = 600
+    settle()
+    resize = time.process_time() - start
+    (widgets, instructions) = census(layout)
+
+    tracemalloc.start() # separately, as tracing slows allocation down
+    build(bubble_class, messages)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    count = len(messages)
+    print(f"{name:<14} widgets:{widgets / count:5.1f}  instructions:{instructions / count:5.1f}  "
+          f"memory:{memory / count / 1024:6.1f}KB  build:{elapsed / count * 1000:6.2f}ms  "
+          f"resize:{resize / count * 1000:6.2f}ms  height:{layout.height:.0f}  (per message)")
+
+
+def main(args):
+    Builder.load_file(os.path.join(os.path.dirname(__file__), "..", "chat.kv"))
+    messages = make_messages(args.messages)
+    measure("MessageBubble", MessageBubble, messages)
+    measure("LeanBubble", LeanBubble, messages)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="bench_bubbles")
+    parser.add_argument("--messages", type=int, default=200, help="Messages in the history")
+    main(parser.parse_args())
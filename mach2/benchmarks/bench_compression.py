@@ -0,0 +1,65 @@
+#
+# Compare bytes on the wire and latency of NLIP exchanges with and without
+# compression, over a throttled link to the local stand-in server.
+#
+# Each exchange sends a text message with an image attached and receives a
+# reply that also carries an image.
+#
+#    $ python -m mach2.benchmarks.bench_compression [--mbps 2] [--rtt-ms 80] [-n 5]
+#
+
+import os
+import asyncio
+import argparse
+from base64 import b64encode
+from statistics import median
+
+from nlip_sdk.nlip import NLIP_Factory
+
+from ..nlip_async_client import NlipAsyncClient
+from ..compression import CompressionSettings, available_encodings
+from .standin_server import StandInNlipServer, ThrottledLink, timed
+
+RESOURCES = os.path.join(os.path.dirname(os.path.dirname(__file__)), "resources")
+IMAGE = os.path.join(RESOURCES, "mach2A.png")
+
+
+def make_request():
+    msg = NLIP_Factory.create_text("Describe this image and return a variation of it.")
+    with open(IMAGE, "rb") as f:
+        msg.add_binary(b64encode(f.read()).decode("utf-8"), "image", "png", label="mach2A.png")
+    return msg
+
+
+async def run_case(label: str, settings: CompressionSettings, link: ThrottledLink, count: int):
+    server = StandInNlipServer(link=link, image_path=IMAGE)
+    client = NlipAsyncClient.create_from_url("http://standin/nlip/", compression=settings, transport=server)
+    msg = make_request()
+
+    link.reset()
+    latencies = []
+    for i in range(count):
+        (reply, elapsed) = await timed(client.async_send(msg))
+        latencies.append(elapsed)
+
+    stats = link.stats
+    print(f"{label:<14} up/req:{stats.bytes_up // count:>8}B  down/req:{stats.bytes_down // count:>8}B  "
+          f"median:{median(latencies) * 1000:8.1f}ms  max:{max(latencies) * 1000:8.1f}ms")
+
+
+async def main(args):
+    link = ThrottledLink(latency=args.rtt_ms / 1000, bandwidth=args.mbps * 1_000_000 / 8)
+    print(f"Link: {args.mbps} Mbit/s, {args.rtt_ms} ms RTT, {args.n} exchanges per case")
+
+    await run_case("identity", CompressionSettings(accept_encoding="identity"), link, args.n)
+    for encoding in available_encodings():
+        await run_case(encoding, CompressionSettings(encoding=encoding), link, args.n)
+        await run_case(f"{encoding}:1", CompressionSettings(encoding=encoding, level=1), link, args.n)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="bench_compression")
+    parser.add_argument("--mbps", type=float, default=2.0, help="Link bandwidth in Mbit/s")
+    parser.add_argument("--rtt-ms", type=float, default=80.0, help="Link round trip time in ms")
+    parser.add_argument("-n", type=int, default=5, help="Exchanges per case")
+    asyncio.run(main(parser.parse_args()))
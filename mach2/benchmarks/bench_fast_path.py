@@ -0,0 +1,57 @@
+#
+# Per-message cost of MistuneProcessor for short, chatty replies with and
+# without Markdown, with the plain-text fast path against the full parse.
+# The fast path's output is checked against the full parse for every reply it
+# takes.
+#
+#    $ python -m mach2.benchmarks.bench_fast_path [--repeat 2000]
+#
+
+import time
+import argparse
+
+from ..models import Roles
+from ..metrics import metrics
+from ..processors.mistune_processor import MistuneProcessor, plain_markup
+
+
+REPLIES = [
+    "Sure, I can help with that.",
+    "The forecast for Juneau tonight is cloudy with a chance of rain, around 0.2 inches.",
+    "Done. I added the meeting to your calendar for Tuesday at 3pm.\n\nAnything else?",
+    "It is 72 degrees and sunny in Madrid right now.",
+    "Here is the **summary** you asked for.",
+    "1. Pack\n2. Drive",
+    "Use `pip install mach2` to install it.",
+    "See https://example.com for details.",
+]
+
+
+def per_message(function, content, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        function(content)
+    return (time.perf_counter() - start) / repeat
+
+
+def main(args):
+    processor = MistuneProcessor()
+    full = processor.renderer.parse
+
+    for content in REPLIES:
+        fast = plain_markup(content)
+        full_time = per_message(full, content, args.repeat)
+        process_time = per_message(lambda c: processor.process(c, Roles.ASSISTANT), content, args.repeat)
+        if fast is not None and fast != full(content):
+            print(f"MISMATCH {content!r}")
+        path = "fast" if fast is not None else "parse"
+        print(f"{path:<6} process:{process_time * 1e6:8.1f}us  full parse:{full_time * 1e6:8.1f}us  {content[:40]!r}")
+
+    counters = metrics.snapshot()["counters"]
+    print(f"hits:{counters.get('render.fast_path.hit', 0)}  misses:{counters.get('render.fast_path.miss', 0)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="bench_fast_path")
+    parser.add_argument("--repeat", type=int, default=2000, help="Timed repetitions per reply")
+    main(parser.parse_args())
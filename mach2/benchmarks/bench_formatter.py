@@ -0,0 +1,118 @@
+#
+# Time of KivyBBCodeFormatter on code of growing size, up to 1 MB, for inputs
+# that make long single-style runs (one huge JSON string, one huge comment,
+# a line of thousands of unstyled name and operator tokens)
+# and for ordinary mixed code.  The source is lexed once up front so only the
+# formatter is timed; linear scaling shows as a constant time per MB.
+#
+# The same inputs, and shell commands full of unclosed "/*" globs, are then
+# run through quick_highlight, the regex coloring used for big code blocks.
+#
+# Every output is checked: with the markup tags removed and the escapes undone
+# it must give back the input exactly, so nothing went out unescaped, and the
+# last run of a token stream is checked the same way.
+#
+#    $ python -m mach2.benchmarks.bench_formatter [--max-kb 1024]
+#
+
+import re
+import io
+import time
+import argparse
+
+from pygments.token import Token
+from pygments.lexers import get_lexer_by_name
+
+from ..renderers.kivy_pygments_bbcode import KivyBBCodeFormatter
+from ..renderers.quick_highlight import quick_highlight
+
+
+TAGS = re.compile(r"\[/?[a-z]+(?:=[^\]]*)?\]")
+
+
+def json_string(size):
+    return '{"blob": "' + ("abc[def]&ghi " * (size // 13)) + '"}\n'
+
+
+def long_comment(size):
+    return "/* " + ("array[i] & mask " * (size // 16)) + "*/\nint x = 1;\n"
+
+
+def unstyled_names(size):
+    return "names = " + ("alpha + beta[i] - gamma " * (size // 24)) + "\n"
+
+
+def mixed_code(size):
+    line = "    values[i] = compute(x & 0xff, 'tag[0]')  # step\n"
+    return "def f(values, x):\n" + line * (size // len(line))
+
+
+def shell_globs(size):
+    line = "cp src/*.py build/N/\n"
+    return line * (size // len(line))
+
+
+CASES = [ ("json string", "json", json_string), ("long comment", "c", long_comment),
+          ("unstyled run", "python", unstyled_names), ("mixed code", "python", mixed_code) ]
+
+
+def round_trips(markup, code):
+    """True if markup is code, escaped, between tags"""
+    text = TAGS.sub("", markup)
+    if "[" in text or "]" in text:
+        return False
+    return text.replace("&bl;", "[").replace("&br;", "]").replace("&amp;", "&") == code
+
+
+def run_case(label, language, make, sizes):
+    formatter = KivyBBCodeFormatter(style="default")
+    lexer = get_lexer_by_name(language)
+    for size in sizes:
+        code = make(size)
+        tokens = list(lexer.get_tokens(code))
+        out = io.StringIO()
+        start = time.perf_counter()
+        formatter.format(tokens, out)
+        elapsed = time.perf_counter() - start
+        ok = round_trips(out.getvalue(), code)
+        print(f"{label:<13} {len(code) // 1024:>6}KB {len(tokens):>8} tokens {elapsed * 1000:8.1f}ms "
+              f"{elapsed / (len(code) / 2**20) * 1000:7.1f}ms/MB  {'ok' if ok else 'ESCAPING WRONG'}")
+
+
+def run_quick_case(label, make, sizes):
+    for size in sizes:
+        code = make(size)
+        start = time.perf_counter()
+        markup = quick_highlight(code)
+        elapsed = time.perf_counter() - start
+        ok = round_trips(markup, code)
+        print(f"{label:<13} {len(code) // 1024:>6}KB {'quick':>15} {elapsed * 1000:8.1f}ms "
+              f"{elapsed / (len(code) / 2**20) * 1000:7.1f}ms/MB  {'ok' if ok else 'ESCAPING WRONG'}")
+
+
+def check_tail():
+    """The last run of a token stream must be escaped like the others"""
+    tokens = [ (Token.Name, "x"), (Token.Text, " "), (Token.Comment, "# last[0] & more") ]
+    out = io.StringIO()
+    KivyBBCodeFormatter(style="default").format(tokens, out)
+    ok = round_trips(out.getvalue(), "x # last[0] & more")
+    print(f"final run     {'escaped' if ok else 'NOT ESCAPED'}: {out.getvalue()!r}")
+
+
+def main(args):
+    check_tail()
+    sizes = []
+    size = args.max_kb * 1024
+    while size >= 64 * 1024:
+        sizes.insert(0, size)
+        size //= 2
+    for (label, language, make) in CASES:
+        run_case(label, language, make, sizes)
+    for (label, language, make) in CASES + [ ("shell globs", "bash", shell_globs) ]:
+        run_quick_case(label, make, sizes)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="bench_formatter")
+    parser.add_argument("--max-kb", type=int, default=1024, help="Largest input in KB")
+    main(parser.parse_args())
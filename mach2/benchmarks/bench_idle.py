@@ -0,0 +1,90 @@
+#
+# Frames and CPU time per second of an idle history: at the full frame rate,
+# after the IdleGovernor has dropped to the idle rate, and while suspended
+# (minimized), plus how long a result from a worker thread waits for a frame
+# when idle.
+#
+#    $ python -m mach2.benchmarks.bench_idle [--seconds 3] [--messages 200]
+#
+# Without a display, run it with
+#    KIVY_GL_BACKEND=mock KIVY_METRICS_DENSITY=1 KIVY_TEXT=pil
+# The mock backend draws nothing, so the CPU figures are those of the clock,
+# layout and canvas updates, not of the GPU driver.
+#
+
+import os
+import time
+import argparse
+import threading
+
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+os.environ.setdefault("KIVY_NO_CONSOLELOG", "1")
+os.environ.setdefault("KIVY_CLOCK", "interrupt") # as in __main__.py
+
+from kivy.clock import Clock
+
+from ..idle import IdleGovernor
+from ..widgets.lean_bubble import LeanBubble
+from .bench_bubbles import make_messages, build
+
+
+def run(seconds: float):
+    """Frames per second and CPU ms per second of the clock loop"""
+    frames = 0
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    end = wall + seconds
+    while time.perf_counter() < end:
+        Clock.tick()
+        Clock.tick_draw()
+        frames += 1
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+    return (frames / wall, cpu / wall * 1000)
+
+
+def wake_latency(samples: int = 20):
+    """Worst delay of a callback that a worker thread schedules for the next frame"""
+    latencies = []
+    def worker(i):
+        time.sleep((i % 10) / 100) # somewhere within an idle frame
+        start = time.perf_counter()
+        Clock.schedule_once(lambda dt: latencies.append(time.perf_counter() - start))
+    for i in range(samples):
+        thread = threading.Thread(target=worker, args=(i,))
+        thread.start()
+        while len(latencies) <= i:
+            Clock.tick()
+            Clock.tick_draw()
+        thread.join()
+    return max(latencies)
+
+
+def report(name: str, result):
+    (fps, cpu) = result
+    print(f"{name:<12} frames/s:{fps:6.1f}  cpu:{cpu:6.1f}ms/s")
+
+
+def main(args):
+    layout = build(LeanBubble, make_messages(args.messages)) # laid out, with its thumbnail and measuring threads
+
+    governor = IdleGovernor(idle_fps=0)
+    report("full rate", run(args.seconds))
+    Clock.unschedule(governor._check)
+
+    governor = IdleGovernor(idle_fps=args.idle_fps, idle_after=0.2)
+    run(0.5) # goes idle
+    report("idle", run(args.seconds))
+    governor.suspend()
+    report("suspended", run(args.seconds))
+    governor.resume()
+    run(0.5) # idle again
+    print(f"idle: worker result shown after (worst): {wake_latency() * 1000:.0f}ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="bench_idle")
+    parser.add_argument("--seconds", type=float, default=3, help="Seconds in each state")
+    parser.add_argument("--messages", type=int, default=200, help="Messages in the history")
+    parser.add_argument("--idle-fps", type=float, default=10, help="Idle frame rate")
+    main(parser.parse_args())
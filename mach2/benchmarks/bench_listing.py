@@ -0,0 +1,62 @@
+#
+# A response with one long code block, shown as one markup Label (the whole
+# block colored by quick_highlight) and as the block renderer's virtualized
+# ListingBlock: time to parse, to show the first screen, and to scroll to the
+# middle, the height of the Label's texture, and how many line widgets exist.
+#
+#    $ python -m mach2.benchmarks.bench_listing [--lines 5000]
+#
+# Without a display, run it with
+#    KIVY_GL_BACKEND=mock KIVY_METRICS_DENSITY=1 KIVY_TEXT=pil
+#
+
+import os
+import time
+import argparse
+
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+os.environ.setdefault("KIVY_NO_CONSOLELOG", "1")
+
+from kivy.uix.label import Label
+from kivy.uix.recycleview import RecycleView
+
+from ..renderers.kivy_mistune_bbcode import MarkdownToBBCodeParser
+from ..renderers.kivy_blocks import MarkdownToBlocks
+from ..widgets.rich_text_view import ListingBlock
+from .bench_render import make_response
+from .bench_table import settle, timed
+
+
+def main(args):
+    content = make_response(args.lines)
+    print(f"{args.lines} lines, {len(content)} characters")
+
+    (parse_ms, markup) = timed(lambda: MarkdownToBBCodeParser().parse(content))
+    label = Label(text=markup, markup=True, font_size='13sp')
+    def show_label():
+        label.text_size = (None, None)
+        label.texture_update()
+        settle() # and the refresh it scheduled
+    (show_ms, _) = timed(show_label)
+    print(f"label    parse:{parse_ms:8.1f}ms  first screen:{show_ms:8.1f}ms  texture:{label.texture_size}")
+
+    (parse_ms, blocks) = timed(lambda: MarkdownToBlocks().parse(content))
+    listing = next(block for block in blocks if block.kind == "listing")
+    def show_listing():
+        widget = ListingBlock(listing, width=800)
+        settle()
+        return widget
+    (show_ms, widget) = timed(show_listing)
+    lines = next(child for child in widget.children[0].children if isinstance(child, RecycleView))
+    def scroll():
+        lines.scroll_y = 0.5
+        settle()
+    (scroll_ms, _) = timed(scroll)
+    print(f"listing  parse:{parse_ms:8.1f}ms  first screen:{show_ms:8.1f}ms  scroll:{scroll_ms:6.1f}ms  "
+          f"line widgets:{len(lines.children[0].children)}  width:{round(widget.children[0].width)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="bench_listing")
+    parser.add_argument("--lines", type=int, default=5000, help="Lines in the code block")
+    main(parser.parse_args())
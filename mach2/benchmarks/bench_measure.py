@@ -0,0 +1,69 @@
+#
+# Text heights measured by the TextMeasureService against the heights of the
+# bubbles that then render the text: how many differ, what measuring costs in
+# the worker, and what rendering the text costs on the main thread.
+#
+#    $ python -m mach2.benchmarks.bench_measure [--messages 200]
+#
+# Without a display, run it with
+#    KIVY_GL_BACKEND=mock KIVY_METRICS_DENSITY=1 KIVY_TEXT=pil
+#
+
+import os
+import time
+import argparse
+
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+os.environ.setdefault("KIVY_NO_CONSOLELOG", "1")
+
+from kivy.clock import Clock
+
+from ..models import Message, Roles
+from ..metrics import metrics
+from ..processors.mistune_processor import MistuneProcessor
+from ..text_measure import TextMeasureService
+from ..widgets.lean_bubble import LeanBubble, text_width, bubble_height
+from .bench_bubbles import REPLIES
+
+
+def make_messages(count: int):
+    processor = MistuneProcessor()
+    messages = []
+    for i in range(count):
+        role = Roles.USER if i % 3 == 0 else Roles.ASSISTANT
+        content = " ".join([ REPLIES[(i + j) % len(REPLIES)] for j in range(1 + i % 5) ])
+        messages.append(Message(id=str(i), content=content, formatted=processor.process(content, role),
+                                message_type="text", role=role))
+    return messages
+
+
+def main(args):
+    messages = make_messages(args.messages)
+    for row_width in (400, 600, 900):
+        service = TextMeasureService()
+        measured = {}
+        for message in messages:
+            service.request(message.id, message.formatted or message.content, text_width(row_width, message.role),
+                            lambda key, height: measured.__setitem__(key, height))
+        while len(measured) < len(messages):
+            Clock.tick()
+            time.sleep(0.001)
+
+        mismatches = 0
+        start = time.perf_counter()
+        for message in messages:
+            bubble = LeanBubble(message, width=row_width)
+            bubble._layout()
+            if bubble.height != bubble_height(measured[message.id], 0):
+                mismatches += 1
+        render = (time.perf_counter() - start) / len(messages)
+        measure = metrics.summary("measure.text")
+        metrics.reset()
+        print(f"row {row_width:4d}px  mismatches:{mismatches}/{len(messages)}  "
+              f"measure (worker):{measure['mean'] * 1000:6.2f}ms  bubble render (main):{render * 1000:6.2f}ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="bench_measure")
+    parser.add_argument("--messages", type=int, default=200, help="Messages to measure")
+    main(parser.parse_args())
@@ -0,0 +1,76 @@
+#
+# Rendering a response with a 5,000-line code block, in-process and in the
+# process pool.  Besides the time to markup, the benchmark reports the longest
+# stall of the asyncio event loop while rendering, which is what the user sees
+# as a frozen UI.
+#
+#    $ python -m mach2.benchmarks.bench_render [--lines 5000] [--messages 4] [--workers 4]
+#
+
+import time
+import asyncio
+import argparse
+from concurrent.futures import Future
+
+from ..models import Roles
+from ..processors.mistune_processor import MistuneProcessor
+from ..processors.render_pool import RenderPool
+
+
+def make_response(lines: int) -> str:
+    code = "\n".join(f"    total_{i} = compute(values[{i}], scale={i % 7}) + offset  # step {i}" for i in range(lines))
+    return f"Here is the generated module:\n\n```python\ndef generated(values, offset):\n{code}\n```\n"
+
+
+async def watch_loop(stop: asyncio.Event, interval: float = 0.005):
+    """Longest delay of the event loop beyond the expected interval"""
+    worst = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - start - interval)
+    return worst
+
+
+async def run_case(label, processor, content, count):
+    stop = asyncio.Event()
+    watcher = asyncio.create_task(watch_loop(stop))
+    await asyncio.sleep(0.05)
+
+    start = time.perf_counter()
+    pending = []
+    for i in range(count):
+        result = processor.process(content, Roles.ASSISTANT)
+        if not isinstance(result, Future): # markup, or blocks
+            await asyncio.sleep(0) # let the watcher see the stall
+        else:
+            pending.append(asyncio.wrap_future(result))
+    results = await asyncio.gather(*pending)
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    worst = await watcher
+    print(f"{label:<12} {count} messages in {elapsed * 1000:8.1f}ms   longest loop stall:{worst * 1000:8.1f}ms")
+    return results
+
+
+async def main(args):
+    content = make_response(args.lines)
+    print(f"{args.lines} lines, {len(content)} characters per message")
+
+    await run_case("in-process", MistuneProcessor(), content, args.messages)
+
+    pool = RenderPool(workers=args.workers, threshold=1024)
+    await asyncio.sleep(0.5) # workers start and warm up
+    processor = MistuneProcessor(render_pool=pool)
+    await run_case("pool (cold)", processor, content, args.messages)
+    await run_case("pool (warm)", processor, content, args.messages)
+    pool.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="bench_render")
+    parser.add_argument("--lines", type=int, default=5000, help="Lines in the code block")
+    parser.add_argument("--messages", type=int, default=4, help="Messages rendered together")
+    parser.add_argument("--workers", type=int, default=4, help="Render processes")
+    asyncio.run(main(parser.parse_args()))
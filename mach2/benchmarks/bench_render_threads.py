@@ -0,0 +1,86 @@
+#
+# One MarkdownToBBCodeParser shared by several threads.  Every thread renders
+# the same mix of responses (nested lists, code, quotes) and each result is
+# compared with a single-threaded rendering, so the benchmark fails if render
+# state leaks between concurrent parses.  Throughput only scales with threads
+# on a free-threaded Python; under the GIL it shows the cost of contention.
+#
+#    $ python -m mach2.benchmarks.bench_render_threads [--threads 1,2,4,8] [--rounds 50]
+#
+
+import sys
+import time
+import argparse
+import threading
+
+from ..renderers.kivy_mistune_bbcode import MarkdownToBBCodeParser, sample
+
+
+NESTED = """Steps:
+
+1. First
+   1. one
+   2. two
+      1. deep
+      2. deeper
+         1. deepest a
+         2. deepest b
+   3. three
+2. Second
+   - [ ] open task
+   - [x] done task
+3. Third
+
+> A quote with `code` and **bold** and a [link](https://example.com).
+"""
+
+CODE = "Here:\n\n```python\n" + "\n".join(f"x_{i} = f({i})  # step {i}" for i in range(60)) + "\n```\n"
+
+DOCUMENTS = [ sample, NESTED, CODE, "plain text only", "1. a\n2. b\n   1. c\n" ]
+
+
+def worker(parser, expected, rounds, mismatches, barrier):
+    barrier.wait()
+    for r in range(rounds):
+        for (document, reference) in expected:
+            if parser.parse(document) != reference:
+                mismatches.append(document[:40])
+
+
+def run_case(parser, expected, threads, rounds):
+    mismatches = []
+    barrier = threading.Barrier(threads + 1)
+    pool = [ threading.Thread(target=worker, args=(parser, expected, rounds, mismatches, barrier))
+             for i in range(threads) ]
+    for t in pool:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    renders = threads * rounds * len(expected)
+    print(f"{threads:>3} threads  {renders:>6} renders in {elapsed * 1000:8.1f}ms  "
+          f"{renders / elapsed:8.0f} renders/s  mismatches:{len(mismatches)}")
+    return len(mismatches)
+
+
+def main(args):
+    parser = MarkdownToBBCodeParser()
+    expected = [ (document, MarkdownToBBCodeParser().parse(document)) for document in DOCUMENTS ]
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print(f"{len(DOCUMENTS)} documents, GIL {'enabled' if gil else 'disabled'}")
+
+    failures = 0
+    for threads in [ int(n) for n in args.threads.split(",") ]:
+        failures += run_case(parser, expected, threads, args.rounds)
+    if failures:
+        sys.exit(f"{failures} renders differed from the single-threaded output")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="bench_render_threads")
+    parser.add_argument("--threads", default="1,2,4,8", help="Comma-separated thread counts")
+    parser.add_argument("--rounds", type=int, default=50, help="Passes over the documents per thread")
+    main(parser.parse_args())
@@ -0,0 +1,119 @@
+#
+# Tail latency and error rate against flaky stand-in agent servers, comparing a
+# plain send, retries with backoff, and retries with hedging to a backup server.
+#
+# The flaky servers sometimes answer 503 and sometimes stall in their queue.
+# They share a record of Idempotency-Keys, as replicas behind one agent would:
+# a request whose key was already executed gets the stored reply instead of
+# doing the work again.  The benchmark reports how many requests arrived with a
+# repeated key and how many times work was executed more than once.
+#
+#    $ python -m mach2.benchmarks.bench_retry [-n 200] [--seed 1]
+#
+
+import random
+import asyncio
+import argparse
+
+import httpx
+from nlip_sdk.nlip import NLIP_Factory
+
+from ..nlip_async_client import NlipAsyncClient
+from ..retry import RetryPolicy, ResilientNlipClient
+from .standin_server import StandInNlipServer, ThrottledLink, timed
+
+
+class StandInFlakyServer(StandInNlipServer):
+    """A stand-in agent that fails or stalls some of the time"""
+
+    def __init__(self, shared: dict, error_rate: float = 0.08, stall_rate: float = 0.05,
+                 stall: float = 1.5, work: float = 0.05, **kwargs):
+        super().__init__(**kwargs)
+        self.shared = shared
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.work = work
+
+    async def respond(self, request: httpx.Request, body: bytes) -> httpx.Response:
+        roll = random.random()
+        if roll < self.error_rate:
+            return httpx.Response(503)
+
+        # queueing delay, sometimes a long one
+        await asyncio.sleep(self.stall if roll < self.error_rate + self.stall_rate else 0)
+
+        key = request.headers.get("idempotency-key")
+        deliveries = self.shared.setdefault("deliveries", {})
+        deliveries[key] = deliveries.get(key, 0) + 1
+
+        replies = self.shared.setdefault("replies", {})
+        if key not in replies:
+            replies[key] = asyncio.ensure_future(self._execute(request, body, key))
+        return await asyncio.shield(replies[key])
+
+    async def _execute(self, request: httpx.Request, body: bytes, key: str) -> httpx.Response:
+        executions = self.shared.setdefault("executions", {})
+        executions[key] = executions.get(key, 0) + 1
+        await asyncio.sleep(self.work)
+        return await super().respond(request, body)
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+async def run_case(label, make_client, count):
+    shared = {}
+    client = make_client(shared)
+    msg = NLIP_Factory.create_text("forecast for Juneau")
+
+    latencies = []
+    errors = 0
+    for i in range(count):
+        try:
+            (reply, elapsed) = await timed(client.async_send(msg))
+            latencies.append(elapsed)
+        except Exception:
+            errors += 1
+
+    repeated = sum(n - 1 for n in shared.get("deliveries", {}).values())
+    duplicates = sum(n - 1 for n in shared.get("executions", {}).values())
+    print(f"{label:<16} errors:{errors:>4}  p50:{percentile(latencies, 50) * 1000:7.1f}ms  "
+          f"p95:{percentile(latencies, 95) * 1000:7.1f}ms  p99:{percentile(latencies, 99) * 1000:7.1f}ms  "
+          f"repeated keys:{repeated:>3}  duplicate executions:{duplicates}")
+
+
+async def main(args):
+    random.seed(args.seed)
+    link = ThrottledLink(latency=0.02, bandwidth=None)
+
+    def server(shared):
+        return StandInFlakyServer(shared, link=link)
+
+    def plain(shared):
+        client = NlipAsyncClient.create_from_url("http://primary/nlip/", transport=server(shared))
+        # give the plain client a key too, so executions can be counted
+        return ResilientNlipClient(client, RetryPolicy(max_attempts=1))
+
+    def retrying(shared):
+        client = NlipAsyncClient.create_from_url("http://primary/nlip/", transport=server(shared))
+        return ResilientNlipClient(client, RetryPolicy(max_attempts=4, backoff_base=0.05))
+
+    def hedged(shared):
+        client = NlipAsyncClient.create_from_url("http://primary/nlip/", transport=server(shared))
+        backup = NlipAsyncClient.create_from_url("http://backup/nlip/", transport=server(shared))
+        return ResilientNlipClient(client, RetryPolicy(max_attempts=4, backoff_base=0.05, hedge_min_samples=10), backup=backup)
+
+    print(f"{args.n} sends per case")
+    await run_case("plain", plain, args.n)
+    await run_case("retry", retrying, args.n)
+    await run_case("retry+hedge", hedged, args.n)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="bench_retry")
+    parser.add_argument("-n", type=int, default=200, help="Sends per case")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,63 @@
+#
+# Indexing and query time of the conversation search backends over a large
+# synthetic history.
+#
+#    $ python -m mach2.benchmarks.bench_search [-n 50000] [--seed 1]
+#
+
+import time
+import random
+import argparse
+from statistics import median
+
+from ..models import Message
+from ..search import Fts5SearchIndex, InvertedSearchIndex, has_fts5
+
+WORDS = ("forecast temperature wind rain juneau madrid person place agent tool call result image "
+         "summary weather cloudy sunny inches precipitation tonight tuesday domain object json "
+         "server client request response error retry cache token search index history").split()
+
+QUERIES = ["forecast", "rain juneau", "precip", "weather tuesday cloudy", "json obj", "zebra"]
+
+
+def make_messages(count):
+    messages = []
+    for i in range(count):
+        words = [ random.choice(WORDS) for j in range(random.randint(5, 80)) ]
+        words.append(f"ticket{i}")
+        messages.append(Message(id=f"msg_{i}", content=" ".join(words), formatted=None, message_type="text"))
+    return messages
+
+
+def run_case(index, messages, repeat=20):
+    start = time.perf_counter()
+    for message in messages:
+        index.add(message)
+    indexing = time.perf_counter() - start
+
+    print(f"{index.name:<9} indexing:{indexing * 1000:8.1f}ms ({indexing / len(messages) * 1e6:.1f}us/message)")
+    for query in QUERIES:
+        times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            results = index.search(query)
+            times.append(time.perf_counter() - start)
+        print(f"    {query!r:<26} {len(results):>4} results  median:{median(times) * 1000:7.2f}ms  max:{max(times) * 1000:7.2f}ms")
+
+
+def main(args):
+    random.seed(args.seed)
+    messages = make_messages(args.n)
+    print(f"{args.n} messages")
+    if has_fts5():
+        run_case(Fts5SearchIndex(), messages)
+    else:
+        print("fts5      not available in this sqlite3")
+    run_case(InvertedSearchIndex(), messages)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="bench_search")
+    parser.add_argument("-n", type=int, default=50000, help="Messages in the history")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    main(parser.parse_args())
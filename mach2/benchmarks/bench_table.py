@@ -0,0 +1,80 @@
+#
+# A response with one large Markdown table, shown as one markup Label (the
+# BBCode renderer's monospace table) and as the block renderer's virtualized
+# TableBlock: time to parse, to show the first screen, and to scroll to the
+# middle, and how many row widgets exist.
+#
+#    $ python -m mach2.benchmarks.bench_table [--rows 1000]
+#
+# Without a display, run it with
+#    KIVY_GL_BACKEND=mock KIVY_METRICS_DENSITY=1 KIVY_TEXT=pil
+#
+
+import os
+import time
+import argparse
+
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+os.environ.setdefault("KIVY_NO_CONSOLELOG", "1")
+
+from kivy.clock import Clock
+from kivy.uix.label import Label
+from kivy.uix.recycleview import RecycleView
+
+from ..renderers.kivy_mistune_bbcode import MarkdownToBBCodeParser
+from ..renderers.kivy_blocks import MarkdownToBlocks
+from ..widgets.rich_text_view import TableBlock
+
+
+def make_response(rows: int) -> str:
+    body = "\n".join(f"| {i} | host-{i:05d}.example.com | {i * 3.7:.1f} | `up[{i % 3}]` |" for i in range(rows))
+    return f"Here are the hosts:\n\n| # | host | load | state |\n|--:|:--|--:|:-:|\n{body}\n"
+
+
+def settle():
+    for i in range(3):
+        Clock.tick()
+        Clock.tick_draw()
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return ((time.perf_counter() - start) * 1000, result)
+
+
+def main(args):
+    content = make_response(args.rows)
+    print(f"{args.rows} rows, {len(content)} characters")
+
+    parser = MarkdownToBBCodeParser()
+    parser.renderer.table_max_rows = args.rows # the whole table, for comparison
+    (parse_ms, markup) = timed(lambda: parser.parse(content))
+    label = Label(text=markup, markup=True)
+    def show_label():
+        label.text_size = (None, None)
+        label.texture_update()
+        settle() # and the refresh it scheduled
+    (show_ms, _) = timed(show_label)
+    print(f"label    parse:{parse_ms:8.1f}ms  first screen:{show_ms:8.1f}ms  texture:{label.texture_size}")
+
+    (parse_ms, blocks) = timed(lambda: MarkdownToBlocks().parse(content))
+    table = next(block for block in blocks if block.kind == "table")
+    def show_table():
+        widget = TableBlock(table, width=800)
+        settle()
+        return widget
+    (show_ms, widget) = timed(show_table)
+    rows = next(child for child in widget.children[0].children if isinstance(child, RecycleView))
+    def scroll():
+        rows.scroll_y = 0.5
+        settle()
+    (scroll_ms, _) = timed(scroll)
+    print(f"table    parse:{parse_ms:8.1f}ms  first screen:{show_ms:8.1f}ms  scroll:{scroll_ms:6.1f}ms  "
+          f"row widgets:{len(rows.children[0].children)}  column widths:{[round(w) for w in widget.widths]}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="bench_table")
+    parser.add_argument("--rows", type=int, default=1000, help="Rows in the table")
+    main(parser.parse_args())
@@ -0,0 +1,132 @@
+#
+# A local stand-in for an NLIP agent server, used by the benchmarks.
+#
+# The stand-in is an httpx transport, so a client built with
+# transport=StandInNlipServer(...) talks to it without opening sockets.  Every
+# request and response passes through a ThrottledLink that charges latency and
+# bandwidth for the bytes that would have been on the wire, and counts them.
+#
+# By default the server echoes the text of the request and attaches an image.
+# Subclasses override respond() to model other agent behavior.
+#
+
+import asyncio
+import time
+from dataclasses import dataclass, field
+from base64 import b64encode
+from typing import Optional
+
+import httpx
+from nlip_sdk.nlip import NLIP_Factory, NLIP_Message
+
+from ..compression import available_encodings, compress, decompress
+
+
+@dataclass
+class LinkStats:
+    requests: int = 0
+    bytes_up: int = 0
+    bytes_down: int = 0
+
+
+class ThrottledLink:
+    """
+    Model a network link with a fixed round trip latency and bandwidth.
+
+    Args:
+        latency: round trip time in seconds, charged half in each direction
+        bandwidth: link speed in bytes per second, or None for unlimited
+    """
+
+    def __init__(self, latency: float = 0.05, bandwidth: Optional[float] = 1_000_000 / 8):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.stats = LinkStats()
+
+    async def transfer(self, nbytes: int, upstream: bool):
+        if upstream:
+            self.stats.bytes_up += nbytes
+        else:
+            self.stats.bytes_down += nbytes
+
+        delay = self.latency / 2
+        if self.bandwidth:
+            delay += nbytes / self.bandwidth
+        await asyncio.sleep(delay)
+
+    def reset(self):
+        self.stats = LinkStats()
+
+
+def _header_size(headers) -> int:
+    return sum(len(k) + len(v) + 4 for k, v in headers.raw)
+
+
+class StandInNlipServer(httpx.AsyncBaseTransport):
+    """
+    An in-process NLIP server reached through a ThrottledLink.
+
+    Args:
+        link: the simulated network link
+        image_path: an image attached to every reply, or None for text-only replies
+        compress_responses: honor Accept-Encoding when replying
+    """
+
+    def __init__(self, link: ThrottledLink = None, image_path: Optional[str] = None, compress_responses: bool = True):
+        self.link = link or ThrottledLink()
+        self.compress_responses = compress_responses
+        self.image_b64 = None
+        if image_path:
+            with open(image_path, "rb") as f:
+                self.image_b64 = b64encode(f.read()).decode("utf-8")
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.link.stats.requests += 1
+        body = await request.aread()
+        await self.link.transfer(len(body) + _header_size(request.headers), upstream=True)
+
+        response = await self.respond(request, body)
+
+        # charge for the encoded response body as the client would receive it
+        wire_body = response.content
+        encoding = self._choose_encoding(request)
+        headers = dict(response.headers)
+        if encoding and wire_body:
+            wire_body = compress(wire_body, encoding)
+            headers["content-encoding"] = encoding
+        headers["content-length"] = str(len(wire_body))
+        await self.link.transfer(len(wire_body) + sum(len(k) + len(v) + 4 for k, v in headers.items()), upstream=False)
+
+        return httpx.Response(response.status_code, headers=headers, content=wire_body, request=request)
+
+    async def respond(self, request: httpx.Request, body: bytes) -> httpx.Response:
+        """Produce an uncompressed response.  Override to model other servers."""
+        if request.method != "POST":
+            return httpx.Response(204)
+
+        payload = decompress(body, request.headers.get("content-encoding"))
+        msg = NLIP_Message.model_validate_json(payload)
+        reply = self.reply_to(msg)
+        return httpx.Response(200, headers={"content-type": "application/json"}, content=reply.to_json().encode("utf-8"))
+
+    def reply_to(self, msg: NLIP_Message) -> NLIP_Message:
+        reply = NLIP_Factory.create_text(f"You said: {msg.content}")
+        if self.image_b64:
+            reply.add_binary(self.image_b64, "image", "png", label="standin.png")
+        return reply
+
+    def _choose_encoding(self, request: httpx.Request) -> Optional[str]:
+        if not self.compress_responses:
+            return None
+        accepted = [e.split(";")[0].strip() for e in request.headers.get("accept-encoding", "").split(",")]
+        for encoding in accepted:
+            if encoding in available_encodings():
+                return encoding
+        return None
+
+
+async def timed(coro):
+    """Await coro and return (result, elapsed seconds)"""
+    start = time.perf_counter()
+    result = await coro
+    return (result, time.perf_counter() - start)
@@ -0,0 +1,166 @@
+#
+# Opt-in compression for NLIP traffic.
+#
+# NLIP payloads are JSON and frequently carry base64 images, so both directions
+# compress well.  Request bodies may be compressed with gzip (always available),
+# br (needs "brotli") or zstd (needs "zstandard").  The Accept-Encoding header
+# advertises the response encodings that httpx is able to decode here.
+#
+# Settings are chosen per endpoint, so a slow remote agent can use a high
+# compression level while a local one sends plain JSON.
+#
+
+import gzip
+import json
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+DEFAULT_LEVELS = {
+    "gzip": 6,
+    "br": 5,
+    "zstd": 3,
+}
+
+
+def available_encodings() -> List[str]:
+    """Content codings that can be produced and decoded in this environment"""
+    encodings = []
+    if zstandard is not None:
+        encodings.append("zstd")
+    if brotli is not None:
+        encodings.append("br")
+    encodings.append("gzip")
+    return encodings
+
+
+def compress(data: bytes, encoding: str, level: Optional[int] = None) -> bytes:
+    """Compress data with the named content coding"""
+    if level is None:
+        level = DEFAULT_LEVELS.get(encoding)
+
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=level)
+    elif encoding == "br":
+        if brotli is None:
+            raise ValueError("br compression requires the brotli package")
+        return brotli.compress(data, quality=level)
+    elif encoding == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    else:
+        raise ValueError(f"Unsupported content encoding:{encoding}")
+
+
+def decompress(data: bytes, encoding: Optional[str]) -> bytes:
+    """Reverse compress().  An empty or identity encoding returns data unchanged."""
+    if not encoding or encoding == "identity":
+        return data
+    elif encoding == "gzip":
+        return gzip.decompress(data)
+    elif encoding == "br" and brotli is not None:
+        return brotli.decompress(data)
+    elif encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    else:
+        raise ValueError(f"Unsupported content encoding:{encoding}")
+
+
+@dataclass
+class CompressionSettings:
+    """
+    Compression settings for one endpoint.
+
+    Args:
+        encoding: request body coding ("gzip", "br", "zstd") or None to send plain JSON
+        level: compression level, None for the coding's default
+        accept_encoding: value of the Accept-Encoding header.  None advertises
+            every coding available here, "identity" asks for uncompressed responses.
+        min_size: bodies smaller than this are sent uncompressed
+    """
+    encoding: Optional[str] = None
+    level: Optional[int] = None
+    accept_encoding: Optional[str] = None
+    min_size: int = 1024
+
+    @classmethod
+    def parse(cls, spec: str) -> "CompressionSettings":
+        """Parse a spec like "gzip", "zstd:9" or "none" """
+        name, _, level = spec.strip().partition(":")
+        name = name.lower()
+        if name in ("", "none", "identity"):
+            return cls()
+        if name not in DEFAULT_LEVELS:
+            raise ValueError(f"Unsupported content encoding:{name}")
+        return cls(encoding=name, level=int(level) if level else None)
+
+    def request_headers(self) -> Dict[str, str]:
+        accept = self.accept_encoding
+        if accept is None:
+            accept = ", ".join(available_encodings())
+        return { "Accept-Encoding": accept }
+
+    def encode_body(self, body: bytes) -> Tuple[bytes, Dict[str, str]]:
+        """Return the (possibly compressed) body and the headers to send with it"""
+        headers = { "Content-Type": "application/json" }
+        headers.update(self.request_headers())
+        if self.encoding and len(body) >= self.min_size:
+            body = compress(body, self.encoding, self.level)
+            headers["Content-Encoding"] = self.encoding
+        return (body, headers)
+
+
+class EndpointCompression:
+    """
+    Select CompressionSettings per endpoint.
+
+    Endpoints are matched by full URL prefix first, then by origin
+    (scheme://host:port).  Anything else gets the default.
+    """
+
+    def __init__(self, default: CompressionSettings = None, endpoints: Dict[str, CompressionSettings] = None):
+        self.default = default or CompressionSettings()
+        self.endpoints = dict(endpoints or {})
+
+    def set_endpoint(self, url: str, settings: CompressionSettings):
+        self.endpoints[url] = settings
+
+    def settings_for(self, url: str) -> CompressionSettings:
+        for prefix in sorted(self.endpoints, key=len, reverse=True):
+            if url.startswith(prefix):
+                return self.endpoints[prefix]
+
+        parsed = urlparse(url)
+        origin = f"{parsed.scheme}://{parsed.netloc}"
+        if origin in self.endpoints:
+            return self.endpoints[origin]
+
+        return self.default
+
+    @classmethod
+    def load(cls, path: str, default: CompressionSettings = None) -> "EndpointCompression":
+        """
+        Load endpoint settings from a JSON file of the form
+
+            { "http://agent.example.com:8000": {"encoding": "zstd", "level": 9} }
+        """
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+
+        endpoints = { url: CompressionSettings(**values) for url, values in config.items() }
+        return cls(default=default, endpoints=endpoints)
@@ -0,0 +1,233 @@
+#
+# Per-origin credential cache.
+#
+# Once a user has answered a login or bearer popup for a server, the credentials
+# are kept by origin (scheme://host:port).  A client created for a known origin
+# sends its Authorization header with the first request instead of waiting for a
+# 401, and reuses the same httpx.DigestAuth object so the Digest nonce state from
+# earlier exchanges is kept across reconnects.
+#
+# Credentials live in memory.  They can optionally be persisted in the OS keyring
+# (needs "keyring") or in an encrypted file (needs "cryptography").
+#
+
+import os
+import json
+import base64
+import hashlib
+from dataclasses import dataclass, asdict
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+import httpx
+
+try:
+    import keyring
+except ImportError:
+    keyring = None
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = None
+
+
+@dataclass
+class Credentials:
+    """Credentials for one origin.  scheme is "basic", "digest" or "bearer"."""
+    scheme: str
+    username: str = ""
+    password: str = ""
+    bearer: str = ""
+
+    def __str__(self):
+        return f"Credentials(scheme='{self.scheme}', username='{self.username}', secret='***')"
+
+
+def origin_of(url: str) -> str:
+    """Return scheme://host:port for a URL"""
+    parsed = urlparse(url)
+    return f"{parsed.scheme}://{parsed.netloc}"
+
+
+class KeyringCredentialStore:
+    """Persist credentials in the operating system keyring"""
+
+    SERVICE = "mach2"
+
+    def __init__(self):
+        if keyring is None:
+            raise RuntimeError("KeyringCredentialStore requires the keyring package")
+
+    def load(self, origin: str) -> Optional[Credentials]:
+        value = keyring.get_password(self.SERVICE, origin)
+        if value is None:
+            return None
+        return Credentials(**json.loads(value))
+
+    def save(self, origin: str, credentials: Credentials):
+        keyring.set_password(self.SERVICE, origin, json.dumps(asdict(credentials)))
+
+    def delete(self, origin: str):
+        try:
+            keyring.delete_password(self.SERVICE, origin)
+        except keyring.errors.PasswordDeleteError:
+            pass
+
+
+class EncryptedFileCredentialStore:
+    """
+    Persist credentials in a file encrypted with a key derived from a passphrase.
+
+    The file holds a random salt followed by a Fernet token of the JSON mapping
+    origin -> credentials.
+    """
+
+    SALT_SIZE = 16
+    ITERATIONS = 200_000
+
+    def __init__(self, path: str, passphrase: str):
+        if Fernet is None:
+            raise RuntimeError("EncryptedFileCredentialStore requires the cryptography package")
+        self.path = path
+        self.passphrase = passphrase.encode("utf-8")
+
+    def _fernet(self, salt: bytes):
+        key = hashlib.pbkdf2_hmac("sha256", self.passphrase, salt, self.ITERATIONS)
+        return Fernet(base64.urlsafe_b64encode(key))
+
+    def _read_all(self) -> Dict[str, dict]:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "rb") as f:
+            data = f.read()
+        salt, token = data[:self.SALT_SIZE], data[self.SALT_SIZE:]
+        try:
+            return json.loads(self._fernet(salt).decrypt(token))
+        except InvalidToken:
+            print(f"CREDENTIAL FILE COULD NOT BE DECRYPTED:{self.path}")
+            return {}
+
+    def _write_all(self, entries: Dict[str, dict]):
+        salt = os.urandom(self.SALT_SIZE)
+        token = self._fernet(salt).encrypt(json.dumps(entries).encode("utf-8"))
+        tmp_path = self.path + ".tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(salt + token)
+        os.replace(tmp_path, self.path)
+
+    def load(self, origin: str) -> Optional[Credentials]:
+        entry = self._read_all().get(origin)
+        return Credentials(**entry) if entry else None
+
+    def save(self, origin: str, credentials: Credentials):
+        entries = self._read_all()
+        entries[origin] = asdict(credentials)
+        self._write_all(entries)
+
+    def delete(self, origin: str):
+        entries = self._read_all()
+        if entries.pop(origin, None) is not None:
+            self._write_all(entries)
+
+
+class CredentialCache:
+    """
+    In-memory credentials by origin, backed by an optional persistent store.
+
+    The cache also keeps the httpx.Auth object built for each origin, so a
+    DigestAuth carries its last challenge (nonce, opaque, nonce count) to the
+    next client created for the same server.
+    """
+
+    def __init__(self, store = None):
+        self.store = store
+        self._credentials: Dict[str, Credentials] = {}
+        self._auth: Dict[str, httpx.Auth] = {}
+
+    def get(self, origin: str) -> Optional[Credentials]:
+        credentials = self._credentials.get(origin)
+        if credentials is None and self.store is not None:
+            credentials = self.store.load(origin)
+            if credentials is not None:
+                self._credentials[origin] = credentials
+        return credentials
+
+    def put(self, origin: str, credentials: Credentials):
+        self._credentials[origin] = credentials
+        self._auth.pop(origin, None)
+        if self.store is not None:
+            self.store.save(origin, credentials)
+
+    def forget(self, origin: str):
+        self._credentials.pop(origin, None)
+        self._auth.pop(origin, None)
+        if self.store is not None:
+            self.store.delete(origin)
+
+    def auth_for(self, origin: str) -> Optional[httpx.Auth]:
+        """Return the (shared) httpx.Auth for a Basic or Digest origin, else None"""
+        auth = self._auth.get(origin)
+        if auth is not None:
+            return auth
+
+        credentials = self.get(origin)
+        if credentials is None:
+            return None
+        if credentials.scheme == "basic":
+            auth = httpx.BasicAuth(username=credentials.username, password=credentials.password)
+        elif credentials.scheme == "digest":
+            auth = httpx.DigestAuth(username=credentials.username, password=credentials.password)
+        else:
+            return None
+
+        self._auth[origin] = auth
+        return auth
+
+    def headers_for(self, origin: str) -> Dict[str, str]:
+        """Return preemptive headers for a Bearer origin"""
+        credentials = self.get(origin)
+        if credentials is not None and credentials.scheme == "bearer":
+            return { "Authorization" : f"Bearer {credentials.bearer}" }
+        return {}
+
+
+def seed_digest_challenge(auth: httpx.DigestAuth, request: httpx.Request, response: httpx.Response) -> bool:
+    """
+    Give a DigestAuth the challenge from a 401 we already received, so its first
+    request carries the Authorization header instead of provoking another 401.
+    Relies on httpx internals; returns False if they are not available.
+    """
+    header = response.headers.get("www-authenticate", "")
+    if not header.lower().startswith("digest "):
+        return False
+    try:
+        auth._last_challenge = auth._parse_challenge(request, response, header)
+        auth._nonce_count = 1
+        return True
+    except (AttributeError, httpx.ProtocolError):
+        return False
+
+
+DEFAULT_CREDENTIAL_FILE = os.path.join(os.path.expanduser("~"), ".mach2", "credentials.bin")
+
+def create_credential_cache(store: str = "memory", path: str = None) -> CredentialCache:
+    """
+    Create a CredentialCache with the named persistent store: "memory" (none),
+    "keyring", or "file".  The file store reads its passphrase from the
+    MACH2_CREDENTIAL_PASSPHRASE environment variable.
+    """
+    if store == "memory":
+        return CredentialCache()
+    elif store == "keyring":
+        return CredentialCache(store=KeyringCredentialStore())
+    elif store == "file":
+        passphrase = os.environ.get("MACH2_CREDENTIAL_PASSPHRASE")
+        if not passphrase:
+            raise RuntimeError("MACH2_CREDENTIAL_PASSPHRASE must be set to use the encrypted credential file")
+        path = path or DEFAULT_CREDENTIAL_FILE
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return CredentialCache(store=EncryptedFileCredentialStore(path, passphrase))
+    else:
+        raise ValueError(f"Unknown credential store:{store}")
@@ -0,0 +1,124 @@
+#
+# A lower frame rate while nothing is happening.
+#
+# Kivy runs its clock at maxfps (60) for as long as the app is open, even when
+# the window has not changed for hours.  The IdleGovernor drops the clock to
+# idle_fps once there has been no input, animation, scrolling or network
+# activity for idle_after seconds, and to suspended_fps while the window is
+# minimized.  The first input is then seen within a frame of the idle rate,
+# after which the app is back at the full rate.
+#
+# With the "interrupt" clock (KIVY_CLOCK=interrupt, set in __main__.py) a
+# callback scheduled for the next frame, for example by a worker thread or a
+# finished network request, wakes the clock at once rather than at the next
+# idle frame.
+#
+# Activity is reported with poke(), or with busy() around work that takes a
+# while, such as a request in flight.  Listeners of suspend/resume are told
+# when the window is minimized and restored, so they can hold back rendering.
+#
+
+import time
+from contextlib import contextmanager
+from typing import Callable, List
+
+from kivy.clock import Clock
+from kivy.animation import Animation
+
+from .metrics import metrics
+
+
+class IdleGovernor:
+    """
+    Lower the clock's frame rate when the app is idle or minimized.
+
+    Args:
+        idle_fps: frame rate after idle_after seconds without activity (0: never idle)
+        idle_after: seconds without activity before the frame rate drops
+        suspended_fps: frame rate while the window is minimized
+    """
+
+    def __init__(self, idle_fps: float = 10, idle_after: float = 2.0, suspended_fps: float = 1):
+        self.active_fps = Clock._max_fps
+        self.idle_fps = idle_fps
+        self.idle_after = idle_after
+        self.suspended_fps = suspended_fps
+        self.idle = False
+        self.suspended = False
+        self._busy = 0
+        self._last_activity = time.monotonic()
+        self._suspend_listeners: List[Callable[[bool], None]] = []
+        if idle_fps > 0:
+            Clock.schedule_interval(self._check, min(0.5, idle_after / 2))
+        if hasattr(Clock, "interupt_next_only"):
+            # Only callbacks for the next frame wake the clock.  Otherwise it
+            # stops sleeping whenever a timer is due within about half a frame,
+            # which at a low frame rate is most of the time.
+            Clock.interupt_next_only = True
+
+    def watch(self, window):
+        """Treat input to the window as activity, and minimizing it as a suspension"""
+        window.bind(on_touch_down=self.poke, on_touch_move=self.poke, on_touch_up=self.poke,
+                    on_key_down=self.poke, on_mouse_pos=self.poke, on_resize=self.poke,
+                    on_minimize=lambda *args: self.suspend(), on_hide=lambda *args: self.suspend(),
+                    on_restore=lambda *args: self.resume(), on_show=lambda *args: self.resume())
+
+    def add_suspend_listener(self, callback: Callable[[bool], None]):
+        """callback(True) when the window is minimized, callback(False) when it is restored"""
+        self._suspend_listeners.append(callback)
+
+    def poke(self, *args):
+        """Something happened: run at the full frame rate for a while"""
+        self._last_activity = time.monotonic()
+        if self.idle:
+            self.idle = False
+            metrics.incr("idle.wake")
+            self._apply()
+
+    @contextmanager
+    def busy(self):
+        """Stay at the full frame rate while the block runs"""
+        self._busy += 1
+        self.poke()
+        try:
+            yield
+        finally:
+            self._busy -= 1
+            self.poke()
+
+    def suspend(self):
+        if not self.suspended:
+            self.suspended = True
+            self._apply()
+            for callback in self._suspend_listeners:
+                callback(True)
+
+    def resume(self):
+        if self.suspended:
+            self.suspended = False
+            self.poke()
+            self._apply()
+            for callback in self._suspend_listeners:
+                callback(False)
+
+    def _active(self) -> bool:
+        return self._busy > 0 or bool(Animation._instances) \
+            or time.monotonic() - self._last_activity < self.idle_after
+
+    def _check(self, dt):
+        if self.suspended:
+            return
+        if self.idle and Animation._instances: # started without input, e.g. a thumbnail fading in
+            self.poke()
+        elif not self.idle and not self._active():
+            self.idle = True
+            metrics.incr("idle.enter")
+            self._apply()
+
+    def _apply(self):
+        if self.suspended:
+            Clock._max_fps = self.suspended_fps
+        elif self.idle:
+            Clock._max_fps = self.idle_fps
+        else:
+            Clock._max_fps = self.active_fps
@@ -0,0 +1,144 @@
+#
+# Background listing of image folders and a small index of recent choices.
+#
+# The image chooser must not list or stat a large directory on the UI thread.
+# scan_directory() runs in a worker thread and hands entries over in batches, so
+# the chooser fills in while the scan is still going.  It relies on the file
+# type that os.scandir already knows and never stats a file.
+#
+# RecentImageIndex remembers recently used folders and files, and the last
+# listing of recently visited folders, in ~/.mach2/recent-images.json.  When the
+# chooser reopens it shows the remembered listing at once and refreshes it in
+# the background.
+#
+
+import os
+import json
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+
+DEFAULT_INDEX_PATH = os.path.join(os.path.expanduser("~"), ".mach2", "recent-images.json")
+
+# (name, is_dir)
+Entry = Tuple[str, bool]
+
+
+def is_image(name: str) -> bool:
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def sort_entries(entries: List[Entry]) -> List[Entry]:
+    """Folders first, then images, each by name"""
+    return sorted(entries, key=lambda e: (not e[1], e[0].lower()))
+
+
+def scan_directory(folder: str, on_batch: Callable[[List[Entry]], None],
+                   cancelled: Callable[[], bool] = lambda: False, batch_size: int = 64) -> Optional[List[Entry]]:
+    """
+    List the subfolders and images of a folder, calling on_batch with each group
+    of batch_size entries.  Hidden entries are skipped.  Returns the complete
+    sorted listing, or None if cancelled or the folder cannot be read.
+    """
+    entries = []
+    batch = []
+    try:
+        with os.scandir(folder) as it:
+            for entry in it:
+                if cancelled():
+                    return None
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    continue
+                if is_dir or is_image(entry.name):
+                    batch.append((entry.name, is_dir))
+                    if len(batch) >= batch_size:
+                        on_batch(batch)
+                        entries.extend(batch)
+                        batch = []
+    except OSError as e:
+        print(f"IMAGE SCAN FAILED:{folder}:{e}")
+        return None
+
+    if batch:
+        on_batch(batch)
+        entries.extend(batch)
+    return sort_entries(entries)
+
+
+class RecentImageIndex:
+    """
+    Recently used image folders and files, plus remembered folder listings.
+
+    Args:
+        path: the JSON file, or None to keep the index in memory only
+        max_folders: recent folders (and remembered listings) kept
+        max_files: recent files kept
+        max_listing: entries remembered per folder
+    """
+
+    def __init__(self, path: Optional[str] = DEFAULT_INDEX_PATH, max_folders: int = 10,
+                 max_files: int = 50, max_listing: int = 2000):
+        self.path = path
+        self.max_folders = max_folders
+        self.max_files = max_files
+        self.max_listing = max_listing
+        self.folders: List[str] = []
+        self.files: List[str] = []
+        self._listings: "OrderedDict[str, List[Entry]]" = OrderedDict()
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.folders = list(data.get("folders", []))
+            self.files = list(data.get("files", []))
+            for (folder, entries) in data.get("listings", {}).items():
+                self._listings[folder] = [ (name, bool(is_dir)) for (name, is_dir) in entries ]
+        except (OSError, ValueError, TypeError) as e:
+            print(f"RECENT IMAGES: ignoring unreadable index {self.path}:{e}")
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        data = {
+            "folders": self.folders,
+            "files": self.files,
+            "listings": { folder: entries for (folder, entries) in self._listings.items() },
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def listing(self, folder: str) -> Optional[List[Entry]]:
+        """The remembered listing of a folder, if any"""
+        return self._listings.get(folder)
+
+    def remember_listing(self, folder: str, entries: List[Entry]):
+        self._listings[folder] = entries[:self.max_listing]
+        self._listings.move_to_end(folder)
+        while len(self._listings) > self.max_folders:
+            self._listings.popitem(last=False)
+
+    def record_selection(self, paths: List[str]):
+        """Move chosen files, and their folders, to the front of the recent lists"""
+        for path in reversed(paths):
+            self.files = [path] + [ p for p in self.files if p != path ]
+            folder = os.path.dirname(path)
+            self.folders = [folder] + [ f for f in self.folders if f != folder ]
+        self.files = self.files[:self.max_files]
+        self.folders = self.folders[:self.max_folders]
+
+    def recent_files(self) -> List[str]:
+        """Recent files that still exist"""
+        return [ path for path in self.files if os.path.exists(path) ]
@@ -13,41 +13,142 @@ from kivy.uix.textinput import TextInput
 from kivy.uix.button import Button
 from kivy.uix.label import Label
 from kivy.uix.image import Image
+from kivy.uix.relativelayout import RelativeLayout
 from kivy.clock import Clock
+from kivy.animation import Animation
 from kivy.graphics import Color, RoundedRectangle
 from kivy.core.clipboard import Clipboard
 from kivy.uix.widget import Widget
-from kivy.uix.filechooser import FileChooserIconView
-from kivy.uix.popup import Popup
-from kivy.properties import StringProperty, BooleanProperty, ObjectProperty
+from kivy.properties import StringProperty, BooleanProperty, ObjectProperty, NumericProperty
 from kivy.metrics import sp
 import os
 import asyncio
 import webbrowser
+from collections import deque
+from typing import Callable, List
 
 # local
 from . import utils
 from .models import Message, Roles
 from .widgets.text_input_with_shift_return import TextInputWithShiftReturn
 from .services import MockChatBotService, NlipChatBotService, MessageService
+from .thumbnails import get_thumbnail_service, viewport_priority, ensure_image_later
+from .text_measure import get_measure_service
+from .idle import IdleGovernor
+from .stall_profiler import StallProfiler, working_on
+from .widgets.image_viewer_popup import ImageViewerPopup
+from .widgets.image_chooser_popup import ImageChooserPopup
+from .widgets.archive_popup import ArchivePopup
+from .widgets.login_popup import LoginPopup, LoginCredentials
+from .widgets.bearer_popup import BearerPopup, BearerCredentials
+from .widgets.rich_text_view import RichTextView
+from .widgets.lean_bubble import LeanBubble, text_width, bubble_height
+from .compression import CompressionSettings, EndpointCompression
+from .credentials import create_credential_cache
+from .retry import RetryPolicy
+from .response_cache import ResponseCache
+from .archive import export_archive, import_archive, add_extract_observer
+from .search import create_search_index
+from .message_store import BUBBLE_OVERHEAD, LEAN_BUBBLE_OVERHEAD, process_rss
+from .processors.render_pool import RenderPool
 
 # UI Components
+class BubbleImage(RelativeLayout):
+    """UI Component: One image of an image message, shown as a thumbnail"""
+    image_source = StringProperty("") # full image file, only used without thumbnails
+    image_texture = ObjectProperty(None, allownone=True) # thumbnail
+    image_loading = BooleanProperty(False) # placeholder shown while decoding
+
+    def __init__(self, image_path: str, visibility: Callable = None, **kwargs):
+        self.image_path = image_path
+        self.visibility = visibility
+        self._thumbnail_key = None
+        self._released = False
+        super().__init__(**kwargs)
+        self._load_thumbnail()
+
+    def _load_thumbnail(self):
+        """
+        Show a placeholder while a downsampled thumbnail is decoded off the main
+        thread.  Without Pillow, the AsyncImage loads the full image instead.
+        """
+        self.image_loading = True
+        if not get_thumbnail_service().request(self.image_path, self._on_thumbnail, self.visibility):
+            self._load_full()
+
+    def _load_full(self):
+        """Load the full image, once an image of an imported archive is written out"""
+        def loadable(path):
+            if not self._released:
+                self.image_source = path
+        ensure_image_later(self.image_path, loadable)
+
+    def _on_thumbnail(self, key, texture):
+        if key is None:
+            self._load_full()
+            return
+        if self._released: # removed while decoding
+            get_thumbnail_service().release(key)
+            return
+        self._thumbnail_key = key
+        self.image_texture = texture
+        self.on_image_loaded(self.ids.image)
+
+    def on_image_loaded(self, image):
+        """Fade the image in over the placeholder"""
+        self.image_loading = False
+        Animation(opacity=1, d=0.25, t='out_quad').start(image)
+
+    def release(self):
+        """Stop waiting for, or showing, the thumbnail"""
+        self._released = True
+        get_thumbnail_service().cancel(self._on_thumbnail)
+        if self._thumbnail_key is not None:
+            get_thumbnail_service().release(self._thumbnail_key)
+            self._thumbnail_key = None
+            self.image_texture = None
+
+    def on_touch_down(self, touch):
+        """Open the full resolution image"""
+        if self.collide_point(*touch.pos):
+            ImageViewerPopup(self.image_path).open()
+            return True
+        return super().on_touch_down(touch)
+
+
+class MessageLabel(Label):
+    """UI Component: The text of a MessageBubble"""
+    message_id = StringProperty("")
+
+    def texture_update(self, *largs):
+        # runs on the frame after the text changes, outside the bubble's
+        # construction, so mark it (and the texture_size bindings it fires)
+        with working_on(self.message_id):
+            super().texture_update(*largs)
+
+
 class MessageBubble(BoxLayout):
     """UI Component: Visual representation of a message"""
     message_text = StringProperty("")
     message_formatted = StringProperty(None) # default value
+    message_blocks = ObjectProperty(None, allownone=True) # shown by the RichTextView instead of the label
     message_type = StringProperty("text")
-    image_source = StringProperty("")
+    image_columns = NumericProperty(1)
     role = StringProperty(Roles.USER)
+    cached = BooleanProperty(False)
     
     def __init__(self, message: Message, **kwargs):
         self.message_text = message.content
+        self.cached = message.cached
+        self.message_id = message.id
         if message.formatted:
             self.message_formatted = message.formatted
+        self.message_blocks = message.blocks
         self.message_type = message.message_type
-        self.image_source = message.image_path or ""
+        self.image_paths = message.image_paths
         self.role = message.role
         super().__init__(**kwargs)
+        self.ids.message_label.message_id = message.id
         self._setup_bubble()
 
         # remove the 'copy' button for non-assistant messages
@@ -147,43 +248,56 @@ class MessageBubble(BoxLayout):
     
     def _setup_text_message(self):
         """Configure text message bubble"""
-        message_label = self.ids.message_label
-        
-        def update_text_size(instance, *args):
-            # TOM:
-            # instance.text_size = (300, None)
-            instance.text_size = (instance.width, None)
-            instance.texture_update()
-            container = self.ids.message_container
-            padding_height = self.padding[1] + self.padding[3] if hasattr(self, 'padding') else 20
-            status_height = sp(20)
-            container.height = max(instance.texture_size[1] + padding_height + status_height, sp(40))
-        
-        message_label.bind(size=update_text_size)
-        Clock.schedule_once(lambda dt: update_text_size(message_label), 0.1)
+        self._fit_to_content(0)
     
-# TOM: replace with dynamic size calculations
-#    def _setup_image_message(self):
-#        """Configure image message bubble"""
-#        container = self.ids.message_container
-#        container.height = sp(200)
-
+    # TOM: replace with dynamic size calculations
     def _setup_image_message(self):
         """Configure image message bubble"""
+        grid = self.ids.image_grid
+        count = len(self.image_paths)
+        self.image_columns = max(1, min(count, 3))
+        cell_height = sp(150) if count <= 1 else sp(100)
+        for image_path in self.image_paths:
+            grid.add_widget(BubbleImage(image_path=image_path, visibility=self.visibility, height=cell_height))
+        rows = -(-count // self.image_columns)
+        images_height = rows * cell_height + max(0, rows - 1) * sp(5)
+        self._fit_to_content(images_height)
+
+    def _fit_to_content(self, images_height: float):
+        """
+        Keep the container as tall as the text, blocks and images.  The label
+        wraps at its width (chat.kv) and renders once per width and text; the
+        container follows its texture.  The history usually gives the bubble
+        its measured height before that (hold_height).
+        """
         message_label = self.ids.message_label
-        
-        def update_text_size(instance, *args):
-            # instance.text_size = (300, None)  # Fixed max width
-            instance.text_size = (instance.width, None)  # Fixed max width
-            instance.texture_update()
-            # Update container height based on text (fixed as per your requirements)
+
+        def update_height(*args):
             container = self.ids.message_container
-            padding_height = self.padding[1] + self.padding[3] if hasattr(self, 'padding') else 20
+            padding_height = self.padding[1] + self.padding[3]
             status_height = sp(20)
-            container.height = max(instance.texture_size[1] + padding_height + status_height + sp(150), sp(40))
-        
-        message_label.bind(size=update_text_size)
-        Clock.schedule_once(lambda dt: update_text_size(message_label), 0.1)
+            content_height = message_label.texture_size[1] + self.ids.rich_text.height
+            container.height = max(content_height + padding_height + status_height + images_height, sp(40))
+
+        message_label.bind(texture_size=update_height)
+        self.ids.rich_text.bind(height=update_height)
+        update_height()
+
+    def visibility(self) -> int:
+        return viewport_priority(self)
+
+    def hold_height(self, height: float):
+        """Keep a height until the bubble is laid out"""
+        self.ids.message_container.height = max(height - sp(10), sp(40))
+
+    def flash_target(self):
+        return self.ids.message_container
+
+    def on_parent(self, widget, parent):
+        # let the thumbnail atlas recycle our cells once we are gone
+        if parent is None:
+            for image in self.ids.image_grid.children:
+                image.release()
 
     def on_copy_pressed(self, instance):
         Clipboard.copy(self.message_text)
@@ -191,29 +305,224 @@ class MessageBubble(BoxLayout):
     def on_link_press(self, instance, url:str):
         webbrowser.open(url)
         
+BUBBLES = (MessageBubble, LeanBubble)
+
+
+class MessageStub(Widget):
+    """UI Component: Placeholder, of the same height, for a message evicted from memory"""
+
+    def __init__(self, message_id: str, **kwargs):
+        super().__init__(size_hint_y=None, **kwargs)
+        self.message_id = message_id
+
+
 class ChatHistory(ScrollView):
     """UI Component: Container for message history"""
     message_service = ObjectProperty(allownone=True)
+    lean_bubbles = BooleanProperty(False) # draw messages with LeanBubble
     
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self._is_subscribed = False
+        self._bubbles = {} # message id -> MessageBubble or MessageStub
+        # pending thumbnails follow the viewport, at most once per frame
+        self._reprioritize = Clock.create_trigger(lambda dt: get_thumbnail_service().reprioritize())
+        self.bind(scroll_y=self._reprioritize)
+        # evicted messages are rebuilt when they come near the viewport
+        self._check_viewport = Clock.create_trigger(self._rebuild_near_viewport)
+        self.bind(scroll_y=self._check_viewport)
+        # new messages are shown, in order, once their text has been measured
+        self._arriving = deque() # messages waiting for their height
+        self._arrived = {} # message id -> text height, or None when not measured
+        self._row_width = None # width of a bubble's row, once laid out
+        self._held = None # message events queued while the window is minimized
+
+    def on_kv_post(self, base_widget):
+        self.ids.messages_layout.bind(width=self._on_row_width)
+
+    def _on_row_width(self, layout, width):
+        self._row_width = width - sp(20) # the layout's padding
     
     def on_message_service(self, instance, message_service):
         """Called when message_service property is set (property injection)"""
         if message_service and not self._is_subscribed:
             # Subscribe to message service events
             message_service.add_observer(self._on_new_message)
+            message_service.add_eviction_observer(self._on_evicted)
+            message_service.add_update_observer(self._on_updated)
             self._is_subscribed = True
             # Load any existing messages
             self.load_existing_messages()
     
+    def hold(self):
+        """Queue message events instead of building bubbles, e.g. while the window is minimized"""
+        if self._held is None:
+            self._held = []
+
+    def release(self):
+        """
+        Catch up on the queued events in one pass.  A message created while
+        held is shown in its latest state, so its updates and eviction are
+        skipped; an older message is updated once.
+        """
+        (held, self._held) = (self._held, None)
+        created = { message.id for (kind, message) in held or () if kind == "new" }
+        updated = set()
+        for (kind, message) in held or ():
+            if kind == "new":
+                self._on_new_message(message)
+            elif message.id in created:
+                continue
+            elif kind == "updated":
+                if message.id not in updated:
+                    updated.add(message.id)
+                    self._on_updated(message)
+            else:
+                self._on_evicted(message)
+
     def _on_new_message(self, message: Message):
-        """Handle new message from service"""
-        message_bubble = MessageBubble(message)
-        self.ids.messages_layout.add_widget(message_bubble)
+        """Handle new message from service: show it once the height of its text is known"""
+        if self._held is not None:
+            self._held.append(("new", message))
+            return
+        self._arriving.append(message)
+        text = message.formatted or message.content
+        if self._row_width is None or message.blocks is not None or not text:
+            self._arrived[message.id] = None # laid out by the bubble
+        else:
+            def measured(key, height):
+                self._arrived[key] = height
+                self._show_arrived()
+            get_measure_service().request(message.id, text, text_width(self._row_width, message.role), measured)
+        self._show_arrived()
+
+    def _show_arrived(self):
+        while self._arriving and self._arriving[0].id in self._arrived:
+            message = self._arriving.popleft()
+            self._show(message, self._arrived.pop(message.id))
+
+    def _show(self, message: Message, text_height):
+        height = bubble_height(text_height, len(message.image_paths)) if text_height is not None else None
+        if message.evicted: # while it was measured
+            widget = MessageStub(message.id, height=height or sp(50))
+            self._bubbles[message.id] = widget
+        else:
+            with working_on(message.id):
+                widget = self._make_bubble(message)
+                if height is not None:
+                    widget.hold_height(height) # its final height, before it is laid out
+        self.ids.messages_layout.add_widget(widget)
         # Auto-scroll to bottom
         Clock.schedule_once(lambda dt: setattr(self, 'scroll_y', 0), 0.1)
+
+    def _make_bubble(self, message: Message):
+        if self.lean_bubbles and message.blocks is None: # blocks need the MessageBubble's RichTextView
+            bubble = LeanBubble(message)
+            self._bubbles[message.id] = bubble
+            bubble.bind(texture_pixels=lambda bubble, pixels:
+                        self.message_service.note_view_size(message.id, int(pixels * 4) + LEAN_BUBBLE_OVERHEAD))
+            return bubble
+
+        message_bubble = MessageBubble(message)
+        self._bubbles[message.id] = message_bubble
+
+        # tell the memory budget what the bubble's text textures cost
+        def on_texture_size(*args):
+            (label, rich_text) = (message_bubble.ids.message_label, message_bubble.ids.rich_text)
+            pixels = label.texture_size[0] * label.texture_size[1] + rich_text.width * rich_text.height
+            self.message_service.note_view_size(message.id, int(pixels * 4) + BUBBLE_OVERHEAD)
+        message_bubble.ids.message_label.bind(texture_size=on_texture_size)
+        message_bubble.ids.rich_text.bind(size=on_texture_size)
+        return message_bubble
+
+    def _replace(self, old, new):
+        layout = self.ids.messages_layout
+        index = layout.children.index(old)
+        layout.remove_widget(old)
+        layout.add_widget(new, index=index)
+
+    def _on_updated(self, message: Message):
+        """Show markup that was rendered in the background"""
+        if self._held is not None:
+            self._held.append(("updated", message))
+            return
+        get_measure_service().forget(message.id) # heights of the text it had before
+        bubble = self._bubbles.get(message.id)
+        if isinstance(bubble, LeanBubble) and message.blocks is not None:
+            self._replace(bubble, self._make_bubble(message))
+            return
+        if isinstance(bubble, MessageBubble):
+            bubble.message_blocks = message.blocks
+        if isinstance(bubble, BUBBLES):
+            bubble.message_formatted = message.formatted
+
+    def _on_evicted(self, message: Message):
+        """Swap the bubble of an evicted message for a stub of the same height"""
+        if self._held is not None:
+            self._held.append(("evicted", message))
+            return
+        bubble = self._bubbles.get(message.id)
+        if isinstance(bubble, BUBBLES):
+            stub = MessageStub(message.id, height=bubble.height)
+            self._bubbles[message.id] = stub
+            self._replace(bubble, stub)
+
+    def _measured_height(self, message: Message):
+        """Height of the message's bubble at the current width, if its text has been measured"""
+        if self._row_width is None:
+            return None
+        text = message.formatted or message.content
+        text_height = get_measure_service().height(message.id, text, text_width(self._row_width, message.role))
+        return None if text_height is None else bubble_height(text_height, len(message.image_paths))
+
+    def _rebuild(self, stub: MessageStub):
+        message = self.message_service.reload_message(stub.message_id)
+        bubble = self._make_bubble(message)
+        height = self._measured_height(message)
+        bubble.hold_height(height if height is not None else stub.height) # until laid out
+        self._replace(stub, bubble)
+        return bubble
+
+    def _rebuild_measured(self, stub: MessageStub):
+        """Rebuild a stub once its text has been measured at the current width"""
+        message = self.message_service.reload_message(stub.message_id)
+        text = message.formatted or message.content
+        if self._row_width is None or message.blocks is not None or not text:
+            self._rebuild(stub)
+            return
+        def measured(key, height):
+            if self._bubbles.get(key) is stub: # not rebuilt meanwhile
+                self._rebuild(stub)
+        get_measure_service().request(message.id, text, text_width(self._row_width, message.role), measured)
+
+    def _rebuild_near_viewport(self, *args):
+        """Rebuild stubs within a screen of the viewport; mark visible bubbles as recently used"""
+        layout = self.ids.messages_layout
+        (x, bottom) = layout.to_widget(*self.to_window(self.x, self.y))
+        (low, high) = (bottom - self.height, bottom + 2 * self.height)
+        near = [ child for child in layout.children if child.top >= low and child.y <= high ]
+        # rebuilding one of them must not evict another
+        self.message_service.keep_in_view(child.message_id for child in near)
+        for child in near:
+            if child.parent is None: # replaced during this pass
+                continue
+            if isinstance(child, MessageStub):
+                self._rebuild_measured(child)
+            elif isinstance(child, BUBBLES):
+                self.message_service.reload_message(child.message_id)
+
+    def scroll_to_message(self, message_id: str) -> bool:
+        """Scroll a message into view and flash its bubble"""
+        bubble = self._bubbles.get(message_id)
+        if bubble is None:
+            return False
+        if isinstance(bubble, MessageStub):
+            bubble = self._rebuild(bubble)
+        self.scroll_to(bubble, padding=sp(20), animate={'d': 0.2})
+        target = bubble.flash_target()
+        Animation.cancel_all(target, 'opacity')
+        (Animation(opacity=0.4, d=0.15) + Animation(opacity=1, d=0.3)).start(target)
+        return True
     
     def load_existing_messages(self):
         """Load any existing messages from the service"""
@@ -226,6 +535,7 @@ class UrlInput(BoxLayout):
     """UI Component: Input area for composing messages"""
     chatbot_service = ObjectProperty(allownone=True)
     message_service = ObjectProperty(allownone=True)
+    idle = ObjectProperty(allownone=True)
     
     def on_enter_pressed(self, instance):
         """Handle Enter key press"""
@@ -237,13 +547,50 @@ class UrlInput(BoxLayout):
             instance.text = instance.text.strip()
             # await self.chatbot_service.connect_to_server(instance.text)
             try:
-                await self.chatbot_service.connect_to_server(instance.text)
-                self.message_service.create_text_message(f"Connected to {instance.text}", role=Roles.STATUS)
+                with self.idle.busy():
+                    status = await self.chatbot_service.connect_to_server(instance.text)
+                self.message_service.create_text_message(status, role=Roles.STATUS)
             except Exception as e:
                 self.message_service.create_text_message(f"Exception: {e}", role=Roles.WARNING)
 
         asyncio.create_task(doit())
 
+class SearchBar(BoxLayout):
+    """UI Component: Search the conversation and jump between matches"""
+    search_index = ObjectProperty(allownone=True)
+    chat_history = ObjectProperty(allownone=True)
+    status_text = StringProperty("")
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._matches = [] # message ids, newest first
+        self._current = 0
+        self._search = Clock.create_trigger(self._run_search, 0.15) # wait for typing to pause
+
+    def on_query(self, instance, text):
+        self._search()
+
+    def _run_search(self, dt):
+        query = self.ids.search_input.text.strip()
+        self._matches = self.search_index.search(query) if (query and self.search_index) else []
+        self._current = 0
+        self._show()
+
+    def next_match(self, step: int):
+        """Move to an older (1) or newer (-1) match"""
+        if self._matches:
+            self._current = (self._current + step) % len(self._matches)
+            self._show()
+
+    def _show(self):
+        if not self._matches:
+            self.status_text = "no matches" if self.ids.search_input.text.strip() else ""
+            return
+        self.status_text = f"{self._current + 1} of {len(self._matches)}"
+        if self.chat_history:
+            self.chat_history.scroll_to_message(self._matches[self._current])
+
+
 class MessageInput(BoxLayout):
     """UI Component: Input area for composing messages"""
     on_send_callback = ObjectProperty(allownone=True)
@@ -276,45 +623,42 @@ class MessageInput(BoxLayout):
         text_input.text = ''
         return message_text
 
-class ImageChooserPopup(Popup):
-    """UI Component: File chooser popup for selecting images"""
-    on_image_selected = ObjectProperty(allownone=True)
-    
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.title = "Select an Image"
-        self.size_hint = (0.9, 0.9)
-        
-        layout = BoxLayout(orientation='vertical', spacing='10sp', padding='10sp')
-        
-        self.file_chooser = FileChooserIconView(
-            filters=['*.png', '*.jpg', '*.jpeg', '*.gif', '*.bmp'],
-            path=os.path.expanduser('~')
-        )
-        
-        button_layout = BoxLayout(size_hint_y=None, height='40sp', spacing='10sp')
-        
-        cancel_btn = Button(text='Cancel', size_hint_x=0.5)
-        cancel_btn.bind(on_press=self.dismiss)
-        
-        select_btn = Button(text='Select', size_hint_x=0.5)
-        select_btn.bind(on_press=self.select_image)
-        
-        button_layout.add_widget(cancel_btn)
-        button_layout.add_widget(select_btn)
-        
-        layout.add_widget(self.file_chooser)
-        layout.add_widget(button_layout)
-        
-        self.content = layout
-    
-    def select_image(self, *args):
-        """Handle image selection"""
-        if self.file_chooser.selection:
-            selected_file = self.file_chooser.selection[0]
-            if self.on_image_selected:
-                self.on_image_selected(selected_file)
-            self.dismiss()
+#
+# Credentials for the NLIP Chat Bot Service are asked for with popups.
+#
+
+def on_login_elicitation(client):
+
+    print(f"SERVICES: ON_BASIC_ELICIATION:{client}")
+
+    from asyncio import Future
+    future = Future()
+
+    def handle_login_result(credentials: LoginCredentials):
+        username = credentials.username
+        password = credentials.password
+        future.set_result((username, password))
+
+    popup = LoginPopup(on_login_callback=handle_login_result)
+    popup.open()
+
+    return future
+
+def on_bearer_elicitation(client):
+
+    print(f"SERVICES: ON_BEARER_ELICIATION:{client}")
+
+    from asyncio import Future
+    future = Future()
+
+    def handle_bearer_result(credentials: BearerCredentials):
+        bearer = credentials.bearer
+        future.set_result(bearer)
+
+    popup = BearerPopup(on_bearer_callback=handle_bearer_result)
+    popup.open()
+
+    return future
 
 
 class ChatInterface(BoxLayout):
@@ -324,30 +668,98 @@ class ChatInterface(BoxLayout):
         # Initialize services BEFORE calling super() so they're available during KV loading
         self.cmdargs = cmdargs # argparse instance
 
+        memory_budget = int(self.cmdargs.memory_mb * 1024 * 1024)
         if self.cmdargs.plain:
-            self.message_service = MessageService(processor_name='plain')
+            self.message_service = MessageService(processor_name='plain', memory_budget=memory_budget)
         else:
-            self.message_service = MessageService(processor_name='mistune')
+            render_pool = None
+            if self.cmdargs.render_workers > 0:
+                render_pool = RenderPool(workers=self.cmdargs.render_workers, threshold=self.cmdargs.render_threshold)
+            self.message_service = MessageService(processor_name='blocks' if self.cmdargs.blocks else 'mistune',
+                                                  memory_budget=memory_budget, render_pool=render_pool)
+
+        # full frame rate only while something is happening
+        self.idle = IdleGovernor(idle_fps=self.cmdargs.idle_fps, idle_after=self.cmdargs.idle_after)
+        self.message_service.add_observer(self.idle.poke)
+        self.message_service.add_update_observer(self.idle.poke)
+
+        # images of an imported archive that has been moved or deleted since
+        add_extract_observer(lambda archive_path, error: Clock.schedule_once(
+            lambda dt: self.message_service.create_text_message(
+                f"Images can no longer be read from {archive_path}, was it moved or deleted? ({error})",
+                role=Roles.WARNING)))
+
+        # kept up to date as messages are created
+        self.search_index = create_search_index()
+        self.message_service.add_observer(self.search_index.add)
 
         if self.cmdargs.mock:
             self.chatbot_service = MockChatBotService()
         else:
-            self.chatbot_service = NlipChatBotService()
+            credential_cache = create_credential_cache(self.cmdargs.credential_store, self.cmdargs.credential_file)
+            self.chatbot_service = NlipChatBotService(compression=self._compression_settings(),
+                                                      credential_cache=credential_cache,
+                                                      retry_policy=self._retry_policy(),
+                                                      backup_url=self.cmdargs.backup_url,
+                                                      response_cache=self._response_cache(),
+                                                      on_login_elicitation=on_login_elicitation,
+                                                      on_bearer_elicitation=on_bearer_elicitation)
         super().__init__(**kwargs)
 
+    def _response_cache(self):
+        """Build the opt-in response cache from the command line"""
+        if not self.cmdargs.cache:
+            return None
+        if self.cmdargs.cache_dir:
+            return ResponseCache(directory=self.cmdargs.cache_dir, ttl=self.cmdargs.cache_ttl)
+        else:
+            return ResponseCache(ttl=self.cmdargs.cache_ttl)
+
+    def _retry_policy(self):
+        """Build the retry policy from the command line"""
+        hedge_ms = self.cmdargs.hedge_ms
+        return RetryPolicy(max_attempts=max(1, self.cmdargs.retries),
+                           connect_timeout=self.cmdargs.connect_timeout,
+                           read_timeout=self.cmdargs.read_timeout,
+                           total_timeout=self.cmdargs.total_timeout,
+                           hedge_delay=hedge_ms / 1000 if hedge_ms is not None else None)
+
+    def _compression_settings(self):
+        """Build the per-endpoint compression settings from the command line"""
+        default = CompressionSettings.parse(self.cmdargs.compress)
+        if self.cmdargs.compression_config:
+            return EndpointCompression.load(self.cmdargs.compression_config, default=default)
+        else:
+            return EndpointCompression(default=default)
+
     def on_kv_post(self, base_widget):
         """Called after the kv file is loaded"""
+        # Bubbles drawn on one widget; the block view needs MessageBubble's widgets
+        self.ids.chat_history.lean_bubbles = self.cmdargs.lean_bubbles and not self.cmdargs.blocks
+
         # Inject message service dependency into chat history
         self.ids.chat_history.message_service = self.message_service
 
         # Inject chatbotservice into the url input
         self.ids.url_input.chatbot_service = self.chatbot_service
         self.ids.url_input.message_service = self.message_service
+        self.ids.url_input.idle = self.idle
+
+        # Scrolling keeps the frame rate up; no bubbles are built while minimized
+        history = self.ids.chat_history
+        history.bind(scroll_y=self.idle.poke)
+        self.idle.add_suspend_listener(lambda suspended: history.hold() if suspended else history.release())
+
+        # Inject the search index and the history it scrolls
+        self.ids.search_bar.search_index = self.search_index
+        self.ids.search_bar.chat_history = self.ids.chat_history
         
         # Set up message input callbacks
         self.ids.message_input.on_send_callback = self.handle_send_message
         self.ids.message_input.on_image_callback = self.handle_image_upload
         
+        Clock.schedule_interval(self._update_memory_readout, 2.0)
+
         # Add sample messages
         self._add_welcome_messages()
         if self.cmdargs.mock:
@@ -357,15 +769,16 @@ class ChatInterface(BoxLayout):
         """Handle sending a new text message"""
         # Create user message through service
         user_message = self.message_service.create_text_message(message_text, role=Roles.USER)
-
-        async def doit():
-            response_text , image_path = await self.chatbot_service.generate_response(user_message)
-            if image_path == None:
-                self.message_service.create_text_message(response_text, role=Roles.ASSISTANT)
-            else:
-                self.message_service.create_image_message(response_text, image_path, role=Roles.ASSISTANT)
-
-        asyncio.create_task(doit())
+        asyncio.create_task(self._respond_to(user_message))
+
+    async def _respond_to(self, user_message: Message):
+        """Get the chatbot response to a user message and add it to the history"""
+        with self.idle.busy():
+            response_text, image_paths, cached = await self.chatbot_service.generate_response(user_message)
+        if not image_paths:
+            self.message_service.create_text_message(response_text, role=Roles.ASSISTANT, cached=cached)
+        else:
+            self.message_service.create_image_message(response_text, image_paths, role=Roles.ASSISTANT, cached=cached)
         
     
     def handle_image_upload(self, *args):
@@ -374,27 +787,67 @@ class ChatInterface(BoxLayout):
         popup.on_image_selected = self.on_image_selected
         popup.open()
     
-    def on_image_selected(self, image_path: str):
-        """Handle when an image is selected"""
-        filename = os.path.basename(image_path)
-        default_content = f"Shared an image: {filename}"
+    def on_image_selected(self, image_paths: List[str]):
+        """Handle when one or more images are selected"""
+        filenames = ", ".join(os.path.basename(image_path) for image_path in image_paths)
+        if len(image_paths) == 1:
+            default_content = f"Shared an image: {filenames}"
+        else:
+            default_content = f"Shared {len(image_paths)} images: {filenames}"
         explicit_content = self.ids.message_input.cut_message()
         user_message = self.message_service.create_image_message(
             content= default_content if len(explicit_content) == 0 else explicit_content,
-            image_path=image_path,
+            image_paths=image_paths,
             role=Roles.USER
         )
+        asyncio.create_task(self._respond_to(user_message))
 
+    
+    def _update_memory_readout(self, dt):
+        """Show message memory against the budget, and the process RSS"""
+        if self.idle.suspended:
+            return
+        usage = self.message_service.memory_usage()
+        rss = process_rss()
+        text = f"{usage['resident_bytes'] / 1e6:.1f} MB in {usage['resident']} messages"
+        if usage['budget']:
+            text += f" of {usage['budget'] / 1e6:.0f} MB, {usage['stubs']} on disk"
+        if rss:
+            text += f", RSS {rss / 1e6:.0f} MB"
+        self.ids.memory_readout.text = text
+
+    def export_conversation(self, *args):
+        """Ask for a file and save the conversation to it"""
+        ArchivePopup(exporting=True, on_archive_callback=self._on_export).open()
+
+    def import_conversation(self, *args):
+        """Ask for an archive and add its messages to the conversation"""
+        ArchivePopup(exporting=False, on_archive_callback=self._on_import).open()
+
+    def _on_export(self, path: str, include_markup: bool):
         async def doit():
-            response_text, image_path = await self.chatbot_service.generate_response(user_message)
-            if image_path == None:
-                self.message_service.create_text_message(response_text, role=Roles.ASSISTANT)
-            else:
-                self.message_service.create_image_message(response_text, image_path, role=Roles.ASSISTANT)
-        
+            messages = self.message_service.get_all_messages(full=True)
+            try:
+                counts = await asyncio.to_thread(export_archive, path, messages, include_markup)
+                self.message_service.create_text_message(
+                    f"Exported {counts['messages']} messages and {counts['images']} images to {path}", role=Roles.STATUS)
+            except Exception as e:
+                self.message_service.create_text_message(f"Export failed: {e}", role=Roles.WARNING)
+
+        asyncio.create_task(doit())
+
+    def _on_import(self, path: str, include_markup: bool):
+        async def doit():
+            try:
+                messages = await asyncio.to_thread(import_archive, path)
+            except Exception as e:
+                self.message_service.create_text_message(f"Import failed: {e}", role=Roles.WARNING)
+                return
+            self.message_service.restore_messages(messages)
+            self.message_service.create_text_message(f"Imported {len(messages)} messages from {path}", role=Roles.STATUS)
+
         asyncio.create_task(doit())
 
-    
     def _generate_bot_response(self, user_message: Message):
         """Generate and send bot response"""
         response_text = self.chatbot_service.generate_response(user_message)
@@ -411,7 +864,7 @@ class ChatInterface(BoxLayout):
             if msg_type == "text":
                 self.message_service.create_text_message(content, role)
             elif msg_type == "image":
-                self.message_service.create_image_message(content, img_path, role)
+                self.message_service.create_image_message(content, [img_path], role)
 
     def _add_sample_messages(self):
         """Add sample messages to demonstrate the interface"""
@@ -467,7 +920,7 @@ class ChatInterface(BoxLayout):
             if msg_type == "text":
                 self.message_service.create_text_message(content, role)
             elif msg_type == "image":
-                self.message_service.create_image_message(content, img_path, role)
+                self.message_service.create_image_message(content, [img_path], role)
 
 class ChatApp(App):
     """Application entry point"""
@@ -484,5 +937,16 @@ class ChatApp(App):
     def on_start(self):
         from kivy.core.window import Window
         Window.clearcolor = (1, 1, 1, 1)
+        self.root.idle.watch(Window)
+
+        self.stall_profiler = None
+        if self.cmdargs.stall_ms > 0:
+            self.stall_profiler = StallProfiler(self.cmdargs.stall_ms, directory=self.cmdargs.stall_dir, clock=Clock)
+            self.stall_profiler.start(asyncio.get_event_loop())
+
+    def on_stop(self):
+        if self.stall_profiler is not None:
+            self.stall_profiler.stop()
+        self.root.message_service.close() # removes the spilled history
 
     
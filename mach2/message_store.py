@@ -0,0 +1,101 @@
+#
+# Disk-backed copy of the conversation, for a memory-bounded history.
+#
+# With a memory budget, MessageService writes every message through to a
+# MessageStore.  When the budget is exceeded, the least recently used messages
+# are reduced to stubs (content and markup dropped) and their bubbles to
+# placeholders; a stub is filled in again from the store when it scrolls back
+# into view.
+#
+# The store is a scratch SQLite file that is deleted when the store is closed.
+# It does not need to survive a crash, so it is written without syncing.
+#
+
+import os
+import sys
+import json
+import sqlite3
+import tempfile
+from datetime import datetime
+from typing import Optional
+
+from .models import Message
+
+
+DEFAULT_STORE_DIR = os.path.join(os.path.expanduser("~"), ".mach2")
+
+# estimated bytes of a MessageBubble's widgets, not counting its textures
+BUBBLE_OVERHEAD = 16 * 1024
+
+# and of a LeanBubble, one widget drawing on its own canvas
+LEAN_BUBBLE_OVERHEAD = 4 * 1024
+
+
+def message_size(message: Message) -> int:
+    """Estimated bytes held by a message's text"""
+    size = sys.getsizeof(message.content) + sys.getsizeof(message.formatted or "")
+    for block in message.blocks or ():
+        size += sys.getsizeof(block.markup) + sum(map(sys.getsizeof, block.lines))
+    return size
+
+
+def process_rss() -> Optional[int]:
+    """Resident set size of this process in bytes, where the platform reports it"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # peak, not current
+        return peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        return None
+
+
+class MessageStore:
+    """
+    Messages by id in a scratch SQLite file.
+
+    Args:
+        directory: where the file is created
+    """
+
+    def __init__(self, directory: str = DEFAULT_STORE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        (fd, self.path) = tempfile.mkstemp(prefix="history-", suffix=".sqlite", dir=directory)
+        os.close(fd)
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute("PRAGMA synchronous=OFF")
+        self._conn.execute("PRAGMA journal_mode=MEMORY")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS messages (
+                                  id TEXT PRIMARY KEY, content TEXT, formatted TEXT, message_type TEXT,
+                                  image_paths TEXT, role TEXT, timestamp REAL, cached INTEGER)""")
+
+    def put(self, message: Message):
+        self._conn.execute("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                           (message.id, message.content, message.formatted, message.message_type,
+                            json.dumps(message.image_paths), message.role,
+                            message.timestamp.timestamp(), 1 if message.cached else 0))
+        self._conn.commit()
+
+    def get(self, message_id: str) -> Optional[Message]:
+        row = self._conn.execute("SELECT * FROM messages WHERE id = ?", (message_id,)).fetchone()
+        if row is None:
+            return None
+        (id, content, formatted, message_type, image_paths, role, timestamp, cached) = row
+        return Message(id=id, content=content, formatted=formatted, message_type=message_type,
+                       image_paths=json.loads(image_paths), role=role,
+                       timestamp=datetime.fromtimestamp(timestamp), cached=bool(cached))
+
+    def clear(self):
+        self._conn.execute("DELETE FROM messages")
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,94 @@
+#
+# Lightweight in-process metrics: counters and timing samples.
+#
+# Modules record into the shared `metrics` registry.  Nothing is exported
+# anywhere; benchmarks and debugging code read summaries back out.
+#
+#    from .metrics import metrics
+#
+#    metrics.incr("auth.preemptive")
+#    with metrics.timer("decode"):
+#        ...
+#
+
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict
+
+
+class Metrics:
+    """A thread-safe registry of named counters and timing samples"""
+
+    def __init__(self, max_samples: int = 1000):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = {}
+        self._timings: Dict[str, deque] = {}
+
+    def incr(self, name: str, n: int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def count(self, name: str) -> int:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            samples = self._timings.get(name)
+            if samples is None:
+                samples = self._timings[name] = deque(maxlen=self.max_samples)
+            samples.append(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def samples(self, name: str) -> list:
+        with self._lock:
+            return list(self._timings.get(name, ()))
+
+    def percentile(self, name: str, pct: float):
+        """Return the pct (0-100) percentile of a timing, or None without samples"""
+        samples = sorted(self.samples(name))
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def summary(self, name: str) -> dict:
+        samples = sorted(self.samples(name))
+        if not samples:
+            return { "count": 0 }
+        return {
+            "count": len(samples),
+            "mean": sum(samples) / len(samples),
+            "p50": samples[len(samples) // 2],
+            "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+            "max": samples[-1],
+        }
+
+    def snapshot(self) -> dict:
+        """All counters and timing summaries"""
+        with self._lock:
+            counters = dict(self._counters)
+            names = list(self._timings.keys())
+        return {
+            "counters": counters,
+            "timings": { name: self.summary(name) for name in names },
+        }
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timings.clear()
+
+
+# process-wide registry
+metrics = Metrics()
@@ -1,5 +1,5 @@
-from dataclasses import dataclass
-from typing import Optional
+from dataclasses import dataclass, field
+from typing import List, Optional
 from datetime import datetime
 from enum import StrEnum
 
@@ -19,11 +19,19 @@ class Message:
     content: str
     formatted: str  # kivy markup version of content if present
     message_type: str  # "text" or "image"
-    image_path: Optional[str] = None
+    image_path: Optional[str] = None # the first of image_paths
     role: str = "user" # user, assistant, system, status
     timestamp: datetime = None
+    cached: bool = False # response was answered from the local cache
+    image_paths: List[str] = field(default_factory=list) # every attached image
+    evicted: bool = False # content and markup dropped to stay within the memory budget
+    blocks: Optional[list] = None # Blocks of the block renderer, shown instead of formatted
     
     def __post_init__(self):
         if self.timestamp is None:
             self.timestamp = datetime.now()
+        if self.image_path and not self.image_paths:
+            self.image_paths = [self.image_path]
+        elif self.image_paths and not self.image_path:
+            self.image_path = self.image_paths[0]
 
@@ -2,22 +2,43 @@
 # A simple Async NLIP Client based on HTTPX
 #
 
+import time
 import httpx
 from nlip_sdk.nlip import NLIP_Message
 
+from .nlip_decoder import NlipDecoder
+from .compression import CompressionSettings
+
 class NlipAsyncClient:
 
-    def __init__(self, base_url: str):
+    def __init__(self, base_url: str, decoder: NlipDecoder = None, compression: CompressionSettings = None, transport = None):
         self.base_url = base_url
-        self.client = httpx.AsyncClient()
+        self.client = httpx.AsyncClient(transport=transport)
+        self.decoder = decoder or NlipDecoder()
+        self.compression = compression or CompressionSettings()
 
     @classmethod
-    def create_from_url(cls, base_url:str):
-        return NlipAsyncClient(base_url)
+    def create_from_url(cls, base_url:str, decoder: NlipDecoder = None, compression: CompressionSettings = None, transport = None):
+        return NlipAsyncClient(base_url, decoder=decoder, compression=compression, transport=transport)
+
+    # Open a connection to the server and measure the round trip.  Any HTTP
+    # response counts as reachable; the connection stays in the pool for the
+    # first message.  Returns (status_code, seconds).
+    async def async_probe(self, timeout = 10.0):
+        started = time.perf_counter()
+        response = await self.client.options(self.base_url, timeout=timeout)
+        return (response.status_code, time.perf_counter() - started)
 
-    async def async_send(self, msg:NLIP_Message) -> NLIP_Message:
-        response = await self.client.post(self.base_url, json=msg.to_dict(), timeout=120.0, follow_redirects=True)
-        data = response.raise_for_status().json()
-        nlip_msg = NLIP_Message(**data)
+    async def async_send(self, msg:NLIP_Message, headers: dict = None, timeout = 120.0) -> NLIP_Message:
+        (nlip_msg, response) = await self.async_exchange(msg, headers, timeout)
         return nlip_msg
+
+    # send a message and return both the reply and the HTTP response it came in
+    async def async_exchange(self, msg:NLIP_Message, headers: dict = None, timeout = 120.0):
+        content, body_headers = self.compression.encode_body(msg.to_json().encode("utf-8"))
+        body_headers.update(headers or {})
+        response = await self.client.post(self.base_url, content=content, headers=body_headers, timeout=timeout, follow_redirects=True)
+        response.raise_for_status()
+        nlip_msg = await self.decoder.async_decode(response.content)
+        return (nlip_msg, response)
         
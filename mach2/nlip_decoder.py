@@ -0,0 +1,134 @@
+#
+# Fast decoding of NLIP responses.
+#
+# Responses carrying base64 images can be several megabytes.  Parsing them with the
+# stdlib json module and then running full pydantic validation over every submessage
+# costs tens of milliseconds on the event loop, which shows up as a stalled UI.
+#
+# The NlipDecoder picks the fastest JSON backend that is installed (orjson, then
+# msgspec, then the stdlib json), can skip validation of large binary submessage
+# content, and moves decoding of large bodies to a worker thread.
+#
+
+import json
+import asyncio
+from typing import Callable, Dict, List, Optional
+
+from nlip_sdk.nlip import NLIP_Message
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+def _orjson_loads(body: bytes):
+    return orjson.loads(body)
+
+def _msgspec_loads(body: bytes):
+    return msgspec.json.decode(body)
+
+def _stdlib_loads(body: bytes):
+    return json.loads(body)
+
+
+def _available_backends() -> Dict[str, Callable]:
+    backends = {}
+    if orjson is not None:
+        backends["orjson"] = _orjson_loads
+    if msgspec is not None:
+        backends["msgspec"] = _msgspec_loads
+    backends["json"] = _stdlib_loads
+    return backends
+
+
+def available_backends() -> List[str]:
+    """Names of the installed JSON backends, fastest first"""
+    return list(_available_backends().keys())
+
+
+class NlipDecoder:
+    """
+    Decode an HTTP response body into an NLIP_Message.
+
+    Args:
+        backend: "orjson", "msgspec" or "json".  None selects the fastest installed.
+        skip_binary_validation: do not run validation over binary submessage content
+            at or above binary_threshold characters.  The content is restored
+            untouched on the validated message.
+        binary_threshold: size (characters) at which binary content is set aside
+        thread_threshold: body size (bytes) at which async_decode uses a worker thread
+    """
+
+    def __init__(self,
+                 backend: Optional[str] = None,
+                 skip_binary_validation: bool = True,
+                 binary_threshold: int = 64 * 1024,
+                 thread_threshold: int = 256 * 1024):
+
+        backends = _available_backends()
+        if backend is None:
+            backend = next(iter(backends))
+        if backend not in backends:
+            raise ValueError(f"JSON backend not available:{backend}")
+
+        self.backend = backend
+        self._loads = backends[backend]
+        self.skip_binary_validation = skip_binary_validation
+        self.binary_threshold = binary_threshold
+        self.thread_threshold = thread_threshold
+
+    def loads(self, body: bytes):
+        """Parse JSON bytes with the selected backend"""
+        return self._loads(body)
+
+    def decode(self, body: bytes) -> NLIP_Message:
+        """Parse and validate a response body.  Runs on the calling thread."""
+        data = self._loads(body)
+        return self.to_message(data)
+
+    async def async_decode(self, body: bytes) -> NLIP_Message:
+        """Decode a response body, off the event loop when it is large"""
+        if len(body) >= self.thread_threshold:
+            return await asyncio.to_thread(self.decode, body)
+        else:
+            return self.decode(body)
+
+    def to_message(self, data: dict) -> NLIP_Message:
+        """Build an NLIP_Message from parsed JSON"""
+
+        deferred = {}
+        if self.skip_binary_validation:
+            deferred = self._set_aside_binary(data)
+
+        nlip_msg = NLIP_Message(**data)
+
+        # put the large content back without re-validating it
+        for index, content in deferred.items():
+            nlip_msg.submessages[index].content = content
+
+        return nlip_msg
+
+    def _set_aside_binary(self, data: dict) -> Dict[int, str]:
+        deferred = {}
+        submessages = data.get("submessages")
+        if not submessages:
+            return deferred
+
+        for index, submsg in enumerate(submessages):
+            if not isinstance(submsg, dict):
+                continue
+            content = submsg.get("content")
+            fmt = submsg.get("format")
+            if (isinstance(content, str)
+                and isinstance(fmt, str) and fmt.lower() == "binary"
+                and len(content) >= self.binary_threshold):
+                deferred[index] = content
+                submsg["content"] = ""
+
+        return deferred
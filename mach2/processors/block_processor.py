@@ -0,0 +1,47 @@
+#
+# The Block Processor parses Markdown into a list of Blocks (renderers/kivy_blocks.py)
+# that the bubble shows one widget per block, instead of one markup string.
+#
+# Replies without Markdown take the same fast path as in the Mistune Processor
+# and become a single text block, or a listing of their lines if they are too
+# long for one texture.  With a RenderPool, content above the pool's
+# threshold is parsed in a worker process and process() returns a Future of
+# the blocks.
+#
+
+from ..renderers.kivy_blocks import MarkdownToBlocks, plain_blocks
+from ..models import Roles
+from ..metrics import metrics
+from .mistune_processor import plain_markup
+from .render_pool import RenderPool
+
+class BlockProcessor:
+
+    def __init__(self, render_pool: RenderPool = None):
+        self.renderer = MarkdownToBlocks()
+        self.render_pool = render_pool
+
+    def process(self, content: str, role: str):
+
+        if role == Roles.ASSISTANT:
+
+            markup = plain_markup(content)
+            if markup is not None:
+                metrics.incr("render.fast_path.hit")
+                return plain_blocks(markup)
+            metrics.incr("render.fast_path.miss")
+
+            if self.render_pool is not None and self.render_pool.wants(content):
+                return self.render_pool.submit(content, blocks=True)
+
+            try:
+                blocks = self.renderer.parse(content)
+            except Exception as e:
+                print(f"BlockException")
+                print(e)
+                blocks = None
+
+            return blocks
+
+        else:
+            return None
@@ -2,23 +2,89 @@
 # The Mistune Processor recognizes Markdown and fenced code blocks and translates
 # content into Kivy markup.
 #
+# Many replies are a sentence or two with no Markdown at all.  A regular
+# expression pre-scan looks for anything Markdown, its plugins or Kivy markup
+# would treat specially; when there is nothing, the text is escaped and its
+# paragraphs normalized the way the full parse would, without running mistune.
+#
+# A message longer than BBCodeRenderer.full_highlight_lines would be a Label
+# taller than one texture, so it is parsed into Blocks instead, as the Block
+# Processor does, and a long code block in it is shown as a list of lines.
+# This is decided before the fast path, so a long reply with no Markdown (a
+# log, say) becomes a listing of its lines too.
+#
+# With a RenderPool, content above the pool's threshold is rendered in a worker
+# process and process() returns a Future of the markup instead of the markup.
+#
+
+import re
+from typing import Optional
 
-from ..renderers.kivy_mistune_bbcode import MarkdownToBBCodeParser
+from ..renderers.kivy_mistune_bbcode import MarkdownToBBCodeParser, BBCodeRenderer
+from ..renderers.kivy_blocks import MarkdownToBlocks, plain_blocks
+from ..renderers.kivy_pygments_bbcode import escape_markup
 from ..models import Roles
+from ..metrics import metrics
+from .render_pool import RenderPool
+
+
+# inline syntax, entities, HTML, autolinks and Kivy markup brackets anywhere in the text
+_INLINE_SYNTAX = re.compile(r"[\\`*_\[\]<>~|!\r\f\v\x00]|&#?\w+;|https?://")
+
+# lines that start a block: lists, quotes, headings, setext underlines, indented code
+_BLOCK_SYNTAX = re.compile(r"^(?: {0,3}(?:[-+*>#=]|\d{1,9}[.)](?:[ \t]|$))| {0,3}\t| {4})", re.MULTILINE)
+
+
+def plain_markup(content: str) -> Optional[str]:
+    """
+    Kivy markup for content with no Markdown in it, the same as the full
+    parse would produce, or None if content needs the parser.
+    """
+    if _INLINE_SYNTAX.search(content) or _BLOCK_SYNTAX.search(content):
+        return None
+
+    paragraphs = []
+    lines = []
+    for line in content.split("\n"):
+        if line.isspace() or not line:
+            if line.strip(" \t"):
+                return None # other whitespace alone on a line
+            if lines:
+                paragraphs.append("\n".join(lines).rstrip(" \t"))
+                lines = []
+            continue
+        # a paragraph's first line loses its spaces, continuation lines all leading whitespace
+        line = line.lstrip() if lines else line.lstrip(" ")
+        lines.append(line.rstrip(" "))
+    if lines:
+        paragraphs.append("\n".join(lines).rstrip(" \t"))
+    return escape_markup("\n\n".join(paragraphs)).strip()
+
 
 class MistuneProcessor:
 
-    def __init__(self):
+    def __init__(self, render_pool: RenderPool = None):
         self.renderer = MarkdownToBBCodeParser()
+        self.block_renderer = MarkdownToBlocks()
+        self.render_pool = render_pool
 
     def process(self, content: str, role: str):
 
         if role == Roles.ASSISTANT:
 
-            processed = self.renderer.parse(content)
+            blocks = content.count("\n") >= BBCodeRenderer.full_highlight_lines # too tall for one Label
+
+            processed = plain_markup(content)
+            if processed is not None:
+                metrics.incr("render.fast_path.hit")
+                return plain_blocks(processed) if blocks else processed
+            metrics.incr("render.fast_path.miss")
+
+            if self.render_pool is not None and self.render_pool.wants(content):
+                return self.render_pool.submit(content, blocks=blocks)
 
             try:
-                processed = self.renderer.parse(content)
+                processed = self.block_renderer.parse(content) if blocks else self.renderer.parse(content)
             except Exception as e:
                 print(f"MistuneException")
                 print(e)
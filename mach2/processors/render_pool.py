@@ -0,0 +1,107 @@
+#
+# Render large messages in worker processes.
+#
+# Pygments lexing is pure Python, so highlighting a long code dump holds the
+# GIL and a thread pool would not keep the UI responsive.  The RenderPool runs
+# the Markdown to BBCode renderer in a pool of processes that are started and
+# warmed up (mistune and pygments imported, a sample rendered) when the pool is
+# created, so the first large message does not pay for process start-up.
+#
+# The workers render either a markup string or, for the Block Processor, a list
+# of Blocks.
+#
+# Content shorter than the threshold is not worth the pickling round trip and
+# is rendered in-process by the caller.
+#
+# Until a worker's result arrives, the message shows preview_markup(): the
+# start of the content, escaped, and a note.  Showing the raw content instead
+# would build a texture of all of it on the main thread, and would read any
+# "[b]" in it as a markup tag.
+#
+# Workers are spawned rather than forked: forking a process that has a GL
+# context and running threads is not safe.
+#
+
+import os
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from ..renderers.kivy_pygments_bbcode import escape_markup
+
+
+WARMUP_SAMPLE = """# Warm up
+
+Some **bold** and *italic* text with `code`.
+
+```python
+def warm():
+    return [1, 2, 3]
+```
+"""
+
+PREVIEW_CHARS = 2000
+PREVIEW_LINES = 20
+
+_parser = None # the worker's MarkdownToBBCodeParser
+_block_parser = None # and MarkdownToBlocks
+
+
+def _warm_worker():
+    """Process initializer: import and exercise the renderer once"""
+    global _parser, _block_parser
+    os.environ.setdefault("KIVY_NO_ARGS", "1")
+    os.environ.setdefault("KIVY_NO_CONSOLELOG", "1")
+    from ..renderers.kivy_mistune_bbcode import MarkdownToBBCodeParser
+    from ..renderers.kivy_blocks import MarkdownToBlocks
+    _parser = MarkdownToBBCodeParser()
+    _parser.parse(WARMUP_SAMPLE)
+    _block_parser = MarkdownToBlocks()
+
+
+def _render(content: str) -> str:
+    return _parser.parse(content)
+
+
+def _render_blocks(content: str) -> list:
+    return _block_parser.parse(content)
+
+
+def preview_markup(content: str, note: str = "rendering...") -> str:
+    """Kivy markup of the first lines of content, escaped, followed by a note"""
+    preview = "\n".join(content[:PREVIEW_CHARS].split("\n")[:PREVIEW_LINES]).rstrip()
+    return f"{escape_markup(preview)}\n[color=#888888][i]{note}[/i][/color]"
+
+
+def _ready() -> int:
+    return os.getpid()
+
+
+class RenderPool:
+    """
+    A pool of warm renderer processes.
+
+    Args:
+        workers: number of processes
+        threshold: content shorter than this many characters should be rendered in-process
+    """
+
+    def __init__(self, workers: int = 2, threshold: int = 16 * 1024):
+        self.workers = workers
+        self.threshold = threshold
+        self._executor = ProcessPoolExecutor(max_workers=workers,
+                                             mp_context=multiprocessing.get_context("spawn"),
+                                             initializer=_warm_worker)
+        # start every worker now rather than on the first large message
+        for i in range(workers):
+            self._executor.submit(_ready)
+
+    def wants(self, content: str) -> bool:
+        """True if content is large enough to render in the pool"""
+        return len(content) >= self.threshold
+
+    def submit(self, content: str, blocks: bool = False) -> Future:
+        """Render content in a worker.  The Future's result is the BBCode string, or with blocks the list of Blocks."""
+        return self._executor.submit(_render_blocks if blocks else _render, content)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
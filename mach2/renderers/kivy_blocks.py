@@ -0,0 +1,191 @@
+#
+# Markdown to a column of blocks, for block layout instead of one markup string.
+#
+# The BBCode renderer turns a whole response into one Kivy markup string, and
+# the Label re-parses all of it whenever it re-wraps.  Markup can only indent
+# the first line of a list item, and a code block wraps like prose.
+#
+# MarkdownToBlocks walks the mistune AST and emits one Block per paragraph,
+# heading, list item, code block, table or rule.  A code block longer than
+# BBCodeRenderer.full_highlight_lines is too tall for one texture and becomes a
+# "listing" instead: its quick_highlight markup, one string per line.  A long
+# paragraph is split into text blocks of at most TEXT_BLOCK_LINES lines, at
+# line breaks outside any inline markup, and a long reply with no Markdown at
+# all (plain_blocks) is a listing of its lines.  Inline text (emphasis, links,
+# code spans) is still rendered by the BBCode renderer, but only within its
+# block.  Each block is shown by its own widget (widgets/rich_text_view.py), so:
+#
+#   - list items and nested content are indented as a whole
+#   - code blocks are not wrapped and keep their texture when the bubble is resized
+#   - tables and listings only lay out the rows on screen
+#   - a block that did not change is not rendered again when a message is updated
+#
+# Blocks are small frozen dataclasses: they can be compared, hashed to find the
+# widget already showing them, and pickled back from the render pool.
+#
+
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import mistune
+from mistune.core import BlockState
+
+from .kivy_mistune_bbcode import BBCodeRenderer, SQUAREROOT, ENQUAD, markup_text
+from .kivy_pygments_bbcode import escape_markup
+from .quick_highlight import quick_highlight
+from ..metrics import metrics
+
+
+TEXT_BLOCK_LINES = 100 # lines of a paragraph in one text block
+
+
+@dataclass(frozen=True)
+class Block:
+    """One block of a rendered message"""
+    kind: str # "text", "code", "listing", "table" or "rule"
+    markup: str = "" # Kivy markup of the block's text
+    indent: int = 0 # nesting depth of lists and their content
+    size: Optional[int] = None # font size in sp of a heading
+    quote: bool = False # inside a block quote
+    cells: Tuple[Tuple[str, ...], ...] = () # markup of a table's cells, by row, the head row first
+    align: Tuple[Optional[str], ...] = () # "left", "center", "right" or None for each table column
+    lines: Tuple[str, ...] = () # markup of each line of a listing
+    columns: int = 0 # characters in the longest line of a listing
+
+
+def plain_blocks(markup: str) -> List[Block]:
+    """
+    Blocks of a reply with no Markdown, given its escaped text: one text block,
+    or a listing of its lines if it is too tall for one texture.
+    """
+    lines = markup.split("\n")
+    if len(lines) <= BBCodeRenderer.full_highlight_lines:
+        return [ Block("text", markup) ]
+    metrics.incr("render.plain.listing")
+    return [ Block("listing", lines=tuple(lines), columns=max(len(markup_text(line)) for line in lines)) ]
+
+
+class MarkdownToBlocks:
+    """
+    Parse Markdown into a list of Blocks.
+
+    The parser is reentrant: all state of a parse lives in its own BlockState,
+    the same as for MarkdownToBBCodeParser.
+    """
+
+    def __init__(self):
+        self.inline = BBCodeRenderer() # renders the text inside each block
+        self.markdown = mistune.create_markdown(
+            renderer='ast',
+            plugins=[
+                'strikethrough',
+                'task_lists',
+                'url',
+                'abbr',
+                'table',
+            ]
+        )
+
+    def parse(self, markdown_text: str) -> List[Block]:
+        blocks = []
+        self._walk(self.markdown(markdown_text), BlockState(), blocks, 0, False)
+        return blocks
+
+    def _walk(self, tokens, state, blocks: List[Block], indent: int, quote: bool):
+        for token in tokens:
+            kind = token['type']
+
+            if kind in ('paragraph', 'block_text'):
+                self._paragraph(token, state, blocks, indent, quote)
+
+            elif kind == 'heading':
+                size = max(1, 21 - token['attrs']['level'])
+                blocks.append(Block("text", f"[b]{self._inline(token, state)}[/b]", indent, size, quote))
+
+            elif kind == 'block_code':
+                code = token['raw']
+                if code.count("\n") + 1 > self.inline.full_highlight_lines:
+                    blocks.append(self._listing(code, indent, quote))
+                else:
+                    blocks.append(Block("code", self._code(token, state), indent, quote=quote))
+
+            elif kind == 'block_quote':
+                self._walk(token['children'], state, blocks, indent, True)
+
+            elif kind == 'list':
+                self.inline._list_push(state, token['attrs'].get('ordered', False))
+                self._walk(token['children'], state, blocks, indent, quote)
+                self.inline._list_pop(state)
+
+            elif kind in ('list_item', 'task_list_item'):
+                self._list_item(token, state, blocks, indent, quote)
+
+            elif kind == 'table':
+                (align, rows) = self.inline._table_cells(token, state)
+                cells = tuple(tuple(row) for row in rows)
+                blocks.append(Block("table", indent=indent, quote=quote, cells=cells, align=tuple(align)))
+
+            elif kind == 'thematic_break':
+                blocks.append(Block("rule", indent=indent, quote=quote))
+
+            elif kind == 'blank_line':
+                continue
+
+            else: # anything else the BBCode renderer knows, or its raw text
+                try:
+                    markup = self.inline.render_token(token, state).strip()
+                except AttributeError:
+                    markup = escape_markup(token.get('raw', '')).strip()
+                if markup:
+                    blocks.append(Block("text", markup, indent, quote=quote))
+
+    def _list_item(self, token, state, blocks: List[Block], indent: int, quote: bool):
+        """The bullet goes on the item's first paragraph; the rest of the item is indented under it"""
+        self.inline._list_next(state)
+        if token['type'] == 'task_list_item':
+            bullet = f"&bl;{SQUAREROOT}&br;" if token['attrs'].get('checked') else f"&bl;{ENQUAD}&br;"
+        else:
+            bullet = self.inline._list_bullet(state)
+
+        children = token['children']
+        if children and children[0]['type'] in ('paragraph', 'block_text'):
+            blocks.append(Block("text", f"{bullet} {self._inline(children[0], state)}", indent, quote=quote))
+            children = children[1:]
+        else:
+            blocks.append(Block("text", bullet, indent, quote=quote))
+        self._walk(children, state, blocks, indent + 1, quote)
+
+    def _paragraph(self, token, state, blocks: List[Block], indent: int, quote: bool):
+        """
+        A paragraph as text blocks of at most TEXT_BLOCK_LINES lines each.  It
+        is split at its own line breaks, where no emphasis or link is open.
+        """
+        chunk = []
+        lines = 0
+        for child in token.get('children', ()):
+            chunk.append(child)
+            if child['type'] in ('softbreak', 'linebreak'):
+                lines += 1
+                if lines % TEXT_BLOCK_LINES == 0:
+                    blocks.append(Block("text", self._inline({ 'children': chunk }, state), indent, quote=quote))
+                    chunk = []
+        if chunk or not lines:
+            blocks.append(Block("text", self._inline({ 'children': chunk }, state), indent, quote=quote))
+
+    def _inline(self, token, state) -> str:
+        return self.inline.render_children(token, state).strip()
+
+    def _listing(self, code: str, indent: int, quote: bool) -> Block:
+        """A long code block as one markup line per line of code"""
+        metrics.incr("render.block_code.tier.listing")
+        lines = code.rstrip("\n").split("\n")
+        return Block("listing", indent=indent, quote=quote,
+                     lines=tuple(quick_highlight("\n".join(lines)).split("\n")),
+                     columns=max(len(line.expandtabs()) for line in lines))
+
+    def _code(self, token, state) -> str:
+        """Highlighted code, without the newline the formatter ends it with"""
+        markup = self.inline.block_code(token, state).rstrip("\n")
+        if markup.endswith("\n[/font]"):
+            markup = markup[:-len("\n[/font]")] + "[/font]"
+        return markup
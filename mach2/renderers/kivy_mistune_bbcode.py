@@ -12,8 +12,10 @@
 #
 # Tom Sheffler (c) 2025
 
+import re
+import string
 from typing import Any, Dict, List, Optional, cast
-from kivy.utils import escape_markup # "[" to "&lb;"
+from .kivy_pygments_bbcode import escape_markup # "[" to "&bl;", without importing Kivy
 import mistune
 from mistune import BaseRenderer
 from mistune.core import BlockState, InlineState
@@ -25,6 +27,10 @@ from pygments.lexers import get_lexer_by_name, TextLexer
 from .kivy_pygments_bbcode import KivyBBCodeFormatter
 from pygments.util import ClassNotFound
 
+# Huge code blocks get cheaper treatment
+from .quick_highlight import quick_highlight
+from ..metrics import metrics
+
 # likely Roboto special characters
 #    https://www.fileformat.info/info/unicode/font/roboto/grid.htm
 
@@ -36,6 +42,26 @@ EMQUAD = "\u2001" # space
 ENSP = "\u2002" # en space
 EMSP = "\u2003" # em space
 
+_MARKUP_TAG = re.compile(r"\[/?[a-z_]+(?:=[^\]]*)?\]")
+_MARKUP_ENTITY = re.compile(r"&(bl|br|amp);")
+_ENTITY_CHARS = { "bl": "[", "br": "]", "amp": "&" }
+
+
+def markup_text(markup: str) -> str:
+    """The text that Kivy markup displays: tags removed and escapes undone"""
+    return _MARKUP_ENTITY.sub(lambda m: _ENTITY_CHARS[m.group(1)], _MARKUP_TAG.sub("", markup))
+
+
+class ListState:
+    """Nesting of the lists being rendered, kept per parse in state.env"""
+    __slots__ = ("level", "ordered", "counter")
+
+    def __init__(self):
+        self.level = 0
+        self.ordered = [ False ]
+        self.counter = [ 0 ]
+
+
 class BBCodeRenderer(BaseRenderer):
     """
     Custom renderer that converts parsed Markdown tokens to BBCode format.
@@ -44,12 +70,43 @@ class BBCodeRenderer(BaseRenderer):
     from mistune and converts them to their BBCode equivalents.
     
     BaseRenderer methods use (token, state) signature pattern.
+
+    Code blocks up to full_highlight_lines long are highlighted with
+    Pygments, longer ones with quick_highlight.  That many lines at 13sp is
+    about 5,000 px, within the texture size that GL drivers allow, so the
+    processors give longer messages to the block renderer, which shows a
+    long code block as a list of lines (renderers/kivy_blocks.py).
+
+    Tables are aligned columns of monospace text, showing at most
+    table_max_rows rows.
     """
 
-    level = 0
-    ordered = [ False ]
-    counter = [ 0 ]
-    
+    full_highlight_lines = 300
+    table_max_rows = 200
+
+    # token types rendered by methods of this class
+    TOKEN_METHODS = (
+        "text", "block_text", "paragraph", "heading", "emphasis", "strong", "link", "image",
+        "codespan", "block_code", "block_quote", "list_item", "task_list_item", "list",
+        "strikethrough", "linebreak", "softbreak", "thematic_break", "blank_line", "table",
+    )
+
+    #
+    # The renderer holds no per-parse state: list nesting lives in the parse's
+    # state.env, so one renderer can serve parses in several threads and a
+    # parse that fails leaves nothing behind.
+    #
+
+    def __init__(self):
+        super().__init__()
+        self._dispatch = { name: getattr(self, name) for name in self.TOKEN_METHODS }
+
+    def render_token(self, token, state):
+        method = self._dispatch.get(token['type'])
+        if method is None:
+            method = self._get_method(token['type']) # registered by a plugin
+        return method(token, state)
+
     def render_children(self, token, state):
         """
         Helper method to render child tokens.
@@ -58,18 +115,24 @@ class BBCodeRenderer(BaseRenderer):
         if 'children' not in token:
             return ''
         
+        dispatch = self._dispatch
         children_output = []
         for child in token['children']:
-            # Get the method name for this token type
-            method_name = child['type']
-            if hasattr(self, method_name):
-                method = getattr(self, method_name)
+            method = dispatch.get(child['type'])
+            if method is not None:
                 children_output.append(method(child, state))
             elif 'raw' in child:
                 # Fallback for plain text tokens
                 children_output.append(child['raw'])
         
         return ''.join(children_output)
+
+    @staticmethod
+    def _lists(state) -> ListState:
+        lists = state.env.get('bbcode_lists')
+        if lists is None:
+            lists = state.env['bbcode_lists'] = ListState()
+        return lists
     
     def text(self, token, state):
         """Render plain text"""
@@ -117,13 +180,20 @@ class BBCodeRenderer(BaseRenderer):
     
     def codespan(self, token, state):
         """Convert `code` to [code]code[/code]"""
-        return f"[font=RobotoMono-Regular]{token['raw']}[/font]"
+        return f"[font=RobotoMono-Regular]{escape_markup(token['raw'])}[/font]"
     
     def block_code(self, token, state):
         """Convert code blocks to [code] blocks"""
         attrs = token.get("attrs", {})
         info = cast(str, attrs.get("info", ""))
         code = token['raw']
+
+        lines = code.count("\n") + 1
+        if lines > self.full_highlight_lines:
+            metrics.incr("render.block_code.tier.quick")
+            return "[font=RobotoMono-Regular]" + quick_highlight(code) + "[/font]\n"
+        metrics.incr("render.block_code.tier.full")
+
         if info:
             try:
                 lexer = get_lexer_by_name(info.strip())
@@ -145,40 +215,44 @@ class BBCodeRenderer(BaseRenderer):
         children = self.render_children(token, state)
         return f"[color=#4444AA][i]\n{children.rstrip()}\n[/i][/color]\n"
 
-    def _list_push(self, isOrdered):
-
-        self.level = self.level + 1
-        self.ordered.append(isOrdered)
-        self.counter.append(0)
-
-    def _list_pop(self):
-
-        self.level = self.level -1
-        self.ordered.pop()
-        self.counter.pop()
-        self.counter[-1] = 0
-
-    def _list_indent_prefix(self):
-        return ENSP * ((self.level-1) * 4)
-
-    def _list_bullet(self):
-
-        if self.ordered[-1]:
-            count = self.counter[-1]
-            if self.level == 1:
+    def _list_push(self, state, isOrdered):
+        lists = self._lists(state)
+        lists.level = lists.level + 1
+        lists.ordered.append(isOrdered)
+        lists.counter.append(0)
+
+    def _list_pop(self, state):
+        lists = self._lists(state)
+        lists.level = lists.level -1
+        lists.ordered.pop()
+        lists.counter.pop()
+        lists.counter[-1] = 0
+
+    def _list_indent_prefix(self, state):
+        return ENSP * ((self._lists(state).level-1) * 4)
+
+    def _list_next(self, state):
+        """Count the next item of the innermost list"""
+        lists = self._lists(state)
+        lists.counter[-1] = lists.counter[-1] + 1
+
+    def _list_bullet(self, state):
+        lists = self._lists(state)
+
+        if lists.ordered[-1]:
+            count = lists.counter[-1] # counts from 1
+            if lists.level == 1:
                 return f"[b]{count}.[/b]"
 
-            elif self.level == 2:
-                caps = "ABCDEFGHIJKLMNOPqRSTUVWZYZ"
-                letter = caps[count]
+            elif lists.level == 2:
+                letter = string.ascii_uppercase[(count - 1) % 26]
                 return f"[b]{letter}.[/b]"
 
-            elif self.level == 3:
+            elif lists.level == 3:
                 return f"[b]{count}.[/b]"
 
-            elif self.level == 4:
-                letters = "abcdefghijklmnopqrstuvwxyz"
-                letter = letter[count]
+            elif lists.level == 4:
+                letter = string.ascii_lowercase[(count - 1) % 26]
                 return f"[b]{letter}.[/b]"
 
             else:
@@ -192,16 +266,16 @@ class BBCodeRenderer(BaseRenderer):
     
     def list_item(self, token, state, **attrs):
         """Convert list items to [*] format"""
-        prefix = self._list_indent_prefix()
-        self.counter[-1] = self.counter[-1] + 1 # increment list counter
-        bullet = self._list_bullet()
+        prefix = self._list_indent_prefix(state)
+        self._list_next(state) # increment list counter
+        bullet = self._list_bullet(state)
         children = self.render_children(token, state)
         return f"{prefix}{bullet} {children.rstrip()}\n"
     
     def task_list_item(self, token, state):
         attrs = token.get("attrs", {})
-        prefix = self._list_indent_prefix()
-        self.counter[-1] = self.counter[-1] + 1
+        prefix = self._list_indent_prefix(state)
+        self._list_next(state)
         checked = attrs.get('checked', False)
         children = self.render_children(token, state)
         if checked:
@@ -213,12 +287,55 @@ class BBCodeRenderer(BaseRenderer):
     def list(self, token, state, **attrs):
         """Convert lists to BBCode list format"""
         ordered = token['attrs'].get('ordered', False)
-        self._list_push(ordered)
+        self._list_push(state, ordered)
         children = self.render_children(token, state)
-        self._list_pop()
+        self._list_pop(state)
         return f"\n{children.rstrip()}\n\n"
         # return f"\n[list]\n{children.rstrip()}\n[/list]\n"
     
+    def _table_cells(self, token, state):
+        """(align, rows) of a table: each row a list of cell markup, the head row first"""
+        align = []
+        rows = []
+        for part in token['children']:
+            if part['type'] == 'table_head':
+                align = [ cell['attrs'].get('align') for cell in part['children'] ]
+                rows.append([ self.render_children(cell, state).strip() for cell in part['children'] ])
+            else:
+                for row in part['children']:
+                    rows.append([ self.render_children(cell, state).strip() for cell in row['children'] ])
+        return (align, rows)
+
+    def table(self, token, state):
+        """Tables as aligned columns of monospace text"""
+        (align, rows) = self._table_cells(token, state)
+        hidden = max(0, len(rows) - 1 - self.table_max_rows)
+        if hidden:
+            rows = rows[:self.table_max_rows + 1]
+
+        lengths = [ [ len(markup_text(cell)) for cell in row ] for row in rows ]
+        widths = [ max(row[i] for row in lengths) for i in range(len(align)) ]
+
+        lines = []
+        for (r, row) in enumerate(rows):
+            cells = []
+            for (i, cell) in enumerate(row):
+                space = widths[i] - lengths[r][i]
+                if align[i] == 'right':
+                    cells.append(" " * space + cell)
+                elif align[i] == 'center':
+                    cells.append(" " * (space // 2) + cell + " " * (space - space // 2))
+                else:
+                    cells.append(cell + " " * space)
+            if r == 0:
+                lines.append("[b]" + " | ".join(cells) + "[/b]")
+                lines.append("-+-".join("-" * width for width in widths))
+            else:
+                lines.append(" | ".join(cells))
+        if hidden:
+            lines.append(f"[color=#888888][i]... {hidden:,} more rows (copy the message for the full table) ...[/i][/color]")
+        return "[font=RobotoMono-Regular]" + "\n".join(lines) + "[/font]\n\n"
+
     def strikethrough(self, token, state):
         """Convert ~~strike~~ to [s]strike[/s]"""
         children = self.render_children(token, state)
@@ -259,6 +376,7 @@ class MarkdownToBBCodeParser:
                 'task_lists',     # Support - [ ] and - [x]
                 'url',           # Auto-link URLs
                 'abbr',          # Abbreviations (if needed)
+                'table',         # Pipe tables
             ]
         )
     
@@ -1,53 +1,76 @@
 #
 # The Pygments BBCode formatter works very well to generate Kivy Markup with the exception
-# of the lack of escaping "[" characters in emitted code.  The solution is to use
-# the kivy escape_markup function to escape characters properly.
+# of the lack of escaping "[" characters in emitted code.  This specialization of Pygments
+# BBCodeFormatter overrides one method to insert the necessary escaping.
 #
-# This specialization of Pygments BBCodeFormatter overrides one method to insert the
-# necessary escaping.
+# Highlighted code can be megabytes long (JSON dumps, logs), so the formatter gathers
+# token values in lists and joins each style run once, escapes a whole run at a time,
+# and resolves each token type to its markup only the first time it is seen.  Types
+# with the same markup (most names, operators and whitespace are unstyled) make one
+# run.  The work is linear in the size of the code.
 #
 # Tom Sheffler 2025
 #
 
 from pygments.formatters import BBCodeFormatter
-from pygments.util import get_bool_opt
-from kivy.utils import escape_markup # "[" to "&lb;"
 
-__all__ = ['KivyBBCodeFormatter']
+__all__ = ['KivyBBCodeFormatter', 'escape_markup']
+
+
+def escape_markup(text: str) -> str:
+    """
+    Escape text for Kivy markup, as kivy.utils.escape_markup does.
+
+    Three str.replace passes: str.translate with multi-character replacements
+    is an order of magnitude slower on long runs.
+    """
+    return text.replace('&', '&amp;').replace('[', '&bl;').replace(']', '&br;')
 
 
 class KivyBBCodeFormatter(BBCodeFormatter):
 
     def format_unencoded(self, tokensource, outfile):
+        styles = self.styles
+        markup = {} # token type -> (start, end) of the nearest type with a style
+
+        parts = []
         if self._code:
-            outfile.write('[code]')
+            parts.append('[code]')
         if self._mono:
-            outfile.write('[font=monospace]')
+            parts.append('[font=monospace]')
 
-        lastval = ''
-        lasttype = None
+        run = []
+        lastmarkup = None
 
         for ttype, value in tokensource:
-            while ttype not in self.styles:
-                ttype = ttype.parent
-            if ttype == lasttype:
-                lastval += value
+            tokenmarkup = markup.get(ttype)
+            if tokenmarkup is None:
+                styletype = ttype
+                while styletype not in styles:
+                    styletype = styletype.parent
+                tokenmarkup = markup[ttype] = styles[styletype]
+            if tokenmarkup == lastmarkup:
+                run.append(value)
             else:
-                if lastval:
-                    # lastval = lastval.replace("[", "&bl;")
-                    lastval = escape_markup(lastval)
-                    start, end = self.styles[lasttype]
-                    outfile.write(''.join((start, lastval, end)))
-                lastval = value
-                lasttype = ttype
-
-        if lastval:
-            start, end = self.styles[lasttype]
-            outfile.write(''.join((start, lastval, end)))
+                _flush(parts, lastmarkup, run)
+                run = [ value ]
+                lastmarkup = tokenmarkup
+
+        _flush(parts, lastmarkup, run)
 
         if self._mono:
-            outfile.write('[/font]')
+            parts.append('[/font]')
         if self._code:
-            outfile.write('[/code]')
+            parts.append('[/code]')
         if self._code or self._mono:
-            outfile.write('\n')
+            parts.append('\n')
+
+        outfile.write(''.join(parts))
+
+
+def _flush(parts, markup, run):
+    """Append one run of same-styled token values, escaped, to parts"""
+    text = ''.join(run)
+    if text:
+        (start, end) = markup
+        parts.extend((start, escape_markup(text), end))
@@ -0,0 +1,54 @@
+#
+# Cheap coloring of code blocks that are too big for Pygments.
+#
+# quick_highlight() colors comments, strings, numbers and common keywords with
+# one regular expression, in the colors of the Pygments default style, without
+# any language knowledge.
+#
+# Every alternative of the expression stops at the end of a line, so a "/*"
+# that is never closed (a shell glob like "cp src/*.py build/") costs at most
+# the rest of its line; comments that span lines are colored only on their
+# first line.  It also means that no tag is open across a newline, so the
+# markup can be split into lines for the block view's line list.
+#
+
+import re
+from .kivy_pygments_bbcode import escape_markup # "[" to "&bl;", without importing Kivy
+
+
+KEYWORDS = (
+    "and as async await break case catch class const continue def default del elif else enum "
+    "except export extends false finally fn for from func function if impl import in interface "
+    "is let match mod new nil none not null or package pass private protected pub public raise "
+    "return self static struct switch this throw true try type var void while with yield"
+).split()
+
+_TOKENS = re.compile(r"""
+    (?P<comment> \#[^\n]* | //[^\n]* | /\*[^\n]*?\*/ )
+  | (?P<string>  "(?:[^"\\\n]|\\.)*" | '(?:[^'\\\n]|\\.)*' )
+  | (?P<number>  \b(?:0[xX][0-9a-fA-F]+|\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)\b )
+  | (?P<keyword> \b(?:""" + "|".join(KEYWORDS) + r""")\b )
+""", re.VERBOSE | re.IGNORECASE)
+
+STYLES = {
+    "comment": ("[color=#3D7B7B][i]", "[/i][/color]"),
+    "string": ("[color=#BA2121]", "[/color]"),
+    "number": ("[color=#666666]", "[/color]"),
+    "keyword": ("[color=#008000][b]", "[/b][/color]"),
+}
+
+
+def quick_highlight(code: str) -> str:
+    """Kivy markup for code, colored by a single regular expression"""
+    parts = []
+    last = 0
+    for match in _TOKENS.finditer(code):
+        (start, end) = match.span()
+        if start > last:
+            parts.append(escape_markup(code[last:start]))
+        (open_tag, close_tag) = STYLES[match.lastgroup]
+        parts.append(open_tag + escape_markup(match.group()) + close_tag)
+        last = end
+    parts.append(escape_markup(code[last:]))
+    return "".join(parts)
+
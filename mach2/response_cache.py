@@ -0,0 +1,269 @@
+#
+# Opt-in local cache of NLIP responses.
+#
+# Dashboards ask the same agents the same questions.  The cache keys a reply by
+# the endpoint and a normalized hash of the outgoing NLIP_Message, keeps it for a
+# TTL, and evicts the least recently used entry when full.  Entries are written
+# through to a directory so they survive restarts.  Replies can be several MB,
+# so the files are written behind, by one thread: the event loop only updates
+# the in-memory index, and writes, removals and touches of a file happen in the
+# order they were made.
+#
+# Server headers are honored when present:
+#   Cache-Control: no-store      the reply is not cached
+#   Cache-Control: max-age=N     overrides the default TTL
+#   Cache-Control: no-cache      the reply is cached but revalidated before use
+#   ETag                         a stale entry is revalidated with If-None-Match,
+#                                and a 304 answer refreshes it
+#
+
+import os
+import re
+import json
+import time
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from typing import Optional, Tuple
+
+import httpx
+from nlip_sdk.nlip import NLIP_Message
+
+from .nlip_decoder import NlipDecoder
+from .metrics import metrics
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".mach2", "response-cache")
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _normalize(value):
+    """Sort keys and collapse whitespace in text so trivially different queries match"""
+    if isinstance(value, dict):
+        return { k: _normalize(v) for k, v in sorted(value.items()) }
+    elif isinstance(value, list):
+        return [ _normalize(v) for v in value ]
+    elif isinstance(value, str):
+        return _WHITESPACE.sub(" ", value).strip()
+    else:
+        return value
+
+
+def cache_key(endpoint: str, msg: NLIP_Message) -> str:
+    canonical = json.dumps(_normalize(msg.to_dict()), separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(f"{endpoint}\n{canonical}".encode("utf-8")).hexdigest()
+
+
+def parse_cache_control(value: str) -> dict:
+    directives = {}
+    for part in value.split(","):
+        name, _, arg = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = arg.strip('"') if arg else True
+    return directives
+
+
+@dataclass
+class CacheEntry:
+    key: str
+    endpoint: str
+    body: str               # the reply as NLIP JSON
+    stored_at: float
+    expires_at: float
+    etag: Optional[str] = None
+
+    def is_fresh(self, now: float) -> bool:
+        return now < self.expires_at
+
+
+class ResponseCache:
+    """
+    TTL + LRU cache of NLIP replies, persisted in a directory.
+
+    Args:
+        directory: where entries are stored, or None for memory only
+        ttl: seconds a reply stays fresh when the server gives no max-age
+        max_entries: entries kept before the least recently used is evicted
+    """
+
+    def __init__(self, directory: Optional[str] = DEFAULT_CACHE_DIR, ttl: float = 300.0, max_entries: int = 256):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._writer = None # one thread, so file operations keep their order
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self._load()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _load(self):
+        """Load entries from disk, least recently used first"""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                path = os.path.join(self.directory, name)
+                files.append((os.path.getmtime(path), path))
+
+        for (mtime, path) in sorted(files)[-self.max_entries:]:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    entry = CacheEntry(**json.load(f))
+                self._entries[entry.key] = entry
+            except (OSError, ValueError, TypeError):
+                print(f"RESPONSE CACHE: dropping unreadable entry {path}")
+                os.remove(path)
+
+    def _write_behind(self, operation, *args):
+        if self._writer is None:
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache")
+        self._writer.submit(self._run, operation, *args)
+
+    @staticmethod
+    def _run(operation, *args):
+        try:
+            operation(*args)
+        except OSError as e:
+            print(f"RESPONSE CACHE: {e}")
+
+    def flush(self):
+        """Wait until the files written behind are on disk"""
+        if self._writer is not None:
+            self._writer.submit(lambda: None).result()
+
+    def _save(self, entry: CacheEntry):
+        if self.directory:
+            self._write_behind(self._write_file, self._path(entry.key), asdict(entry)) # a copy: refresh() changes the entry
+
+    @staticmethod
+    def _write_file(path: str, fields: dict):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(fields, f)
+        os.replace(tmp_path, path)
+
+    def _remove_file(self, key: str):
+        if self.directory:
+            self._write_behind(self._delete_file, self._path(key))
+
+    @staticmethod
+    def _delete_file(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            if self.directory:
+                self._write_behind(os.utime, self._path(key)) # LRU order survives a restart
+        return entry
+
+    def put(self, key: str, endpoint: str, body: str, response: httpx.Response) -> Optional[CacheEntry]:
+        """Store a reply, as allowed by the response headers.  Returns the entry or None."""
+        control = parse_cache_control(response.headers.get("cache-control", ""))
+        if "no-store" in control:
+            return None
+
+        now = time.time()
+        ttl = self._ttl(control)
+        etag = response.headers.get("etag")
+        if ttl <= 0 and etag is None:
+            return None # could never be used
+
+        entry = CacheEntry(key=key, endpoint=endpoint, body=body, stored_at=now, expires_at=now + ttl, etag=etag)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        self._save(entry)
+
+        while len(self._entries) > self.max_entries:
+            (old_key, old) = self._entries.popitem(last=False)
+            self._remove_file(old_key)
+            metrics.incr("cache.evict")
+
+        return entry
+
+    def refresh(self, entry: CacheEntry, response: httpx.Response):
+        """Extend an entry after a 304 Not Modified"""
+        control = parse_cache_control(response.headers.get("cache-control", ""))
+        entry.expires_at = time.time() + self._ttl(control)
+        self._save(entry)
+
+    def _ttl(self, control: dict) -> float:
+        if "no-cache" in control:
+            return 0
+        if "max-age" in control:
+            try:
+                return float(control["max-age"])
+            except ValueError:
+                pass
+        return self.ttl
+
+    def clear(self):
+        for key in list(self._entries):
+            self._remove_file(key)
+        self._entries.clear()
+
+
+class CachingNlipClient:
+    """
+    Answer repeated queries from a ResponseCache.  With no cache, every send
+    goes to the wrapped client.
+
+    Args:
+        client: the wrapped client; must provide async_exchange and base_url
+        cache: the ResponseCache, or None to disable caching
+    """
+
+    def __init__(self, client, cache: ResponseCache = None, decoder: NlipDecoder = None):
+        self.client = client
+        self.cache = cache
+        self.decoder = decoder or NlipDecoder()
+
+    @property
+    def base_url(self):
+        return self.client.base_url
+
+    async def async_probe(self):
+        return await self.client.async_probe()
+
+    async def async_send(self, msg: NLIP_Message) -> NLIP_Message:
+        (nlip_msg, cached) = await self.async_send_cached(msg)
+        return nlip_msg
+
+    async def async_send_cached(self, msg: NLIP_Message) -> Tuple[NLIP_Message, bool]:
+        """Send a message.  Returns (reply, True if the reply came from the cache)."""
+        if self.cache is None:
+            (nlip_msg, response) = await self.client.async_exchange(msg)
+            return (nlip_msg, False)
+
+        key = cache_key(self.base_url, msg)
+        entry = self.cache.get(key)
+
+        if entry is not None and entry.is_fresh(time.time()):
+            metrics.incr("cache.hit")
+            return (await self.decoder.async_decode(entry.body.encode("utf-8")), True)
+
+        headers = {}
+        if entry is not None and entry.etag:
+            headers["If-None-Match"] = entry.etag
+
+        try:
+            (nlip_msg, response) = await self.client.async_exchange(msg, headers=headers)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 304 and entry is not None:
+                metrics.incr("cache.revalidated")
+                self.cache.refresh(entry, e.response)
+                return (await self.decoder.async_decode(entry.body.encode("utf-8")), True)
+            raise
+
+        metrics.incr("cache.miss")
+        self.cache.put(key, self.base_url, response.content.decode("utf-8"), response)
+        return (nlip_msg, False)
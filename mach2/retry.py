@@ -0,0 +1,208 @@
+#
+# Resilient sending: retries with backoff, deadlines and optional hedging.
+#
+# ResilientNlipClient wraps an NLIP client (anything with an async_exchange) and
+# retries transport failures and overload responses with exponential backoff
+# and full jitter.  Every attempt of one logical send carries the same
+# Idempotency-Key header, so a server that honors it performs the work once
+# even when a retry or a hedge races an earlier attempt.
+#
+# With a backup client configured, a send that has not answered within the
+# observed p95 latency is hedged: the same message (same key) goes to the
+# backup endpoint and whichever answers first wins.  Time the primary spends
+# waiting for the user to give credentials (a login or bearer popup) does not
+# count: the hedge delay starts again once they have been given.
+#
+
+import time
+import uuid
+import random
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import httpx
+from nlip_sdk.nlip import NLIP_Message
+
+from .metrics import metrics
+
+
+# responses that mean "try again later" rather than "this request is wrong"
+RETRYABLE_STATUS = { 408, 429, 502, 503, 504 }
+
+
+@dataclass
+class RetryPolicy:
+    """
+    Args:
+        max_attempts: attempts per send, including the first
+        backoff_base: delay before the first retry, doubled for each later one
+        backoff_max: upper bound of a single backoff delay
+        connect_timeout: deadline for establishing a connection
+        read_timeout: deadline between bytes of the response
+        total_timeout: deadline for the whole send, across all attempts
+        hedge_delay: seconds before hedging to the backup endpoint.  None uses
+            the p95 of recent latencies once hedge_min_samples are available.
+        hedge_min_samples: latencies needed before an adaptive hedge is sent
+    """
+    max_attempts: int = 3
+    backoff_base: float = 0.5
+    backoff_max: float = 8.0
+    connect_timeout: float = 10.0
+    read_timeout: float = 120.0
+    total_timeout: float = 300.0
+    hedge_delay: Optional[float] = None
+    hedge_min_samples: int = 20
+
+    def backoff(self, attempt: int) -> float:
+        """Full-jitter exponential backoff before retry number `attempt` (1-based)"""
+        ceiling = min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1)))
+        return random.uniform(0, ceiling)
+
+    def timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(self.read_timeout, connect=self.connect_timeout)
+
+
+def is_retryable(e: Exception) -> bool:
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in RETRYABLE_STATUS
+    return isinstance(e, httpx.TransportError)
+
+
+def retry_after(e: Exception) -> Optional[float]:
+    """Seconds requested by a Retry-After header, if any"""
+    if not isinstance(e, httpx.HTTPStatusError):
+        return None
+    value = e.response.headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class ResilientNlipClient:
+    """
+    Retry, deadline and hedging policy around an NLIP client.
+
+    Args:
+        client: the primary client
+        policy: the RetryPolicy
+        backup: an optional client for a backup endpoint used for hedging
+    """
+
+    def __init__(self, client, policy: RetryPolicy = None, backup = None):
+        self.client = client
+        self.policy = policy or RetryPolicy()
+        self.backup = backup
+        self._latencies = deque(maxlen=200)
+
+    @property
+    def base_url(self):
+        return self.client.base_url
+
+    def hedge_delay(self) -> Optional[float]:
+        if self.backup is None:
+            return None
+        if self.policy.hedge_delay is not None:
+            return self.policy.hedge_delay
+        if len(self._latencies) < self.policy.hedge_min_samples:
+            return None
+        samples = sorted(self._latencies)
+        return samples[int(len(samples) * 0.95) - 1]
+
+    async def async_probe(self):
+        """Probe the primary endpoint, warming the backup alongside it"""
+        timeout = self.policy.connect_timeout
+        if self.backup is None:
+            return await self.client.async_probe(timeout=timeout)
+
+        (result, backup_result) = await asyncio.gather(self.client.async_probe(timeout=timeout),
+                                                       self.backup.async_probe(timeout=timeout),
+                                                       return_exceptions=True)
+        if isinstance(backup_result, Exception):
+            print(f"BACKUP PROBE FAILED:{backup_result!r}")
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def async_send(self, msg: NLIP_Message, headers: dict = None) -> NLIP_Message:
+        (nlip_msg, response) = await self.async_exchange(msg, headers)
+        return nlip_msg
+
+    async def async_exchange(self, msg: NLIP_Message, headers: dict = None):
+        """Send with the retry policy.  Returns (reply, httpx.Response)."""
+        headers = dict(headers or {})
+        headers["Idempotency-Key"] = str(uuid.uuid4())
+
+        async with asyncio.timeout(self.policy.total_timeout):
+            attempt = 1
+            while True:
+                try:
+                    return await self._send_once(msg, headers)
+                except Exception as e:
+                    if attempt >= self.policy.max_attempts or not is_retryable(e):
+                        raise
+                    delay = retry_after(e)
+                    if delay is None:
+                        delay = self.policy.backoff(attempt)
+                    print(f"RETRY {attempt} after {delay:.2f}s:{e!r}")
+                    metrics.incr("send.retry")
+                    await asyncio.sleep(delay)
+                    attempt += 1
+
+    async def _timed_send(self, client, msg: NLIP_Message, headers: dict):
+        start = time.perf_counter()
+        result = await client.async_exchange(msg, headers=headers, timeout=self.policy.timeout())
+        elapsed = time.perf_counter() - start
+        if client is self.client:
+            self._latencies.append(elapsed)
+        metrics.observe("send.latency", elapsed)
+        return result
+
+    async def _wait_for_credentials(self) -> bool:
+        """Wait while the primary client asks the user for credentials.  Returns True if it was."""
+        wait = getattr(self.client, "wait_for_credentials", None)
+        return wait is not None and await wait()
+
+    async def _send_once(self, msg: NLIP_Message, headers: dict):
+        delay = self.hedge_delay()
+        if delay is None:
+            return await self._timed_send(self.client, msg, headers)
+
+        primary = asyncio.create_task(self._timed_send(self.client, msg, headers))
+        hedge = None
+        try: # both tasks belong to this send, also when it times out or is cancelled
+            while True:
+                done, _ = await asyncio.wait({primary}, timeout=delay)
+                if done:
+                    return primary.result()
+                if not await self._wait_for_credentials():
+                    break
+
+            print(f"HEDGING to {self.backup.base_url} after {delay:.2f}s")
+            metrics.incr("send.hedge")
+            hedge = asyncio.create_task(self._timed_send(self.backup, msg, headers))
+
+            pending = {primary, hedge}
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            metrics.incr("send.hedge.won")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
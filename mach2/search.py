@@ -0,0 +1,128 @@
+#
+# Full-text search over the conversation.
+#
+# The index is fed incrementally: it observes the MessageService and adds each
+# message as it is created.  search() returns message ids, newest first.  All
+# words of a query must match; the last word also matches as a prefix, so
+# results follow the user while they type.
+#
+# SQLite's FTS5 module is used when the sqlite3 library has it.  Otherwise an
+# in-process inverted index gives the same results.
+#
+
+import re
+import bisect
+import sqlite3
+from typing import Dict, List
+
+from .models import Message
+
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN.findall(text.lower())
+
+
+def has_fts5() -> bool:
+    try:
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE VIRTUAL TABLE probe USING fts5(x)")
+        conn.close()
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+class Fts5SearchIndex:
+    """Search index in an in-memory SQLite FTS5 table"""
+
+    name = "fts5"
+
+    def __init__(self):
+        self._conn = sqlite3.connect(":memory:")
+        self._conn.execute("CREATE VIRTUAL TABLE messages USING fts5(content, message_id UNINDEXED, tokenize='unicode61')")
+
+    def add(self, message: Message):
+        self._conn.execute("INSERT INTO messages (content, message_id) VALUES (?, ?)", (message.content, message.id))
+
+    def search(self, query: str, limit: int = 100) -> List[str]:
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        # quote each word so FTS5 operators in the query are taken literally
+        terms = [ f'"{t}"' for t in tokens[:-1] ] + [ f'"{tokens[-1]}"*' ]
+        rows = self._conn.execute("SELECT message_id FROM messages WHERE messages MATCH ? ORDER BY rowid DESC LIMIT ?",
+                                  (" ".join(terms), limit))
+        return [ row[0] for row in rows ]
+
+    def clear(self):
+        self._conn.execute("DELETE FROM messages")
+
+    def __len__(self):
+        return self._conn.execute("SELECT count(*) FROM messages").fetchone()[0]
+
+
+class InvertedSearchIndex:
+    """Search index in Python dictionaries, used when FTS5 is unavailable"""
+
+    name = "inverted"
+
+    def __init__(self):
+        self._ids: List[str] = []  # message ids by insertion order
+        self._postings: Dict[str, List[int]] = {}  # word -> ascending positions in _ids
+        self._vocabulary: List[str] = []  # sorted words, for prefix lookups
+
+    def add(self, message: Message):
+        position = len(self._ids)
+        self._ids.append(message.id)
+        for token in set(tokenize(message.content)):
+            postings = self._postings.get(token)
+            if postings is None:
+                self._postings[token] = [position]
+                bisect.insort(self._vocabulary, token)
+            else:
+                postings.append(position)
+
+    def _prefix_matches(self, prefix: str) -> set:
+        matches = set()
+        i = bisect.bisect_left(self._vocabulary, prefix)
+        while i < len(self._vocabulary) and self._vocabulary[i].startswith(prefix):
+            matches.update(self._postings[self._vocabulary[i]])
+            i += 1
+        return matches
+
+    def search(self, query: str, limit: int = 100) -> List[str]:
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        sets = []
+        for token in tokens[:-1]:
+            postings = self._postings.get(token)
+            if not postings:
+                return []
+            sets.append(postings)
+        sets.sort(key=len)
+        prefix = self._prefix_matches(tokens[-1])
+        if not prefix:
+            return []
+
+        found = prefix.intersection(*sets) if sets else prefix
+        return [ self._ids[p] for p in sorted(found, reverse=True)[:limit] ]
+
+    def clear(self):
+        self._ids.clear()
+        self._postings.clear()
+        self._vocabulary.clear()
+
+    def __len__(self):
+        return len(self._ids)
+
+
+def create_search_index(backend: str = None):
+    """A search index using FTS5 when available, or the named backend ("fts5" or "inverted")"""
+    if backend == "inverted" or (backend is None and not has_fts5()):
+        return InvertedSearchIndex()
+    return Fts5SearchIndex()
@@ -1,7 +1,9 @@
 import os
 import asyncio
 import random
-from typing import List, Callable, Optional
+from concurrent.futures import Future
+from collections import OrderedDict
+from typing import List, Callable, Optional, Set
 
 # import NLIP
 from nlip_sdk.nlip import NLIP_Factory
@@ -12,12 +14,17 @@ from . import utils
 from .models import Message
 from .nlip_async_client import NlipAsyncClient
 from .authenticating_nlip_async_client import AuthenticatingNlipAsyncClient
+from .compression import EndpointCompression
+from .credentials import CredentialCache
+from .retry import RetryPolicy, ResilientNlipClient
+from .response_cache import ResponseCache, CachingNlipClient
+from .metrics import metrics
+from .stall_profiler import working_on
+from .message_store import MessageStore, message_size
 from .processors.plain_processor import PlainProcessor
 from .processors.mistune_processor import MistuneProcessor
-
-# login popup
-from .widgets.login_popup import LoginPopup, LoginCredentials
-from .widgets.bearer_popup import BearerPopup, BearerCredentials
+from .processors.block_processor import BlockProcessor
+from .processors.render_pool import RenderPool, preview_markup
 
 #
 # Mock Chat Bot Service delivers canned responses.
@@ -61,11 +68,10 @@ class MockChatBotService:
         scheme = parsed_url.scheme
         netloc = parsed_url.netloc
 
-        # Establish the URL and return a connection message
-        await asyncio.sleep(1.0)
+        # Establish the URL and return a connection message.  Nothing is contacted.
         # self.client = NlipAsyncClient.create_from_url(f"{scheme}://{netloc}/nlip/")   
         self.client = AuthenticatingNlipAsyncClient.create_from_url(f"{scheme}://{netloc}/nlip/")   
-        return f"Connected to {scheme}://{netloc}/"
+        return f"Connected to {scheme}://{netloc}/ (mock)"
                 
     
     def generate_response_to_text(self, user_message: Message) -> str:
@@ -86,6 +92,8 @@ class MockChatBotService:
     
     def generate_response_to_image(self, user_message: Message) -> str:
         """Generate a response to an image message"""
+        if len(user_message.image_paths) > 1:
+            return f"Thanks for the {len(user_message.image_paths)} images!"
         filename = os.path.basename(user_message.image_path) if user_message.image_path else ""
         file_ext = filename.split('.')[-1].lower() if '.' in filename else ""
         
@@ -98,65 +106,48 @@ class MockChatBotService:
         else:
             return random.choice(self._image_responses)
 
-    # return text response and None image path
-    async def generate_response(self, user_message: Message) -> (str, Optional[str]):
+    # return text response, no image paths and not-cached
+    async def generate_response(self, user_message: Message) -> (str, List[str], bool):
         """Generate appropriate response based on message type"""
-        image_path = None
+        image_paths = []
         await asyncio.sleep(1.0)
 
         if user_message.message_type == "text":
-            return (self.generate_response_to_text(user_message), image_path)
+            return (self.generate_response_to_text(user_message), image_paths, False)
         elif user_message.message_type == "image":
-            return (self.generate_response_to_image(user_message), image_path)
+            return (self.generate_response_to_image(user_message), image_paths, False)
         else:
-            return ("I received your message!", image_path)
+            return ("I received your message!", image_paths, False)
+
+    async def send(self, user_message: Message) -> (str, List[str], bool):
+        return await self.generate_response(user_message)
 
 
 #
 # NLIP Chat Bot Service sends/receives messages to an NLIP Server.
 # Server credentials must be set before use.
 #
-
-def on_login_elicitation(client):
-
-    print(f"SERVICES: ON_BASIC_ELICIATION:{client}")
-
-    from asyncio import Future
-    future = Future()
-
-    def handle_login_result(credentials: LoginCredentials):
-        username = credentials.username
-        password = credentials.password
-        future.set_result((username, password))
-
-    popup = LoginPopup(on_login_callback=handle_login_result)
-    popup.open()
-
-    return future
-
-def on_bearer_elicitation(client):
-
-    print(f"SERVICES: ON_BEARER_ELICIATION:{client}")
-
-    from asyncio import Future
-    future = Future()
-
-    def handle_bearer_result(credentials: BearerCredentials):
-        bearer = credentials.bearer
-        future.set_result(bearer)
-
-    popup = BearerPopup(on_bearer_callback=handle_bearer_result)
-    popup.open()
-
-    return future
-
-
+# Credentials a server asks for are obtained from the elicitation callbacks,
+# which take the client and return an awaitable: the chat app opens a popup,
+# the batch client (batch.py) answers from the environment or a file.  This
+# module does not depend on Kivy.
+#
 
 class NlipChatBotService:
     """Service: Handles chatbot response generation"""
     
-    def __init__(self):
+    def __init__(self, compression: EndpointCompression = None, credential_cache: CredentialCache = None,
+                 retry_policy: RetryPolicy = None, backup_url: str = None, response_cache: ResponseCache = None,
+                 on_login_elicitation: Callable = None, on_bearer_elicitation: Callable = None):
         self.client = None
+        self.compression = compression or EndpointCompression()
+        # kept across reconnects so known servers are not challenged again
+        self.credential_cache = credential_cache or CredentialCache()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.backup_url = backup_url # optional endpoint for hedged requests
+        self.response_cache = response_cache # opt-in, None disables
+        self.on_login_elicitation = on_login_elicitation # client -> awaitable (username, password)
+        self.on_bearer_elicitation = on_bearer_elicitation # client -> awaitable bearer token
         
     #
     # Make a connection and return a status string
@@ -169,57 +160,91 @@ class NlipChatBotService:
         scheme = parsed_url.scheme
         netloc = parsed_url.netloc
 
-        # Establish the URL and return a connection message
-        await asyncio.sleep(1.0)
         # self.client = NlipAsyncClient.create_from_url(f"{scheme}://{netloc}/nlip/")   
-        self.client = AuthenticatingNlipAsyncClient.create_from_url(f"{scheme}://{netloc}/nlip/")
+        primary = self._create_client(f"{scheme}://{netloc}/nlip/")
+        backup = None
+        if self.backup_url:
+            parsed_backup = urlparse(self.backup_url)
+            backup = self._create_client(f"{parsed_backup.scheme}://{parsed_backup.netloc}/nlip/")
+        client = CachingNlipClient(ResilientNlipClient(primary, self.retry_policy, backup=backup), self.response_cache)
+
+        # Probe the server so that a bad URL is reported now, and the connection
+        # (DNS, TCP, TLS) is already open when the first message is sent.
+        (status, rtt) = await client.async_probe()
+        metrics.observe("connect.probe", rtt)
+        self.client = client
+        return f"Connected to {scheme}://{netloc}/ (HTTP {status}, {rtt * 1000:.0f} ms)"
+
+    def _create_client(self, endpoint: str):
+        client = AuthenticatingNlipAsyncClient.create_from_url(endpoint,
+                                                               compression=self.compression.settings_for(endpoint),
+                                                               credential_cache=self.credential_cache)
         # register credential callbacks
-        self.client.on_login_requested(on_login_elicitation)
-        self.client.on_bearer_requested(on_bearer_elicitation)
-        return f"Connected to {scheme}://{netloc}/"
+        client.on_login_requested(self.on_login_elicitation)
+        client.on_bearer_requested(self.on_bearer_elicitation)
+        return client
 
     def error_connection_response(self):
         msg = f"[b]No connection to server[/b].\nPlease enter http://hostname:port/ information"
         return msg
                 
     
-    async def generate_response(self, user_message: Message) -> (str, Optional[str]):
+    # return text response, image paths, and whether the response came from the cache
+    async def generate_response(self, user_message: Message) -> (str, List[str], bool):
 
         # make sure the client is created
         if (self.client is None):
             msg = self.error_connection_response()
-            return (msg, None)
-        
-        nlip_message = utils.messageToNlipMessage(user_message)
+            return (msg, [], False)
 
-        resp = None
         try:
-            resp = await self.client.async_send(nlip_message)
+            return await self.send(user_message)
         except Exception as e:
-            err = f"Error:{e}"
-
-        if resp:
-            (content, image_path) = utils.nlipMessageExtractParts(resp)
-        else:
             # TODO: use NLIP Parts more effectively to signify errors
-            content = err
-            image_path = None
+            return (f"Error:{e}", [], False)
 
-        return (content, image_path)
+    # like generate_response, but raises when the message could not be sent
+    async def send(self, user_message: Message) -> (str, List[str], bool):
+        # attachments are encoded and decoded off the event loop
+        nlip_message = await asyncio.to_thread(utils.messageToNlipMessage, user_message)
+        (resp, cached) = await self.client.async_send_cached(nlip_message)
+        (content, image_paths) = await asyncio.to_thread(utils.nlipMessageExtractParts, resp)
+        return (content, image_paths, cached)
 
 # Services
 class MessageService:
-    """Service: Manages message operations and state"""
+    """
+    Service: Manages message operations and state
+
+    With a memory_budget (bytes), messages are written through to the store and
+    the least recently used ones beyond the budget are evicted to stubs; the
+    keep_recent most recently used messages, and those the view has marked with
+    keep_in_view(), are never evicted.  The budget can be exceeded when those
+    alone are larger than it.
+    """
     
-    def __init__(self, processor_name: str):
+    def __init__(self, processor_name: str, memory_budget: int = 0, store: MessageStore = None,
+                 keep_recent: int = 20, render_pool: RenderPool = None):
         self._messages: List[Message] = []
+        self._by_id = {}
         self._message_counter = 0
         self._observers: List[Callable[[Message], None]] = []
+        self._eviction_observers: List[Callable[[Message], None]] = []
+        self._update_observers: List[Callable[[Message], None]] = []
+
+        self.memory_budget = memory_budget
+        self.store = store if store is not None else (MessageStore() if memory_budget else None)
+        self.keep_recent = keep_recent
+        self._resident: "OrderedDict[str, int]" = OrderedDict() # id -> bytes, least recently used first
+        self._resident_bytes = 0
+        self._in_view: Set[str] = set() # not evicted while they are near the viewport
 
         if processor_name == 'plain':
             self.processor = PlainProcessor()
+        elif processor_name == 'blocks':
+            self.processor = BlockProcessor(render_pool=render_pool)
         else:
-            self.processor = MistuneProcessor()
+            self.processor = MistuneProcessor(render_pool=render_pool)
     
     def add_observer(self, callback: Callable[[Message], None]):
         """Subscribe to message events"""
@@ -234,52 +259,212 @@ class MessageService:
         """Notify all observers of new messages"""
         for observer in self._observers:
             observer(message)
+
+    def add_update_observer(self, callback: Callable[[Message], None]):
+        """Subscribe to messages whose markup arrived after they were created"""
+        self._update_observers.append(callback)
+
+    def _format(self, message: Message):
+        """
+        Render the markup, or the blocks, of a message.  Markup rendered in the
+        background arrives later and is announced to the update observers.
+        """
+        formatted = self.processor.process(message.content, message.role)
+        if not isinstance(formatted, Future):
+            self._set_formatted(message, formatted)
+            return
+
+        message.formatted = preview_markup(message.content) # until rendered
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError: # no event loop to deliver it later
+            self._set_formatted(message, formatted.result())
+            return
+        formatted.add_done_callback(lambda f: loop.call_soon_threadsafe(self._on_formatted, message, f))
+
+    @staticmethod
+    def _set_formatted(message: Message, formatted):
+        """A processor returns a markup string, a list of Blocks, or None"""
+        if isinstance(formatted, list):
+            message.blocks = formatted
+            message.formatted = None # not the preview
+        else:
+            message.formatted = formatted
+
+    def _on_formatted(self, message: Message, future: Future):
+        try:
+            formatted = future.result()
+        except Exception as e:
+            print(f"RENDER FAILED:{message.id}:{e}")
+            content = self.store.get(message.id).content if message.evicted else message.content
+            formatted = preview_markup(content, "could not be rendered, copy the message for the full text")
+
+        if message.evicted: # only the stored copy needs it
+            stored = self.store.get(message.id)
+            stored.formatted = None if isinstance(formatted, list) else formatted # blocks are not stored
+            self.store.put(stored)
+            return
+
+        self._set_formatted(message, formatted)
+        if self.store is not None:
+            self.store.put(message)
+        if message.id in self._resident:
+            self._set_resident(message.id, message_size(message))
+        with working_on(message.id):
+            for observer in self._update_observers:
+                observer(message)
+        self._enforce_budget()
+
+    def add_eviction_observer(self, callback: Callable[[Message], None]):
+        """Subscribe to messages being reduced to stubs"""
+        self._eviction_observers.append(callback)
+
+    def _add_message(self, message: Message):
+        self._messages.append(message)
+        self._by_id[message.id] = message
+        if self.store is not None:
+            self.store.put(message)
+        self._set_resident(message.id, message_size(message))
+        self._notify_observers(message)
+        self._enforce_budget()
     
-    def create_text_message(self, content: str, role:str = "user") -> Message:
+    def create_text_message(self, content: str, role:str = "user", cached: bool = False) -> Message:
         """Create a new text message"""
         self._message_counter += 1
 
-        formatted = self.processor.process(content, role)
-
         message = Message(
             id=f"msg_{self._message_counter}",
             content=content,
-            formatted=formatted,
+            formatted=None,
             message_type="text",
-            role=role
+            role=role,
+            cached=cached
         )
-        self._messages.append(message)
-        self._notify_observers(message)
+        with working_on(message.id):
+            self._format(message)
+            self._add_message(message)
         return message
     
-    def create_image_message(self, content: str, image_path: str, role: str = "user") -> Message:
-        """Create a new image message"""
+    def create_image_message(self, content: str, image_paths: List[str], role: str = "user", cached: bool = False) -> Message:
+        """Create a new image message with one or more images"""
         self._message_counter += 1
 
-        formatted = self.processor.process(content, role)
-
         message = Message(
             id=f"msg_{self._message_counter}",
             content=content,
-            formatted=formatted,
+            formatted=None,
             message_type="image",
-            image_path=image_path,
-            role=role
+            image_paths=list(image_paths),
+            role=role,
+            cached=cached
         )
-        self._messages.append(message)
-        self._notify_observers(message)
+        with working_on(message.id):
+            self._format(message)
+            self._add_message(message)
         return message
     
-    def get_all_messages(self) -> List[Message]:
-        """Get all messages"""
+    def restore_messages(self, messages: List[Message]):
+        """Add messages from an archive, renumbered after the current ones"""
+        for message in messages:
+            self._message_counter += 1
+            message.id = f"msg_{self._message_counter}"
+            if message.formatted is None:
+                self._format(message)
+            self._add_message(message)
+
+    #
+    # Memory budget
+    #
+
+    def _set_resident(self, message_id: str, nbytes: int):
+        self._resident_bytes += nbytes - self._resident.get(message_id, 0)
+        self._resident[message_id] = nbytes
+
+    def note_view_size(self, message_id: str, nbytes: int):
+        """Record the memory held by a message's widgets and textures"""
+        message = self._by_id.get(message_id)
+        if message_id in self._resident:
+            self._set_resident(message_id, message_size(message) + nbytes)
+            self._enforce_budget()
+
+    def keep_in_view(self, message_ids):
+        """Messages that must stay resident because they are near the viewport, replacing the previous set"""
+        self._in_view = set(message_ids)
+
+    def _enforce_budget(self):
+        if not self.memory_budget or self._resident_bytes <= self.memory_budget:
+            return
+        oldest = list(self._resident)[:max(0, len(self._resident) - self.keep_recent)] # least recently used first
+        for message_id in oldest:
+            if self._resident_bytes <= self.memory_budget:
+                break
+            if message_id in self._in_view:
+                continue
+            self._resident_bytes -= self._resident.pop(message_id)
+            self._evict(self._by_id[message_id])
+
+    def _evict(self, message: Message):
+        """Reduce a message to a stub; the full message stays in the store"""
+        message.content = ""
+        message.formatted = None
+        message.blocks = None
+        message.evicted = True
+        metrics.incr("history.evict")
+        for observer in self._eviction_observers:
+            observer(message)
+
+    def reload_message(self, message_id: str) -> Optional[Message]:
+        """Fill in a stub from the store, or mark a resident message as recently used"""
+        message = self._by_id.get(message_id)
+        if message is None:
+            return None
+        if message.evicted:
+            stored = self.store.get(message_id)
+            message.content = stored.content
+            message.formatted = stored.formatted
+            message.evicted = False
+            if message.formatted is None:
+                self._format(message) # blocks are not stored
+            self._set_resident(message_id, message_size(message))
+            metrics.incr("history.reload")
+            self._enforce_budget()
+        elif message_id in self._resident:
+            self._resident.move_to_end(message_id)
+        return message
+
+    def memory_usage(self) -> dict:
+        return {
+            "budget": self.memory_budget,
+            "resident_bytes": self._resident_bytes,
+            "resident": len(self._resident),
+            "stubs": len(self._messages) - len(self._resident),
+        }
+    
+    def get_all_messages(self, full: bool = False) -> List[Message]:
+        """Get all messages; with full, stubs are replaced by copies loaded from the store"""
+        if full and self.store is not None:
+            return [ self.store.get(m.id) if m.evicted else m for m in self._messages ]
         return self._messages.copy()
     
     def get_message_by_id(self, message_id: str) -> Optional[Message]:
         """Get a specific message by ID"""
-        return next((msg for msg in self._messages if msg.id == message_id), None)
+        return self._by_id.get(message_id)
     
     def clear_messages(self):
         """Clear all messages"""
         self._messages.clear()
+        self._by_id.clear()
+        self._resident.clear()
+        self._resident_bytes = 0
+        self._in_view.clear()
+        if self.store is not None:
+            self.store.clear()
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+        render_pool = getattr(self.processor, "render_pool", None)
+        if render_pool is not None:
+            render_pool.shutdown()
 
 
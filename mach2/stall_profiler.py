@@ -0,0 +1,160 @@
+#
+# Stack samples of the main thread while the UI is stalled.
+#
+# A hitch in the chat (a bubble that appears late, a scroll that sticks) means
+# the main thread was busy, but not with what.  The StallProfiler runs a
+# watchdog thread that pings the asyncio loop, which Kivy's clock runs on
+# (ChatApp.async_run), and times how long the ping waits.  Once a ping has
+# waited longer than the threshold, the watchdog samples the main thread's
+# stack every few milliseconds until the ping is answered, and writes the
+# samples in the collapsed-stack format read by flamegraph.pl, speedscope and
+# similar tools:
+#
+#    stall msg_12;_run_once (base_events.py:1922);_format (services.py:301);... 14
+#
+# The first frame names the messages that the main thread was working on
+# during the stall, as marked with working_on(message_id), so that a stall can
+# be traced to processor.process, building a bubble's texture, or decoding a
+# response for a particular message.  Files go to ~/.mach2/stalls, one per
+# stall, named by time, length and message.
+#
+# The Kivy frame interval during the stall (the time since the clock's last
+# frame) is recorded alongside.  It is not used to detect stalls, since an
+# idle app legitimately runs few frames (see idle.py).
+#
+# Samples are taken when the main thread lets go of the GIL, which pure Python
+# code does every few milliseconds; a long call into C that holds it shows up
+# as fewer samples, all in that call.
+#
+
+import os
+import sys
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import List, Optional
+
+from .metrics import metrics
+
+
+DEFAULT_STALL_DIR = os.path.join(os.path.expanduser("~"), ".mach2", "stalls")
+MAX_SAMPLES = 2000 # per stall
+
+# messages the main thread is working on, innermost last
+_working_on: List[str] = []
+
+
+@contextmanager
+def working_on(message_id: str):
+    """Attribute stalls within the block to a message"""
+    _working_on.append(message_id)
+    try:
+        yield
+    finally:
+        _working_on.pop()
+
+
+def collapse(frame) -> str:
+    """A stack as root-first 'function (file:line)' names separated by semicolons"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})".replace(";", ":"))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StallProfiler:
+    """
+    Sample the main thread while the event loop is blocked for longer than
+    threshold_ms, and write the samples as collapsed stacks.
+
+    Args:
+        threshold_ms: loop lag that counts as a stall
+        directory: where the .folded files are written
+        sample_ms: interval between stack samples during a stall
+        clock: the Kivy clock, for the frame interval (optional)
+    """
+
+    def __init__(self, threshold_ms: float, directory: str = None, sample_ms: float = 5, clock=None):
+        self.threshold = threshold_ms / 1000
+        self.directory = directory or DEFAULT_STALL_DIR
+        self.sample_interval = sample_ms / 1000
+        self.clock = clock
+        self._main = threading.main_thread().ident
+        self._loop = None
+        self._sent = None # when the outstanding ping was sent
+        self._answered = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, loop):
+        """Watch an asyncio loop that runs on the main thread"""
+        self._loop = loop
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="stall-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._answered.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _ping(self):
+        self._sent = time.perf_counter()
+        self._answered.clear()
+        self._loop.call_soon_threadsafe(self._answered.set)
+
+    def _run(self):
+        interval = min(0.25, self.threshold / 2) # between pings
+        while not self._stop.is_set():
+            try:
+                self._ping()
+            except RuntimeError: # the loop is closed
+                return
+            if not self._answered.wait(self.threshold):
+                self._sample()
+            self._stop.wait(interval)
+
+    def _sample(self):
+        """Collect main thread stacks until the ping is answered"""
+        stacks = Counter()
+        samples = 0
+        messages = []
+        frame_interval = None
+        while samples < MAX_SAMPLES and not self._answered.wait(self.sample_interval):
+            frame = sys._current_frames().get(self._main)
+            if frame is None:
+                return
+            stacks[collapse(frame)] += 1
+            samples += 1
+            current = _working_on[-1:] # one read: the main thread may pop in between
+            if current and current[0] not in messages:
+                messages.append(current[0])
+            if self.clock is not None: # get_time() is the time of the last frame
+                frame_interval = self.clock.time() - self.clock.get_time()
+            del frame
+        lag = time.perf_counter() - self._sent
+        if self._stop.is_set() or not samples:
+            return
+
+        metrics.incr("stall.count")
+        metrics.observe("stall.lag", lag)
+        self._write(stacks, messages, lag, frame_interval)
+
+    def _write(self, stacks: Counter, messages: List[str], lag: float, frame_interval: Optional[float]):
+        tag = ",".join(messages[:3]) or "none"
+        name = f"stall-{time.strftime('%Y%m%d-%H%M%S')}-{lag * 1000:.0f}ms-{tag}.folded"
+        path = os.path.join(self.directory, name.replace(os.sep, "_"))
+        try:
+            with open(path, "w") as f:
+                for (stack, count) in stacks.most_common():
+                    f.write(f"stall {tag};{stack} {count}\n")
+        except OSError as e:
+            print(f"STALL WRITE FAILED:{path}:{e}")
+            return
+        frame = f"{frame_interval * 1000:.0f}ms" if frame_interval is not None else "-"
+        print(f"STALL:{lag * 1000:.0f}ms:frame {frame}:{tag}:{path}")
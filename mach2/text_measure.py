@@ -0,0 +1,141 @@
+#
+# Wrapped text heights, measured off the main thread.
+#
+# A bubble's height is only known once its Label has rendered the text at the
+# bubble's width, so bubbles used to appear at a guessed size and then jump,
+# and a placeholder for an evicted message kept whatever height it last had.
+# The TextMeasureService lays out markup with a core MarkupLabel in a worker
+# thread (layout only: no texture is made, so no GL is needed) and caches the
+# height by message id, text and width bucket, so the history can give a bubble
+# its final height before the bubble exists.  The text is part of the key
+# (by its hash, which Python caches on the string) because a message's
+# markup changes when the render pool delivers it, and a height measured from
+# the raw content must not be used for the rendered text.
+#
+# Widths are rounded down to WIDTH_BUCKET pixels.  LeanBubble wraps its text
+# at the bucket width, so its height is exactly the measured one, and resizing
+# within a bucket does not render the text again.
+#
+# Kivy's text providers call FreeType with the GIL held, so measuring in a
+# thread does not race the main thread's rendering; it moves the work out of
+# the frame rather than running it in parallel.
+#
+
+import time
+import queue
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+from kivy.clock import Clock
+from kivy.core.text.markup import MarkupLabel as CoreMarkupLabel
+from kivy.metrics import sp
+
+from .metrics import metrics
+
+
+WIDTH_BUCKET = 8 # pixels
+FONT_SIZE = 14 # sp, the bubbles' text
+
+
+def bucket_width(width: float) -> int:
+    """The width text is wrapped at: rounded down to a multiple of WIDTH_BUCKET"""
+    return max(WIDTH_BUCKET, int(width) // WIDTH_BUCKET * WIDTH_BUCKET)
+
+
+def measure_height(markup: str, width: int, font_size: float) -> int:
+    """Height of markup wrapped at width, as a Label would render it"""
+    if not markup:
+        return 0
+    label = CoreMarkupLabel(text=markup, font_size=font_size, text_size=(width, None), valign='top')
+    return label.render()[1]
+
+
+class TextMeasureService:
+    """
+    Measure the height of message text in a worker thread.
+
+    request(key, markup, width, callback) calls callback(key, height) on the
+    main thread, at once if the height is cached.  height(key, markup, width)
+    returns a cached height or None.  Bubbles that render their text can put()
+    its height so that it need not be measured again.  forget(key) drops the
+    heights of all of a message's texts.
+    """
+
+    def __init__(self, max_entries: int = 20000):
+        self.max_entries = max_entries
+        self._heights: "OrderedDict[Tuple[str, int, int], int]" = OrderedDict() # (key, text hash, bucket) -> height, main thread only
+        self._pending: Dict[Tuple[str, int, int], list] = {} # (key, text hash, bucket) -> callbacks
+        self._jobs = queue.Queue()
+        self._worker = None # started on the first request
+
+    def height(self, key: str, markup: str, width: float) -> Optional[int]:
+        entry = (key, hash(markup), bucket_width(width))
+        height = self._heights.get(entry)
+        if height is not None:
+            self._heights.move_to_end(entry)
+        return height
+
+    def put(self, key: str, markup: str, width: float, height: int):
+        self._store((key, hash(markup), bucket_width(width)), height)
+
+    def _store(self, entry, height: int):
+        self._heights[entry] = height
+        self._heights.move_to_end(entry)
+        while len(self._heights) > self.max_entries:
+            self._heights.popitem(last=False)
+
+    def forget(self, key: str):
+        for entry in [ entry for entry in self._heights if entry[0] == key ]:
+            del self._heights[entry]
+
+    def request(self, key: str, markup: str, width: float, callback: Callable = None):
+        height = self.height(key, markup, width)
+        if height is not None:
+            metrics.incr("measure.hit")
+            if callback:
+                callback(key, height)
+            return
+
+        metrics.incr("measure.miss")
+        entry = (key, hash(markup), bucket_width(width))
+        waiting = self._pending.get(entry)
+        if waiting is not None: # already queued
+            if callback:
+                waiting.append(callback)
+            return
+        self._pending[entry] = [ callback ] if callback else []
+
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, name="text-measure", daemon=True)
+            self._worker.start()
+        self._jobs.put((entry, markup, sp(FONT_SIZE)))
+
+    def _run(self):
+        while True:
+            (entry, markup, font_size) = self._jobs.get()
+            start = time.perf_counter()
+            try:
+                height = measure_height(markup, entry[2], font_size)
+            except Exception as e:
+                print(f"MEASURE FAILED:{entry[0]}:{e}")
+                height = None
+            metrics.observe("measure.text", time.perf_counter() - start)
+            Clock.schedule_once(lambda dt, entry=entry, height=height: self._on_measured(entry, height))
+
+    def _on_measured(self, entry, height: Optional[int]):
+        callbacks = self._pending.pop(entry, ())
+        if height is not None:
+            self._store(entry, height)
+        for callback in callbacks:
+            callback(entry[0], height)
+
+
+_service = None
+
+def get_measure_service() -> TextMeasureService:
+    """The shared TextMeasureService, created on first use"""
+    global _service
+    if _service is None:
+        _service = TextMeasureService()
+    return _service
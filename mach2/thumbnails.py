@@ -0,0 +1,445 @@
+#
+# Thumbnails for image bubbles.
+#
+# Image bubbles display at 150sp, but loading `source` decodes the full image
+# and keeps a full-size texture alive for as long as the bubble exists.  The
+# ThumbnailService instead:
+#
+#   - decodes and downsamples in worker threads (needs Pillow), taking the
+#     pending image closest to the visible part of the chat first
+#   - caches the downsampled PNGs on disk, keyed by the image's path, size and
+#     modification time (so a cached thumbnail is found without reading the
+#     image), and removes the least recently used ones when the directory
+#     grows past a size limit
+#   - packs thumbnails into shared atlas textures with fixed-size cells, and
+#     recycles the least recently used cell that no bubble is showing
+#
+# Full resolution is only loaded when the user opens an image (see
+# widgets/image_viewer_popup.py).  Without Pillow, request() returns False and
+# the caller falls back to loading the file directly.
+#
+# An image of an imported archive may not be on disk yet (archive.py).  The
+# workers write it out before decoding; code on the main thread that opens an
+# image file itself goes through ensure_image_later(), which writes it out in a
+# worker thread and calls back on the main thread.
+#
+
+import os
+import hashlib
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from kivy.clock import Clock
+from kivy.graphics.texture import Texture
+from kivy.uix.scrollview import ScrollView
+
+from .archive import ensure_image, pending_image
+
+try:
+    from PIL import Image as PILImage, ImageOps
+except ImportError:
+    PILImage = None
+
+
+DEFAULT_THUMBNAIL_DIR = os.path.join(os.path.expanduser("~"), ".mach2", "thumbnails")
+DEFAULT_CACHE_BYTES = 200 * 1024 * 1024
+
+# request priorities, lowest first
+VISIBLE = 0
+NEARBY = 1
+OFFSCREEN = 2
+
+
+def viewport_priority(widget) -> int:
+    """Decode priority of a widget in the chat: VISIBLE in the viewport, NEARBY within a screen of it, else OFFSCREEN"""
+    view = widget.parent.parent if widget.parent else None
+    if not isinstance(view, ScrollView) or widget.height <= 1:
+        return VISIBLE # not laid out yet; new bubbles are scrolled into view
+    (x, y) = widget.to_window(*widget.pos)
+    (vx, vy) = view.to_window(*view.pos)
+    (top, view_top) = (y + widget.height, vy + view.height)
+    if top >= vy and y <= view_top:
+        return VISIBLE
+    if min(abs(y - view_top), abs(vy - top)) < view.height:
+        return NEARBY
+    return OFFSCREEN
+
+
+_extract_pool = None # writes out archive images for ensure_image_later
+
+
+def ensure_image_later(path: str, callback: Callable[[str], None]):
+    """
+    Call callback(path) once the image file can be opened: at once for an
+    ordinary file, and on the main thread after an image of an imported
+    archive has been written out in a worker thread.
+    """
+    global _extract_pool
+    if not pending_image(path):
+        callback(path)
+        return
+    if _extract_pool is None:
+        _extract_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="image-extract")
+    def extract():
+        ensure_image(path)
+        Clock.schedule_once(lambda dt: callback(path))
+    _extract_pool.submit(extract)
+
+
+def thumbnail_key(path: str) -> str:
+    """Identify an image file by its path, size and modification time, without reading it"""
+    stat = os.stat(path)
+    return hashlib.sha256(f"{os.path.abspath(path)}\n{stat.st_size}\n{stat.st_mtime_ns}".encode("utf-8")).hexdigest()
+
+
+class ThumbnailDiskCache:
+    """
+    Downsampled PNGs in a directory, kept under max_bytes by removing the least
+    recently used (oldest modification time; a hit touches the file).  Used
+    from the worker threads.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._bytes = None # total size of the files, counted on the first store
+
+    def path(self, key: str, max_size: int) -> str:
+        return os.path.join(self.directory, f"{key}-{max_size}.png")
+
+    def load(self, key: str, max_size: int):
+        """The cached thumbnail, or None"""
+        path = self.path(key, max_size)
+        try:
+            image = PILImage.open(path)
+            image.load()
+            os.utime(path)
+        except OSError: # not cached, removed meanwhile, or unreadable
+            return None
+        return image
+
+    def store(self, key: str, max_size: int, image):
+        path = self.path(key, max_size)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        image.save(tmp_path, format="PNG")
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = sum(file[1] for file in self._files())
+            else:
+                self._bytes += size
+            if self._bytes > self.max_bytes:
+                self._trim()
+
+    def _files(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".png"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def _trim(self):
+        """Remove the least recently used files until a tenth below the limit, so that not every store trims"""
+        files = sorted(self._files())
+        total = sum(size for (mtime, size, path) in files)
+        for (mtime, size, path) in files:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._bytes = total
+
+
+def make_thumbnail(path: str, max_size: int, cache: Optional[ThumbnailDiskCache]):
+    """
+    Decode and downsample an image file.  Runs in a worker thread.
+    Returns (key, (width, height), RGBA bytes flipped for a Kivy texture).
+    """
+    key = thumbnail_key(ensure_image(path))
+    image = cache.load(key, max_size) if cache else None
+    if image is None:
+        image = PILImage.open(path)
+        image.draft("RGB", (max_size, max_size)) # JPEG decodes at reduced scale
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_size, max_size))
+        image = image.convert("RGBA")
+        if cache:
+            cache.store(key, max_size, image)
+
+    # Kivy textures start at the bottom-left
+    image = image.convert("RGBA").transpose(PILImage.FLIP_TOP_BOTTOM)
+    return (key, image.size, image.tobytes())
+
+
+@dataclass
+class AtlasEntry:
+    key: str
+    page: int
+    cell: int
+    region: object  # kivy TextureRegion
+    users: int = 0
+
+
+class ThumbnailAtlas:
+    """
+    Shared GPU textures ("pages") divided into square cells, one thumbnail per
+    cell.  When every cell is taken, the least recently used entry with no users
+    is recycled.  If all entries are in use a new page is added, up to max_pages;
+    past that, add() returns None.
+    """
+
+    def __init__(self, page_size: int = 2048, cell_size: int = 256, max_pages: int = 4):
+        self.page_size = page_size
+        self.cell_size = cell_size
+        self.max_pages = max_pages
+        self.cells_per_row = page_size // cell_size
+        self.cells_per_page = self.cells_per_row ** 2
+
+        self._pages = []
+        self._free = []  # (page, cell)
+        self._entries: "OrderedDict[str, AtlasEntry]" = OrderedDict()
+
+    def _add_page(self):
+        texture = Texture.create(size=(self.page_size, self.page_size), colorfmt="rgba")
+        page = len(self._pages)
+        self._pages.append(texture)
+        self._free.extend((page, cell) for cell in range(self.cells_per_page))
+
+    def _cell_origin(self, cell: int):
+        return ((cell % self.cells_per_row) * self.cell_size, (cell // self.cells_per_row) * self.cell_size)
+
+    def _allocate(self):
+        if self._free:
+            return self._free.pop(0)
+        for key, entry in self._entries.items(): # least recently used first
+            if entry.users == 0:
+                del self._entries[key]
+                return (entry.page, entry.cell)
+        if len(self._pages) < self.max_pages:
+            self._add_page()
+            return self._free.pop(0)
+        return None
+
+    def get(self, key: str) -> Optional[AtlasEntry]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def add(self, key: str, size, pixels: bytes) -> Optional[AtlasEntry]:
+        (width, height) = size
+        if width > self.cell_size or height > self.cell_size:
+            return None
+        slot = self._allocate()
+        if slot is None:
+            return None
+
+        (page, cell) = slot
+        (x, y) = self._cell_origin(cell)
+        texture = self._pages[page]
+        texture.blit_buffer(pixels, pos=(x, y), size=(width, height), colorfmt="rgba", bufferfmt="ubyte")
+        entry = AtlasEntry(key=key, page=page, cell=cell, region=texture.get_region(x, y, width, height))
+        self._entries[key] = entry
+        return entry
+
+    def stats(self) -> dict:
+        return {
+            "pages": len(self._pages),
+            "entries": len(self._entries),
+            "in_use": sum(1 for e in self._entries.values() if e.users),
+            "bytes": len(self._pages) * self.page_size * self.page_size * 4,
+        }
+
+
+@dataclass
+class _Job:
+    path: str
+    seq: int
+    priority: int = VISIBLE
+    waiters: List[tuple] = field(default_factory=list) # (callback, priority function)
+
+
+class _PriorityDecoder:
+    """
+    Worker threads that decode pending jobs lowest priority first, then oldest
+    first.  Priorities are updated on the main thread with reprioritize(); a
+    worker picks the best job only when it becomes free, so a newly visible
+    image overtakes ones that scrolled out of view.
+    """
+
+    def __init__(self, workers: int, work: Callable, done: Callable):
+        self._work = work
+        self._done = done
+        self._pending: Dict[str, _Job] = {}
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        for i in range(workers):
+            threading.Thread(target=self._run, name=f"thumbnail-{i}", daemon=True).start()
+
+    def submit(self, path: str, callback: Callable, priority: Optional[Callable]):
+        with self._cond:
+            job = self._pending.get(path)
+            if job is None:
+                job = self._pending[path] = _Job(path, next(self._seq))
+            job.waiters.append((callback, priority))
+            job.priority = self._priority_of(job)
+            self._cond.notify()
+
+    def cancel(self, callback: Callable):
+        """Forget a waiter that no longer wants its thumbnail"""
+        with self._cond:
+            for (path, job) in list(self._pending.items()):
+                job.waiters = [ w for w in job.waiters if w[0] != callback ]
+                if not job.waiters:
+                    del self._pending[path]
+
+    def reprioritize(self):
+        with self._cond:
+            jobs = list(self._pending.values())
+        for job in jobs:
+            job.priority = self._priority_of(job)
+
+    @staticmethod
+    def _priority_of(job: _Job) -> int:
+        return min((fn() if fn else VISIBLE) for (cb, fn) in job.waiters)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                job = min(self._pending.values(), key=lambda j: (j.priority, j.seq))
+                del self._pending[job.path]
+            try:
+                result = self._work(job.path)
+                error = None
+            except Exception as e:
+                (result, error) = (None, e)
+            for (callback, fn) in job.waiters:
+                self._done(job.path, result, error, callback)
+
+
+class ThumbnailService:
+    """
+    Produce thumbnail textures for image files without blocking the UI.
+
+    request(path, callback, priority) calls callback(key, texture) on the main
+    thread when the thumbnail is ready.  priority is an optional function
+    returning VISIBLE, NEARBY or OFFSCREEN, re-evaluated by reprioritize() when
+    the view scrolls.  The caller releases the key when it stops displaying the
+    texture so the atlas cell can be recycled.
+    """
+
+    def __init__(self, max_size: int = 256, cache_dir: Optional[str] = DEFAULT_THUMBNAIL_DIR, workers: int = 2,
+                 cache_bytes: int = DEFAULT_CACHE_BYTES):
+        self.max_size = max_size
+        self.cache = ThumbnailDiskCache(cache_dir, cache_bytes) if cache_dir else None
+        self.atlas = ThumbnailAtlas(cell_size=max_size)
+        self.workers = workers
+        self._decoder = None # started on the first request
+        self._keys: Dict[str, str] = {}  # path -> thumbnail_key()
+        self._overflow: Dict[str, list] = {}  # key -> [texture, users] when the atlas is full
+
+    @staticmethod
+    def available() -> bool:
+        return PILImage is not None
+
+    def request(self, path: str, callback: Callable, priority: Optional[Callable] = None) -> bool:
+        """Start loading a thumbnail.  Returns False if thumbnails are unavailable."""
+        if not self.available():
+            return False
+
+        key = self._keys.get(path)
+        if key is not None and self._acquire(key, callback):
+            return True
+
+        if self._decoder is None:
+            self._decoder = _PriorityDecoder(self.workers,
+                                             lambda p: make_thumbnail(p, self.max_size, self.cache),
+                                             self._schedule_decoded)
+        self._decoder.submit(path, callback, priority)
+        return True
+
+    def cancel(self, callback: Callable):
+        """Drop a request that has not been decoded yet"""
+        if self._decoder is not None:
+            self._decoder.cancel(callback)
+
+    def reprioritize(self):
+        """Re-evaluate the priority of pending requests, e.g. after scrolling"""
+        if self._decoder is not None:
+            self._decoder.reprioritize()
+
+    def _schedule_decoded(self, path: str, result, error, callback: Callable):
+        # called in a worker thread; textures are made on the main thread
+        Clock.schedule_once(lambda dt: self._on_decoded(path, result, error, callback))
+
+    def _acquire(self, key: str, callback: Callable) -> bool:
+        entry = self.atlas.get(key)
+        if entry is not None:
+            entry.users += 1
+            callback(key, entry.region)
+            return True
+        overflow = self._overflow.get(key)
+        if overflow is not None:
+            overflow[1] += 1
+            callback(key, overflow[0])
+            return True
+        return False
+
+    def _on_decoded(self, path: str, result, error, callback: Callable):
+        if error is not None:
+            print(f"THUMBNAIL FAILED:{path}:{error}")
+            callback(None, None)
+            return
+
+        (key, size, pixels) = result
+        self._keys[path] = key
+        if self._acquire(key, callback): # another waiter already added it
+            return
+
+        entry = self.atlas.add(key, size, pixels)
+        if entry is not None:
+            entry.users += 1
+            callback(key, entry.region)
+        else:
+            # every atlas cell is on screen: use a texture of thumbnail size
+            texture = Texture.create(size=size, colorfmt="rgba")
+            texture.blit_buffer(pixels, colorfmt="rgba", bufferfmt="ubyte")
+            self._overflow[key] = [texture, 1]
+            callback(key, texture)
+
+    def release(self, key: str):
+        entry = self.atlas.get(key)
+        if entry is not None:
+            entry.users = max(0, entry.users - 1)
+            return
+        overflow = self._overflow.get(key)
+        if overflow is not None:
+            overflow[1] -= 1
+            if overflow[1] <= 0:
+                del self._overflow[key]
+
+
+_service = None
+
+def get_thumbnail_service() -> ThumbnailService:
+    """The shared ThumbnailService, created on first use"""
+    global _service
+    if _service is None:
+        _service = ThumbnailService()
+    return _service
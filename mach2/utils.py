@@ -3,12 +3,42 @@
 #
 
 from .models import Message
+from .archive import ensure_image
 from nlip_sdk.nlip import NLIP_Message, NLIP_Factory
 from nlip_sdk.nlip import AllowedFormats
 
 import os
 import tempfile
 from base64 import b64encode, b64decode
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+#
+# Attachments are encoded and decoded in a shared pool of threads so a message
+# with a gallery of images is not converted one image after another.  File I/O
+# overlaps across threads; results keep the order of the attachments.
+#
+
+_attachment_pool = ThreadPoolExecutor(max_workers=min(8, (os.cpu_count() or 2)), thread_name_prefix="attachment")
+
+def _map_attachments(fn, items):
+    if len(items) <= 1:
+        return [ fn(item) for item in items ]
+    return list(_attachment_pool.map(fn, items))
+
+
+def _encode_image(image_path: str):
+    root, extension = os.path.splitext(image_path)
+    basename = os.path.basename(image_path) # remove directory part and use as label
+    extension = extension.replace(".", "") # remove any period
+
+    fp = open(ensure_image(image_path), "rb")
+    data = fp.read()
+    fp.close()
+
+    b64content=b64encode(data).decode("utf-8")
+    return (b64content, extension, basename)
+
 
 def messageToNlipMessage(message: Message):
 
@@ -18,56 +48,55 @@ def messageToNlipMessage(message: Message):
     
 
     if message.message_type == "image":
-        image_path = message.image_path
-        root, extension = os.path.splitext(image_path)
-        basename = os.path.basename(image_path) # remove directory part and use as label
-        extension = extension.replace(".", "") # remove any period
-
-        fp = open(image_path, "rb")
-        data = fp.read()
-        fp.close()
-
-        b64content=b64encode(data).decode("utf-8")
-        nlip_message.add_binary(b64content, "image", extension, label=basename)
+        for (b64content, extension, basename) in _map_attachments(_encode_image, message.image_paths):
+            nlip_message.add_binary(b64content, "image", extension, label=basename)
 
     return nlip_message
 
 #
-# Find a submessage with an image and store to an image path or return None
+# Find the submessages with images and store each to an image path
 #
 
-def nlipMessageExtractImagePath(nlip_message: NLIP_Message):
+def _decode_image(submsg):
+    # is assumed base64 encoded string
+    content = submsg.content
+    kind, encoding = submsg.subformat.split("/")
+
+    # base64 decode it
+    data = b64decode(content.encode('utf-8'))
+
+    # write it to a temp file
+    tf = tempfile.NamedTemporaryFile(suffix=encoding, mode='wb', delete=False)
+    tf.write(data)
+    tf.close()
+    return tf.name
+
+
+def nlipMessageExtractImagePaths(nlip_message: NLIP_Message) -> List[str]:
 
-    temp_file_path = None
+    images = []
 
     if hasattr(nlip_message, 'submessages'):
         if (nlip_message.submessages is not None):
             for submsg in nlip_message.submessages:
-                subformat = submsg.subformat
-
                 # subformat="image/{encoding}
-                if (subformat.startswith("image")):
-
-                    # is assumed base64 encoded string                    
-                    content = submsg.content
-                    kind, encoding = subformat.split("/")
+                if (submsg.subformat.startswith("image")):
+                    images.append(submsg)
 
-                    # base64 decode it
-                    data = b64decode(content.encode('utf-8'))
+    return _map_attachments(_decode_image, images)
 
-                    # write it to a temp file
-                    tf = tempfile.NamedTemporaryFile(suffix=encoding, mode='wb', delete=False)
-                    tf.write(data)
-                    tf.close()
-                    temp_file_path = tf.name
+#
+# Store the first image, or return None
+#
 
-                    break
-    return temp_file_path
+def nlipMessageExtractImagePath(nlip_message: NLIP_Message):
+    image_paths = nlipMessageExtractImagePaths(nlip_message)
+    return image_paths[0] if image_paths else None
                 
 
 #
-# Find text content in primary message and the first attached image.  Return
-# a local file path for the saved image that can be used with Kivy.
+# Find text content in primary message and the attached images.  Return
+# local file paths for the saved images that can be used with Kivy.
 #
 # Apply simple Kivy formatting for special message parts.
 #
@@ -93,6 +122,6 @@ def nlipMessageExtractParts(nlip_message: NLIP_Message):
                 else:
                     content += f"\n\n{s}"
 
-    image_path = nlipMessageExtractImagePath(nlip_message)
+    image_paths = nlipMessageExtractImagePaths(nlip_message)
 
-    return (content, image_path)
+    return (content, image_paths)
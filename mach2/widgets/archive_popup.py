@@ -0,0 +1,66 @@
+#
+# A popup asking where to export a conversation archive to, or import one from.
+#
+
+import os
+from datetime import datetime
+
+from kivy.uix.popup import Popup
+from kivy.uix.boxlayout import BoxLayout
+from kivy.uix.label import Label
+from kivy.uix.textinput import TextInput
+from kivy.uix.checkbox import CheckBox
+from kivy.uix.button import Button
+
+
+ARCHIVE_EXTENSION = ".m2chat"
+
+
+class ArchivePopup(Popup):
+    """Popup widget for choosing an archive file"""
+
+    def __init__(self, exporting: bool, on_archive_callback=None, **kwargs):
+        super().__init__(**kwargs)
+        self.exporting = exporting
+        self.on_archive_callback = on_archive_callback
+        self.title = "Export Conversation" if exporting else "Import Conversation"
+        self.size_hint = (0.7, None)
+        self.height = '220sp'
+
+        layout = BoxLayout(orientation='vertical', padding=20, spacing=15)
+
+        default = ""
+        if exporting:
+            stamp = datetime.now().strftime("%Y%m%d-%H%M")
+            default = os.path.join(os.path.expanduser('~'), f"conversation-{stamp}{ARCHIVE_EXTENSION}")
+        self.path_input = TextInput(text=default, hint_text='Archive file', multiline=False,
+                                    size_hint_y=None, height='40sp')
+        self.path_input.bind(on_text_validate=self._on_ok)
+        layout.add_widget(self.path_input)
+
+        # rendered markup makes the archive bigger but the import faster
+        self.markup_checkbox = CheckBox(active=False, size_hint_x=None, width='40sp')
+        if exporting:
+            markup_row = BoxLayout(size_hint_y=None, height='30sp')
+            markup_row.add_widget(self.markup_checkbox)
+            markup_row.add_widget(Label(text='Include rendered markup', halign='left'))
+            layout.add_widget(markup_row)
+
+        button_layout = BoxLayout(size_hint_y=None, height='40sp', spacing='10sp')
+        cancel_btn = Button(text='Cancel')
+        cancel_btn.bind(on_press=self.dismiss)
+        ok_btn = Button(text='Export' if exporting else 'Import')
+        ok_btn.bind(on_press=self._on_ok)
+        button_layout.add_widget(cancel_btn)
+        button_layout.add_widget(ok_btn)
+        layout.add_widget(button_layout)
+
+        self.content = layout
+
+    def _on_ok(self, *args):
+        path = os.path.expanduser(self.path_input.text.strip())
+        if not path:
+            return
+        self.dismiss()
+        if self.on_archive_callback:
+            self.on_archive_callback(path, self.markup_checkbox.active)
@@ -0,0 +1,251 @@
+#
+# A popup for choosing one or more images.
+#
+# Folders are listed by mach2.image_index.scan_directory in a background thread
+# and the grid fills in batch by batch.  The grid is a RecycleView, so only the
+# tiles on screen exist, and their thumbnails come from the ThumbnailService.
+# Recently used folders and files are remembered; reopening a recent folder
+# shows its last listing immediately while a fresh scan runs.
+#
+
+import os
+import threading
+from functools import partial
+
+from kivy.clock import Clock
+from kivy.metrics import sp
+from kivy.graphics import Color, Rectangle
+from kivy.properties import StringProperty, BooleanProperty, ObjectProperty
+from kivy.uix.popup import Popup
+from kivy.uix.boxlayout import BoxLayout
+from kivy.uix.button import Button
+from kivy.uix.label import Label
+from kivy.uix.image import Image
+from kivy.uix.spinner import Spinner
+from kivy.uix.behaviors import ButtonBehavior
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
+from kivy.uix.recyclegridlayout import RecycleGridLayout
+
+from ..image_index import RecentImageIndex, scan_directory
+from ..thumbnails import get_thumbnail_service
+
+RECENT_FILES = "Recent images"
+
+
+class ChooserTile(RecycleDataViewBehavior, ButtonBehavior, BoxLayout):
+    """One folder or image in the chooser grid"""
+    name = StringProperty("")
+    path = StringProperty("")
+    is_dir = BooleanProperty(False)
+    selected = BooleanProperty(False)
+    texture = ObjectProperty(None, allownone=True)
+
+    def __init__(self, **kwargs):
+        super().__init__(orientation='vertical', padding='4sp', spacing='2sp', **kwargs)
+        self.chooser = None
+        self._thumbnail_key = None
+        self._thumbnail_path = None
+        self._thumbnail_callback = None
+
+        with self.canvas.before:
+            self._background = Color(0, 0, 0, 0)
+            self._rect = Rectangle(pos=self.pos, size=self.size)
+        self.bind(pos=self._redraw, size=self._redraw, selected=self._redraw, is_dir=self._redraw)
+
+        self.image = Image(fit_mode="contain")
+        self.label = Label(size_hint_y=None, height='20sp', font_size='12sp', shorten=True)
+        self.label.bind(size=lambda label, size: setattr(label, 'text_size', (size[0], None)))
+        self.add_widget(self.image)
+        self.add_widget(self.label)
+        self.bind(texture=self.image.setter('texture'))
+
+    def _redraw(self, *args):
+        self._rect.pos = self.pos
+        self._rect.size = self.size
+        if self.selected:
+            self._background.rgba = (0.2, 0.6, 0.9, 0.6)
+        elif self.is_dir:
+            self._background.rgba = (0.3, 0.3, 0.3, 0.6)
+        else:
+            self._background.rgba = (0, 0, 0, 0)
+
+    def refresh_view_attrs(self, rv, index, data):
+        """Called when the RecycleView reuses this tile for another entry"""
+        self.chooser = rv.chooser
+        super().refresh_view_attrs(rv, index, data)
+        self.label.text = f"{self.name}/" if self.is_dir else self.name
+        if self.path != self._thumbnail_path:
+            self._release_thumbnail()
+            if not self.is_dir:
+                self._thumbnail_path = self.path
+                self._thumbnail_callback = partial(self._on_thumbnail, self.path)
+                get_thumbnail_service().request(self.path, self._thumbnail_callback)
+
+    def _on_thumbnail(self, path, key, texture):
+        if key is None:
+            return
+        if path != self._thumbnail_path or self._thumbnail_key is not None:
+            get_thumbnail_service().release(key) # the tile moved on while decoding
+            return
+        self._thumbnail_key = key
+        self.texture = texture
+
+    def on_parent(self, widget, parent):
+        # scrolled out of the grid: let the atlas recycle the cell
+        if parent is None:
+            self._release_thumbnail()
+
+    def _release_thumbnail(self):
+        if self._thumbnail_callback is not None:
+            get_thumbnail_service().cancel(self._thumbnail_callback)
+            self._thumbnail_callback = None
+        if self._thumbnail_key is not None:
+            get_thumbnail_service().release(self._thumbnail_key)
+        self._thumbnail_key = None
+        self._thumbnail_path = None
+        self.texture = None
+
+    def on_release(self):
+        if self.chooser:
+            self.chooser.on_tile(self.path, self.is_dir)
+
+
+class ImageChooserPopup(Popup):
+    """Popup widget for choosing images without blocking the UI"""
+    on_image_selected = ObjectProperty(allownone=True)
+
+    def __init__(self, index: RecentImageIndex = None, **kwargs):
+        super().__init__(**kwargs)
+        self.title = "Select Images"
+        self.size_hint = (0.9, 0.9)
+        self.index = index or RecentImageIndex()
+        self.folder = None
+        self.selection = []
+        self._generation = 0 # bumped to cancel a running scan
+
+        layout = BoxLayout(orientation='vertical', spacing='10sp', padding='10sp')
+
+        nav = BoxLayout(size_hint_y=None, height='40sp', spacing='10sp')
+        up_btn = Button(text='Up', size_hint_x=None, width='60sp')
+        up_btn.bind(on_press=lambda *args: self.open_folder(os.path.dirname(self.folder or os.path.expanduser('~'))))
+        self.path_label = Label(shorten=True, shorten_from='left', halign='left', valign='middle')
+        self.path_label.bind(size=lambda label, size: setattr(label, 'text_size', size))
+        self.recent = Spinner(text='Recent', size_hint_x=None, width='150sp',
+                              values=[RECENT_FILES] + self.index.folders)
+        self.recent.bind(text=self._on_recent)
+        nav.add_widget(up_btn)
+        nav.add_widget(self.path_label)
+        nav.add_widget(self.recent)
+
+        self.status = Label(size_hint_y=None, height='20sp', font_size='12sp')
+
+        self.grid = RecycleView()
+        self.grid.chooser = self
+        self.grid_layout = RecycleGridLayout(cols=5, spacing='4sp', size_hint_y=None,
+                                             default_size=(None, sp(120)), default_size_hint=(1, None))
+        self.grid_layout.bind(minimum_height=self.grid_layout.setter('height'))
+        self.grid.add_widget(self.grid_layout)
+        self.grid.viewclass = ChooserTile # kept by the layout manager, so set once it is added
+
+        button_layout = BoxLayout(size_hint_y=None, height='40sp', spacing='10sp')
+        cancel_btn = Button(text='Cancel', size_hint_x=0.5)
+        cancel_btn.bind(on_press=self.dismiss)
+        self.select_btn = Button(text='Select', size_hint_x=0.5)
+        self.select_btn.bind(on_press=self.select_images)
+        button_layout.add_widget(cancel_btn)
+        button_layout.add_widget(self.select_btn)
+
+        layout.add_widget(nav)
+        layout.add_widget(self.status)
+        layout.add_widget(self.grid)
+        layout.add_widget(button_layout)
+        self.content = layout
+
+        start = next((f for f in self.index.folders if os.path.isdir(f)), None)
+        if start is None:
+            pictures = os.path.join(os.path.expanduser('~'), 'Pictures')
+            start = pictures if os.path.isdir(pictures) else os.path.expanduser('~')
+        self.open_folder(start)
+
+    def _item(self, folder: str, name: str, is_dir: bool) -> dict:
+        path = os.path.join(folder, name)
+        return { 'name': name, 'path': path, 'is_dir': is_dir, 'selected': path in self.selection }
+
+    def open_folder(self, folder: str):
+        """Show a folder: its remembered listing at once, then a fresh background scan"""
+        self._generation += 1
+        generation = self._generation
+        self.folder = folder
+        self.path_label.text = folder
+
+        cached = self.index.listing(folder)
+        self.grid.data = [ self._item(folder, name, is_dir) for (name, is_dir) in (cached or []) ]
+        self.status.text = "Refreshing..." if cached else "Scanning..."
+
+        def on_batch(batch):
+            if cached is None: # without a remembered listing, fill in as we go
+                Clock.schedule_once(partial(self._add_batch, generation, folder, batch))
+
+        def scan():
+            entries = scan_directory(folder, on_batch, lambda: generation != self._generation)
+            Clock.schedule_once(partial(self._scan_done, generation, folder, entries))
+
+        threading.Thread(target=scan, name="image-scan", daemon=True).start()
+
+    def _add_batch(self, generation, folder, batch, *args):
+        if generation != self._generation:
+            return
+        self.grid.data.extend(self._item(folder, name, is_dir) for (name, is_dir) in batch)
+        self.status.text = f"Scanning... {len(self.grid.data)} items"
+
+    def _scan_done(self, generation, folder, entries, *args):
+        if generation != self._generation:
+            return
+        if entries is None:
+            self.status.text = "Cannot read this folder"
+            return
+        self.grid.data = [ self._item(folder, name, is_dir) for (name, is_dir) in entries ]
+        self.index.remember_listing(folder, entries)
+        images = sum(1 for (name, is_dir) in entries if not is_dir)
+        self.status.text = f"{images} images"
+
+    def _on_recent(self, spinner, text):
+        if text == RECENT_FILES:
+            self._generation += 1 # stop any running scan
+            self.folder = None
+            self.path_label.text = RECENT_FILES
+            files = self.index.recent_files()
+            self.grid.data = [ self._item(os.path.dirname(p), os.path.basename(p), False) for p in files ]
+            self.status.text = f"{len(files)} recent images"
+        elif text in self.index.folders:
+            self.open_folder(text)
+
+    def on_tile(self, path: str, is_dir: bool):
+        """A tile was touched: open a folder, or toggle an image in the selection"""
+        if is_dir:
+            self.open_folder(path)
+            return
+        if path in self.selection:
+            self.selection.remove(path)
+        else:
+            self.selection.append(path)
+        for item in self.grid.data:
+            if item['path'] == path:
+                item['selected'] = path in self.selection
+        self.grid.refresh_from_data()
+        self.select_btn.text = f"Select ({len(self.selection)})" if self.selection else "Select"
+
+    def select_images(self, *args):
+        """Handle image selection"""
+        if self.selection:
+            self.index.record_selection(self.selection)
+            if self.on_image_selected:
+                self.on_image_selected(list(self.selection))
+            self.dismiss()
+
+    def on_dismiss(self):
+        self._generation += 1 # stop any running scan
+        for tile in self.grid_layout.children:
+            tile._release_thumbnail()
+        self.index.save()
@@ -0,0 +1,50 @@
+#
+# A popup that shows an image at full resolution.  Bubbles display thumbnails;
+# the full image is only decoded when the user opens it, and its texture is not
+# kept in the Kivy image cache after the popup closes.  The image is decoded by
+# the Kivy Loader's worker threads, so opening a large image does not stall the UI;
+# an image of an imported archive is written out in a worker thread first.
+#
+
+import os
+
+from kivy.uix.popup import Popup
+from kivy.uix.boxlayout import BoxLayout
+from kivy.uix.image import AsyncImage
+from kivy.uix.button import Button
+
+from ..thumbnails import ensure_image_later
+
+
+class ImageViewerPopup(Popup):
+    """Popup widget showing one image at full resolution"""
+
+    def __init__(self, image_path: str, **kwargs):
+        super().__init__(**kwargs)
+        self.title = os.path.basename(image_path)
+        self.size_hint = (0.9, 0.9)
+
+        layout = BoxLayout(orientation='vertical', spacing='10sp', padding='10sp')
+
+        self.image = AsyncImage(
+            nocache=True, # release the full-size texture with the popup
+            fit_mode="contain",
+        )
+        self._dismissed = False
+        ensure_image_later(image_path, self._show)
+
+        close_btn = Button(text='Close', size_hint_y=None, height='40sp')
+        close_btn.bind(on_press=self.dismiss)
+
+        layout.add_widget(self.image)
+        layout.add_widget(close_btn)
+        self.content = layout
+
+    def _show(self, path: str):
+        if not self._dismissed:
+            self.image.source = path
+
+    def on_dismiss(self):
+        # drop the reference to the full-size texture
+        self._dismissed = True
+        self.image.texture = None
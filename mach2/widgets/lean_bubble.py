@@ -0,0 +1,348 @@
+#
+# A message bubble drawn on the canvas of a single widget.
+#
+# MessageBubble (chat.kv) is about nine widgets: spacers, nested BoxLayouts, a
+# status row, a copy button, a Label and an image grid, each with its own canvas
+# and property bindings, all laid out again whenever the history is resized.
+# LeanBubble instead lays out the bubble itself and draws the background, the
+# text texture, the "cached" and "copy" captions and the thumbnails as
+# instructions on its own canvas:
+#
+#   - the text is rendered with a core MarkupLabel, once per text and width
+#     bucket (text_measure.py), so its height is the one measured in advance
+#   - the caption textures are rendered once and shared by every bubble
+#   - touches are hit-tested by hand: the copy button, the thumbnails, and the
+#     link refs of the text
+#
+# It looks and behaves like MessageBubble, without the fade-in of thumbnails
+# and without the block view (--blocks), which needs its child widgets.  A
+# message that is rendered as blocks anyway, because it is too long for one
+# texture, is shown in a MessageBubble.
+#
+
+import webbrowser
+from typing import Optional
+
+from kivy.clock import Clock
+from kivy.uix.widget import Widget
+from kivy.core.clipboard import Clipboard
+from kivy.core.text.markup import MarkupLabel as CoreMarkupLabel
+from kivy.graphics import Color, Rectangle, RoundedRectangle
+from kivy.properties import StringProperty, NumericProperty
+from kivy.loader import Loader
+from kivy.metrics import sp, dp
+
+from ..models import Message, Roles
+from ..thumbnails import get_thumbnail_service, viewport_priority, ensure_image_later
+from ..text_measure import get_measure_service, bucket_width, FONT_SIZE
+from ..stall_profiler import working_on
+from .image_viewer_popup import ImageViewerPopup
+
+
+# role -> (left spacer, bubble, right spacer) as fractions of the row, bubble color, text alignment
+ROLE_LAYOUT = {
+    Roles.USER: ((0.3, 0.7, 0), (0.85, 0.92, 1, 1), "right"),
+    Roles.ASSISTANT: ((0, 0.7, 0.3), (0.95, 0.95, 0.95, 1), "left"),
+    Roles.SYSTEM: ((0.25, 0.5, 0.25), (0.85, 0.95, 0.85, 1), "center"),
+    Roles.STATUS: ((0.25, 0.5, 0.25), (0.85, 0.95, 0.85, 1), "center"),
+    Roles.WARNING: ((0.25, 0.5, 0.25), (0.95, 0.85, 0.85, 1), "center"),
+}
+OTHER_LAYOUT = ((0.15, 0.7, 0.15), (0.85, 0.85, 0.85, 1), "center")
+
+TEXT_COLOR = (0.2, 0.2, 0.2, 1)
+PLACEHOLDER_COLOR = (0.85, 0.85, 0.85, 1)
+COPY_COLOR = (0.8, 0.8, 0.8, 1)
+COPY_PRESSED_COLOR = (0, 0.7, 0.7, 1)
+
+
+# Geometry, the same as MessageBubble's: 10sp padding and spacing around the
+# bubble, a 20sp status row, and the text 15sp in from the bubble's sides
+
+def bubble_box(row_width: float, role: str):
+    """x and width of the bubble in a row of the history"""
+    ((left, share, right), color, halign) = ROLE_LAYOUT.get(role, OTHER_LAYOUT)
+    row = max(0, row_width - sp(40)) # padding and spacing around the spacers
+    return (sp(20) + row * left, row * share)
+
+
+def text_width(row_width: float, role: str) -> float:
+    """Width of the text area of a bubble"""
+    return max(1, bubble_box(row_width, role)[1] - sp(30))
+
+
+def image_grid(count: int):
+    """The columns, cell height and total height of a bubble's thumbnails"""
+    if not count:
+        return (1, 0, 0)
+    columns = max(1, min(count, 3))
+    cell_height = sp(150) if count <= 1 else sp(100)
+    rows = -(-count // columns)
+    return (columns, cell_height, rows * cell_height + (rows - 1) * sp(5))
+
+
+def bubble_height(text_height: float, image_count: int) -> float:
+    """Height of a bubble with text of this height"""
+    return max(text_height + image_grid(image_count)[2] + sp(10) + sp(20), sp(40)) + sp(10)
+
+
+_captions = {} # (text, font size, italic, color) -> texture, shared by every bubble
+
+
+def caption_texture(text: str, font_size: float, color, italic: bool = False):
+    key = (text, font_size, italic, color)
+    texture = _captions.get(key)
+    if texture is None:
+        label = CoreMarkupLabel(text=text, font_size=font_size, italic=italic, color=color)
+        label.refresh()
+        label.texture.bind()
+        texture = _captions[key] = label.texture
+    return texture
+
+
+class _BubbleImage:
+    """One thumbnail of an image message: its cell and the instructions drawing it"""
+
+    def __init__(self, bubble, path: str):
+        self.bubble = bubble
+        self.path = path
+        self.key = None
+        self.released = False
+        self.cell = (0, 0, 0, 0) # x, y, width, height relative to the bubble
+        with bubble.canvas:
+            self.placeholder = Color(*PLACEHOLDER_COLOR)
+            self.background = RoundedRectangle(radius=[dp(8)])
+            Color(1, 1, 1, 1)
+            self.image = Rectangle(texture=None, size=(0, 0))
+
+    def load(self):
+        if not get_thumbnail_service().request(self.path, self._on_thumbnail, self.bubble.visibility):
+            self._load_full()
+
+    def _load_full(self):
+        ensure_image_later(self.path, self._load_file)
+
+    def _load_file(self, path: str):
+        if self.released:
+            return
+        proxy = Loader.image(path)
+        proxy.bind(on_load=lambda proxy: self._show(proxy.image.texture))
+        if proxy.loaded:
+            self._show(proxy.image.texture)
+
+    def _on_thumbnail(self, key, texture):
+        if key is None:
+            self._load_full()
+            return
+        if self.released: # removed while decoding
+            get_thumbnail_service().release(key)
+            return
+        self.key = key
+        self._show(texture)
+
+    def _show(self, texture):
+        if self.released:
+            return
+        self.placeholder.a = 0
+        self.image.texture = texture
+        self.place()
+
+    def place(self):
+        """Fit the image in its cell, keeping its aspect ratio"""
+        (x, y, width, height) = self.cell
+        (bx, by) = self.bubble.pos
+        self.background.pos = (bx + x, by + y)
+        self.background.size = (width, height)
+        texture = self.image.texture
+        if texture is None or not texture.width or not texture.height:
+            return
+        scale = min(width / texture.width, height / texture.height)
+        (w, h) = (texture.width * scale, texture.height * scale)
+        self.image.pos = (bx + x + (width - w) / 2, by + y + (height - h) / 2)
+        self.image.size = (w, h)
+
+    def contains(self, x: float, y: float) -> bool:
+        (cx, cy, width, height) = self.cell
+        return cx <= x <= cx + width and cy <= y <= cy + height
+
+    def release(self):
+        """Stop waiting for, or showing, the thumbnail"""
+        self.released = True
+        get_thumbnail_service().cancel(self._on_thumbnail)
+        if self.key is not None:
+            get_thumbnail_service().release(self.key)
+            self.key = None
+        self.image.texture = None
+
+
+class LeanBubble(Widget):
+    """UI Component: Visual representation of a message, drawn on one widget"""
+    message_text = StringProperty("")
+    message_formatted = StringProperty(None, allownone=True)
+    texture_pixels = NumericProperty(0) # size of the text texture, for the memory budget
+
+    def __init__(self, message: Message, **kwargs):
+        self.message_id = message.id
+        self.message_text = message.content
+        self.message_formatted = message.formatted or None
+        self.message_type = message.message_type
+        self.role = message.role
+        self.cached = message.cached
+        (_, color, self._halign) = ROLE_LAYOUT.get(message.role, OTHER_LAYOUT)
+        super().__init__(size_hint_y=None, height=sp(50), **kwargs)
+
+        self._label = CoreMarkupLabel(font_size=sp(FONT_SIZE), halign=self._halign, valign='top',
+                                      color=TEXT_COLOR[:3] + (1 if self.message_type == "text" else 0.7,))
+        self._rendered = None # (text, width) of the texture
+        self._pressed = False
+
+        with self.canvas:
+            Color(*color)
+            self._background = RoundedRectangle(radius=[dp(15)])
+            Color(1, 1, 1, 1)
+            self._text = Rectangle(size=(0, 0))
+            self._cached = Rectangle(texture=caption_texture("cached", sp(11), (0.3, 0.5, 0.3, 0.9), italic=True)) \
+                if self.cached else None
+            if self.role == Roles.ASSISTANT:
+                self._copy_color = Color(*COPY_COLOR)
+                self._copy = RoundedRectangle(radius=[dp(5)])
+                Color(1, 1, 1, 1)
+                self._copy_text = Rectangle(texture=caption_texture("copy", sp(15), (0.4, 0.4, 0.4, 0.8)))
+            else:
+                (self._copy_color, self._copy, self._copy_text) = (None, None, None)
+
+        self._images = [ _BubbleImage(self, path) for path in (message.image_paths or ()) ]
+        for image in self._images:
+            image.load()
+
+        self._layout_trigger = Clock.create_trigger(self._layout)
+        self.bind(width=self._layout_trigger, message_text=self._layout_trigger,
+                  message_formatted=self._layout_trigger)
+        self.bind(pos=self._place)
+        self._layout_trigger()
+
+    def _layout(self, *args):
+        (x, width) = bubble_box(self.width, self.role)
+        wrap = bucket_width(text_width(self.width, self.role))
+        text = self.message_formatted or self.message_text
+
+        if self._rendered != (text, wrap):
+            self._rendered = (text, wrap)
+            if text:
+                with working_on(self.message_id):
+                    self._label.text = text
+                    self._label.text_size = (wrap, None)
+                    self._label.refresh()
+                    self._label.texture.bind() # renders now, and fills in the refs, as Label does
+                self._text.texture = self._label.texture
+                self._text.size = self._label.texture.size
+            else:
+                self._text.texture = None
+                self._text.size = (0, 0)
+            self.texture_pixels = self._text.size[0] * self._text.size[1]
+            get_measure_service().put(self.message_id, text, wrap, self._text.size[1])
+
+        self.height = bubble_height(self._text.size[1], len(self._images))
+
+        # cells in rows from the top, under the text
+        (columns, cell_height, images_height) = image_grid(len(self._images))
+        cell_width = (wrap - (columns - 1) * sp(5)) / columns
+        top = self.height - sp(5) - sp(20) - self._text.size[1]
+        for (i, image) in enumerate(self._images):
+            (row, column) = divmod(i, columns)
+            image.cell = (x + sp(15) + column * (cell_width + sp(5)),
+                          top - (row + 1) * cell_height - row * sp(5),
+                          cell_width, cell_height)
+        self._place()
+
+    def _place(self, *args):
+        """Move the canvas instructions to the widget's position"""
+        (x, width) = bubble_box(self.width, self.role)
+        (x, y) = (self.x + x, self.y + sp(5))
+        top = self.top - sp(5)
+        self._background.pos = (x, y)
+        self._background.size = (width, top - y)
+        # halign is applied inside the texture; the texture is aligned in the
+        # text area, which can be up to a width bucket wider
+        slack = text_width(self.width, self.role) - self._text.size[0]
+        offset = { "left": 0, "center": slack / 2, "right": slack }[self._halign]
+        self._text.pos = (x + sp(15) + offset, top - sp(20) - self._text.size[1])
+
+        right = x + width - sp(15)
+        if self._copy:
+            self._copy.size = (sp(60), dp(20))
+            self._copy.pos = (right - sp(60), top - sp(20))
+            self._copy_text.size = self._copy_text.texture.size
+            self._copy_text.pos = (right - sp(30) - self._copy_text.size[0] / 2, top - sp(10) - self._copy_text.size[1] / 2)
+            right -= sp(60)
+        if self._cached:
+            self._cached.size = self._cached.texture.size
+            self._cached.pos = (right - sp(30) - self._cached.size[0] / 2, top - sp(10) - self._cached.size[1] / 2)
+
+        for image in self._images:
+            image.place()
+
+    # Touches
+
+    def _copy_contains(self, x: float, y: float) -> bool:
+        return self._copy is not None and self._copy.pos[0] <= x <= self._copy.pos[0] + self._copy.size[0] \
+            and self._copy.pos[1] <= y <= self._copy.pos[1] + self._copy.size[1]
+
+    def _ref_at(self, x: float, y: float) -> Optional[str]:
+        """The link ref of the text under a point, as Label does it"""
+        (tx, ty) = self._text.pos
+        (width, height) = self._text.size
+        (x, y) = (x - tx, height - (y - ty)) # refs are measured from the top of the texture
+        for (ref, boxes) in self._label.refs.items():
+            for (x1, y1, x2, y2) in boxes:
+                if x1 <= x <= x2 and y1 <= y <= y2:
+                    return ref
+        return None
+
+    def _set_pressed(self, pressed: bool):
+        self._pressed = pressed
+        self._copy_color.rgba = COPY_PRESSED_COLOR if pressed else COPY_COLOR
+
+    def on_touch_down(self, touch):
+        if not self.collide_point(*touch.pos):
+            return False
+        (x, y) = touch.pos
+        if self._copy_contains(x, y):
+            touch.grab(self)
+            self._set_pressed(True)
+            return True
+        for image in self._images:
+            if image.contains(x - self.x, y - self.y):
+                ImageViewerPopup(image.path).open()
+                return True
+        ref = self._ref_at(x, y)
+        if ref is not None:
+            webbrowser.open(ref)
+            return True
+        return False
+
+    def on_touch_up(self, touch):
+        if touch.grab_current is not self:
+            return False
+        touch.ungrab(self)
+        self._set_pressed(False)
+        if self._copy_contains(*touch.pos):
+            Clipboard.copy(self.message_text)
+        return True
+
+    # The same interface as MessageBubble for ChatHistory
+
+    def visibility(self) -> int:
+        return viewport_priority(self)
+
+    def hold_height(self, height: float):
+        """Keep a height until the bubble is laid out"""
+        self.height = height
+
+    def flash_target(self):
+        return self
+
+    def on_parent(self, widget, parent):
+        # let the thumbnail atlas recycle our cells once we are gone
+        if parent is None:
+            for image in self._images:
+                image.release()
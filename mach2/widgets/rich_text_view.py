@@ -0,0 +1,318 @@
+#
+# A column of widgets showing the Blocks of a message (renderers/kivy_blocks.py).
+#
+# Every block has its own widget: a wrapped Label for text, an unwrapped Label
+# in a horizontal ScrollView for code, a line for a rule.  A table is a
+# RecycleView of rows, so only the rows on screen have widgets and textures,
+# however long the table; its column widths are measured once, from the head
+# row and an even sample of the body rows.  A listing (a code block too long
+# for one texture) is a RecycleView of its lines in the same way, as wide as
+# its longest line in the monospace font.  Widgets are kept by
+# block, so when a message's blocks are replaced (the render pool returns, or
+# the message is reloaded) the blocks that did not change keep their widget and
+# texture and only the new ones are rendered.  On resize only text blocks wrap
+# again; code keeps its texture.
+#
+
+import webbrowser
+from typing import List
+
+from kivy.uix.boxlayout import BoxLayout
+from kivy.uix.label import Label
+from kivy.uix.scrollview import ScrollView
+from kivy.uix.widget import Widget
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
+from kivy.core.text import Label as CoreLabel
+from kivy.graphics import Color, Rectangle
+from kivy.properties import ObjectProperty
+from kivy.metrics import sp, dp
+
+from ..metrics import metrics
+from ..renderers.kivy_mistune_bbcode import markup_text
+
+
+TEXT_COLOR = (0.2, 0.2, 0.2, 1)
+QUOTE_COLOR = (0.27, 0.27, 0.67, 1) # the BBCode renderer's #4444AA
+CODE_BACKGROUND = (0.9, 0.9, 0.9, 1)
+RULE_COLOR = (0.7, 0.7, 0.7, 1)
+TABLE_HEAD_BACKGROUND = (0.85, 0.86, 0.9, 1)
+TABLE_STRIPE_BACKGROUND = (0.91, 0.91, 0.91, 1)
+CAPTION_COLOR = (0.45, 0.45, 0.45, 1)
+
+TABLE_FONT_SIZE = 13 # sp
+TABLE_ROW_HEIGHT = 24 # sp
+TABLE_CELL_PADDING = 6 # sp, each side
+TABLE_VISIBLE_ROWS = 12 # rows shown before the table scrolls
+TABLE_SAMPLE_ROWS = 64 # body rows measured for the column widths
+TABLE_MAX_COLUMN = 320 # sp; longer cells are shortened
+
+CODE_FONT = "RobotoMono-Regular"
+LISTING_FONT_SIZE = 13 # sp, as CodeBlock
+LISTING_LINE_HEIGHT = 17 # sp
+LISTING_VISIBLE_LINES = 30 # lines shown before the listing scrolls
+LISTING_MAX_COLUMNS = 400 # characters; longer lines are shortened
+
+
+def indent_width(block) -> float:
+    return block.indent * sp(18) + (sp(12) if block.quote else 0)
+
+
+class TextBlock(Label):
+    """A paragraph, heading or list item, wrapped to the view's width"""
+
+    def __init__(self, block, **kwargs):
+        super().__init__(text=block.markup, markup=True,
+                         font_size=sp(block.size or 14),
+                         color=QUOTE_COLOR if block.quote else TEXT_COLOR,
+                         italic=block.quote,
+                         halign='left', valign='top',
+                         padding=[indent_width(block), dp(2), 0, dp(2)],
+                         size_hint_y=None, **kwargs)
+        if block.quote:
+            with self.canvas.before:
+                Color(*QUOTE_COLOR)
+                self._bar = Rectangle()
+            self.bind(pos=self._place_bar, size=self._place_bar)
+        self.bind(width=self._wrap, texture_size=self._fit)
+
+    def _wrap(self, *args):
+        self.text_size = (self.width, None)
+
+    def _fit(self, *args):
+        self.height = self.texture_size[1]
+
+    def _place_bar(self, *args):
+        self._bar.pos = (self.x + self.padding[0] - sp(9), self.y) # in the quote's left margin
+        self._bar.size = (dp(3), self.height)
+
+    def on_ref_press(self, url: str):
+        webbrowser.open(url)
+
+
+class CodeBlock(ScrollView):
+    """A code block at its natural width, scrolled sideways if it is wider than the view"""
+
+    def __init__(self, block, **kwargs):
+        super().__init__(do_scroll_x=True, do_scroll_y=False, size_hint_y=None,
+                         bar_width=dp(4), scroll_type=['bars', 'content'], **kwargs)
+        self._indent = indent_width(block)
+        label = Label(text=block.markup, markup=True, font_size=sp(13), color=TEXT_COLOR,
+                      halign='left', valign='top', size_hint=(None, None),
+                      padding=[self._indent + dp(6), dp(6), dp(6), dp(6)])
+        label.bind(texture_size=self._fit)
+        with self.canvas.before:
+            Color(*CODE_BACKGROUND)
+            self._background = Rectangle()
+        self.bind(pos=self._place_background, size=self._place_background)
+        self.add_widget(label)
+
+    def _fit(self, label, size):
+        label.size = size
+        self.height = size[1] + dp(4) # room for the scroll bar
+
+    def _place_background(self, *args):
+        self._background.pos = (self.x + self._indent, self.y)
+        self._background.size = (max(0, self.width - self._indent), self.height)
+
+
+class ListingLine(RecycleDataViewBehavior, Label):
+    """One line of a listing; the RecycleView reuses lines as the listing scrolls"""
+
+    def __init__(self, **kwargs):
+        super().__init__(markup=True, shorten=True, font_name=CODE_FONT, font_size=sp(LISTING_FONT_SIZE),
+                         color=TEXT_COLOR, halign='left', valign='middle', **kwargs)
+        self.bind(size=self._fit)
+
+    def _fit(self, *args):
+        self.text_size = self.size
+
+
+class ListingBlock(ScrollView):
+    """A code block too long for one texture: a RecycleView of its lines, scrolled sideways if it is wider than the view"""
+
+    def __init__(self, block, **kwargs):
+        super().__init__(do_scroll_x=True, do_scroll_y=False, size_hint_y=None,
+                         bar_width=dp(4), scroll_type=['bars', 'content'], **kwargs)
+        self._indent = indent_width(block)
+        line_height = sp(LISTING_LINE_HEIGHT)
+        char_width = CoreLabel(font_name=CODE_FONT, font_size=sp(LISTING_FONT_SIZE)).get_extents("0")[0]
+
+        content = BoxLayout(orientation='vertical', size_hint=(None, None),
+                            padding=[self._indent + dp(6), dp(6), dp(6), 0])
+        content.width = self._indent + dp(12) + (min(block.columns, LISTING_MAX_COLUMNS) + 1) * char_width
+
+        lines = RecycleView(do_scroll_x=False, size_hint_y=None,
+                            height=min(len(block.lines), LISTING_VISIBLE_LINES) * line_height,
+                            bar_width=dp(4), scroll_type=['bars', 'content'])
+        layout = RecycleBoxLayout(orientation='vertical', size_hint_y=None,
+                                  default_size=(None, line_height), default_size_hint=(1, None))
+        layout.bind(minimum_height=layout.setter('height'))
+        lines.add_widget(layout)
+        lines.viewclass = ListingLine # kept by the layout manager, so set once it is added
+        lines.data = [ { 'text': line } for line in block.lines ]
+        content.add_widget(lines)
+
+        caption = Label(text=f"{len(block.lines):,} lines", font_size=sp(11), color=CAPTION_COLOR,
+                        halign='left', valign='middle', size_hint_y=None, height=sp(18))
+        caption.bind(size=lambda label, size: setattr(label, 'text_size', size))
+        content.add_widget(caption)
+        content.height = dp(6) + lines.height + caption.height
+
+        with self.canvas.before:
+            Color(*CODE_BACKGROUND)
+            self._background = Rectangle()
+        self.bind(pos=self._place_background, size=self._place_background)
+        self.add_widget(content)
+        self.height = content.height + dp(4) # room for the scroll bar
+
+    def _place_background(self, *args):
+        self._background.pos = (self.x + self._indent, self.y)
+        self._background.size = (max(0, self.width - self._indent), self.height)
+
+
+class RuleBlock(Widget):
+    """A horizontal rule"""
+
+    def __init__(self, block, **kwargs):
+        super().__init__(size_hint_y=None, height=dp(9), **kwargs)
+        self._indent = indent_width(block)
+        with self.canvas:
+            Color(*RULE_COLOR)
+            self._line = Rectangle()
+        self.bind(pos=self._place_line, size=self._place_line)
+
+    def _place_line(self, *args):
+        self._line.pos = (self.x + self._indent, self.center_y)
+        self._line.size = (max(0, self.width - self._indent), dp(1))
+
+
+def column_widths(cells, sample: int = TABLE_SAMPLE_ROWS) -> List[float]:
+    """Column widths that fit the head row and an even sample of the body rows"""
+    (head, body) = (cells[0], cells[1:])
+    step = max(1, len(body) // sample)
+    padding = 2 * sp(TABLE_CELL_PADDING)
+    widths = [ 0 ] * len(head)
+    for (measure, rows) in ((CoreLabel(font_size=sp(TABLE_FONT_SIZE), bold=True), [ head ]),
+                            (CoreLabel(font_size=sp(TABLE_FONT_SIZE)), body[::step][:sample])):
+        for row in rows:
+            for (i, cell) in enumerate(row[:len(widths)]):
+                widths[i] = max(widths[i], measure.get_extents(markup_text(cell))[0])
+    return [ min(max(width + padding, sp(40)), sp(TABLE_MAX_COLUMN)) for width in widths ]
+
+
+class TableRow(RecycleDataViewBehavior, BoxLayout):
+    """One row of a table; the RecycleView reuses rows as the table scrolls"""
+
+    def __init__(self, **kwargs):
+        super().__init__(orientation='horizontal', **kwargs)
+        with self.canvas.before:
+            self._background = Color(0, 0, 0, 0)
+            self._rect = Rectangle()
+        self.bind(pos=self._redraw, size=self._redraw)
+
+    def _redraw(self, *args):
+        self._rect.pos = self.pos
+        self._rect.size = self.size
+
+    def show(self, cells, widths, align, head: bool = False, stripe: bool = False):
+        labels = self.children[::-1]
+        for i in range(len(labels), len(widths)):
+            label = Label(markup=True, shorten=True, font_size=sp(TABLE_FONT_SIZE), color=TEXT_COLOR,
+                          bold=head, valign='middle', size_hint_x=None)
+            self.add_widget(label)
+            labels.append(label)
+        for (i, label) in enumerate(labels):
+            label.width = widths[i]
+            label.text_size = (widths[i] - 2 * sp(TABLE_CELL_PADDING), sp(TABLE_ROW_HEIGHT))
+            label.halign = align[i]
+            label.text = cells[i] if i < len(cells) else ""
+        if head:
+            self._background.rgba = TABLE_HEAD_BACKGROUND
+        else:
+            self._background.rgba = TABLE_STRIPE_BACKGROUND if stripe else (0, 0, 0, 0)
+
+    def refresh_view_attrs(self, rv, index, data):
+        """Called when the RecycleView reuses this row for another one"""
+        table = rv.table
+        self.show(data['cells'], table.widths, table.align, stripe=index % 2 == 1)
+        return super().refresh_view_attrs(rv, index, data)
+
+
+class TableBlock(ScrollView):
+    """A table: a head row over a RecycleView of the body rows, scrolled sideways if it is wider than the view"""
+
+    def __init__(self, block, **kwargs):
+        super().__init__(do_scroll_x=True, do_scroll_y=False, size_hint_y=None,
+                         bar_width=dp(4), scroll_type=['bars', 'content'], **kwargs)
+        self.widths = column_widths(block.cells)
+        self.align = [ align or 'left' for align in block.align ]
+        indent = indent_width(block)
+        row_height = sp(TABLE_ROW_HEIGHT)
+        body = block.cells[1:]
+
+        content = BoxLayout(orientation='vertical', size_hint=(None, None), padding=[indent, 0, 0, 0])
+        content.width = indent + sum(self.widths)
+
+        head = TableRow(size_hint_y=None, height=row_height)
+        head.show(block.cells[0], self.widths, self.align, head=True)
+        content.add_widget(head)
+
+        rows = RecycleView(do_scroll_x=False, size_hint_y=None,
+                           height=min(len(body), TABLE_VISIBLE_ROWS) * row_height,
+                           bar_width=dp(4), scroll_type=['bars', 'content'])
+        rows.table = self
+        layout = RecycleBoxLayout(orientation='vertical', size_hint_y=None,
+                                  default_size=(None, row_height), default_size_hint=(1, None))
+        layout.bind(minimum_height=layout.setter('height'))
+        rows.add_widget(layout)
+        rows.viewclass = TableRow # kept by the layout manager, so set once it is added
+        rows.data = [ { 'cells': row } for row in body ]
+        content.add_widget(rows)
+        content.height = head.height + rows.height
+
+        if len(body) > TABLE_VISIBLE_ROWS:
+            caption = Label(text=f"{len(body):,} rows", font_size=sp(11), color=CAPTION_COLOR,
+                            halign='left', valign='middle', size_hint_y=None, height=sp(18))
+            caption.bind(size=lambda label, size: setattr(label, 'text_size', size))
+            content.add_widget(caption)
+            content.height += caption.height
+
+        self.add_widget(content)
+        self.height = content.height + dp(4) # room for the scroll bar
+
+
+BLOCK_WIDGETS = {
+    "text": TextBlock,
+    "code": CodeBlock,
+    "listing": ListingBlock,
+    "table": TableBlock,
+    "rule": RuleBlock,
+}
+
+
+class RichTextView(BoxLayout):
+    """UI Component: The blocks of a message, one widget per block"""
+    blocks = ObjectProperty(None, allownone=True)
+
+    def __init__(self, **kwargs):
+        super().__init__(orientation='vertical', size_hint_y=None, spacing=dp(4), **kwargs)
+        self.bind(minimum_height=self.setter('height'))
+        self.height = self.minimum_height # nothing to show without blocks
+        self._widgets = {} # Block -> widgets showing it
+
+    def on_blocks(self, instance, blocks):
+        previous = self._widgets
+        self._widgets = {}
+        self.clear_widgets()
+        for block in blocks or ():
+            shown = previous.get(block)
+            if shown:
+                widget = shown.pop()
+                metrics.incr("render.blocks.reused")
+            else:
+                widget = BLOCK_WIDGETS.get(block.kind, TextBlock)(block)
+                metrics.incr("render.blocks.built")
+            self._widgets.setdefault(block, []).append(widget)
+            self.add_widget(widget)